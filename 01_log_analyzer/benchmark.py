@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Benchmarks of log_analyzer stages and generator of synthetic ui_short logs for them
+import os
+import json
+import time
+import random
+import argparse
+import platform
+import tempfile
+import tracemalloc
+from datetime import datetime, timedelta
+from itertools import accumulate
+from functools import partial
+import log_analyzer as la
+from readers import DECOMPRESS_MODES, OPENERS, compression, open_log
+
+RESOURCES = ('banner', 'slot', 'campaign', 'group', 'internal/banner', 'photogenic_banners/list')
+AGENTS = ('Lynx/2.8.8dev.9 libwww-FM/2.14 SSL-MM/1.4.1 GNUTLS/2.10.5', 'Python-urllib/2.7', 'Slotovod',
+          'python-requests/2.13.0', 'Mozilla/5.0 (Windows NT 6.1; WOW64; rv:54.0) Gecko/20100101 Firefox/54.0')
+STATUSES = ('200',) * 95 + ('302', '404', '499', '500', '504')
+STAGES = ('read', 'parse', 'aggregate', 'report')
+FORMATS = {'plain': '', 'gz': '.gz', 'bz2': '.bz2'}
+
+
+def generate_log(path, lines, urls=1000, error_rate=0.0, seed=0):
+    """
+    Writes synthetic ui_short log. Popularity of `urls` distinct URLs follows Zipf law, request times are lognormal
+    with per-URL median. error_rate of lines are broken like the ones nginx writes for bad requests, no parser
+    can get URL from them. Log is compressed if path ends with .gz or .bz2. Returns the number of written lines.
+    """
+    rnd = random.Random(seed)
+    pool = [f'/api/v2/{rnd.choice(RESOURCES)}/{rnd.randrange(10 ** 7, 10 ** 8)}' for _ in range(urls)]
+    medians = [rnd.lognormvariate(-2, 1) for _ in range(urls)]
+    weights = list(accumulate(1 / (rank + 1) for rank in range(urls)))
+    started, ids = datetime(2017, 6, 29, 3, 50, 22), list(range(urls))
+    ext = compression(path)
+    with (OPENERS[ext](path, 'wt', encoding='utf8') if ext else open(path, 'w', encoding='utf8')) as f:
+        for n, i in enumerate(rnd.choices(ids, cum_weights=weights, k=lines)):
+            moment = (started + timedelta(seconds=n // 100)).strftime('%d/%b/%Y:%H:%M:%S +0300')
+            ip = '.'.join(str(rnd.randrange(1, 255)) for _ in range(4))
+            if rnd.random() < error_rate:
+                f.write(f'{ip} -  - [{moment}] "-" 400 0 "-" "-" "-" "-" "-" -\n')
+                continue
+            request_time = rnd.lognormvariate(0, 0.8) * medians[i]
+            f.write(f'{ip} -  - [{moment}] "GET {pool[i]} HTTP/1.1" {rnd.choice(STATUSES)} {rnd.randrange(10, 30000)} '
+                    f'"-" "{rnd.choice(AGENTS)}" "-" "1498697422-{rnd.randrange(10 ** 9)}-4708-{n}" "-" '
+                    f'{request_time:.3f}\n')
+    return lines
+
+
+def measure(func, memory=True):
+    # func is run twice: for timing and under tracemalloc for the peak of Python allocations, which slows it down
+    started = time.perf_counter()
+    result = func()
+    seconds = time.perf_counter() - started
+    peak = None
+    if memory:
+        tracemalloc.start()
+        try:
+            func()
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    return result, seconds, peak
+
+
+def read_stage(log, decompress):
+    # Lines and bytes of the decompressed log
+    f, lines, size = open_log(log, 0, decompress), 0, 0
+    try:
+        for line in f:
+            lines += 1
+            size += len(line)
+    finally:
+        f.close()
+    return lines, size
+
+
+def report_stage(data, size):
+    # Top rows are selected and serialized as in the report, template is not needed
+    return sum(len(part) for part in la.stream_report('', la.iter_rows(data, la.select_top(data, size)), ''))
+
+
+def bench_stages(log, parser='default', decompress='inline', backend='python', report_size=1000, memory=True):
+    # Every stage is measured in isolation: aggregation gets parsed requests from memory, report - ready aggregates
+    stages = {}
+    parse_log = partial(la.parse, log, 1.0, la.PARSERS[parser], decompress=decompress)
+    (lines, size), seconds, peak = measure(lambda: read_stage(log, decompress), memory)
+    stages['read'] = seconds, peak
+    stages['parse'] = measure(lambda: sum(1 for _ in parse_log()), memory)[1:]
+    requests, backend = list(parse_log()), la.BACKENDS[backend]
+    data, seconds, peak = measure(lambda: la.aggregate(requests, data=backend()), memory)
+    stages['aggregate'] = seconds, peak
+    stages['report'] = measure(lambda: report_stage(data, report_size), memory)[1:]
+
+    results = {'lines': lines, 'bytes': size, 'file_bytes': os.path.getsize(log), 'urls': len(data)}
+    for stage, (seconds, peak) in stages.items():
+        results[stage] = {'seconds': round(seconds, 3), 'lines_per_sec': round(lines / seconds),
+                          'mb_per_sec': round(size / seconds / 2 ** 20, 2),
+                          'peak_memory_mb': None if peak is None else round(peak / 2 ** 20, 2)}
+    return results
+
+
+def run_suite(lines=100000, urls=1000, error_rate=0.0, formats=tuple(FORMATS), parser='default', decompress='inline',
+              backend='python', memory=True, seed=0):
+    # Synthetic log is generated in every format into a temporary folder and all stages are measured for it
+    results = {'params': {'lines': lines, 'urls': urls, 'error_rate': error_rate, 'parser': parser,
+                          'decompress': decompress, 'backend': backend, 'seed': seed},
+               'python': platform.python_version(), 'cpus': os.cpu_count(), 'created': datetime.now().isoformat(),
+               'formats': {}}
+    with tempfile.TemporaryDirectory() as tmp:
+        for name in formats:
+            log = os.path.join(tmp, f'nginx-access-ui.log-20170630{FORMATS[name]}')
+            generate_log(log, lines, urls, error_rate, seed)
+            results['formats'][name] = bench_stages(log, parser, decompress, backend, memory=memory)
+    return results
+
+
+def compare(baseline, results):
+    # Relative lines/sec of every stage against the baseline suite results, > 1 is faster
+    return {name: {stage: round(stages[stage]['lines_per_sec'] / baseline['formats'][name][stage]['lines_per_sec'], 2)
+                   for stage in STAGES}
+            for name, stages in results['formats'].items() if name in baseline['formats']}
+
+
+def bench_decompress(log, parser='default'):
+    # Decompression and parsing share one core in inline mode and overlap in thread and external modes
+    results = {}
+    for mode in DECOMPRESS_MODES:
+        started = time.perf_counter()
+        lines = sum(1 for _ in la.parse(log, 1.0, la.PARSERS[parser], decompress=mode))
+        seconds = time.perf_counter() - started
+        results[mode] = {'lines': lines, 'seconds': round(seconds, 3), 'lines_per_sec': round(lines / seconds)}
+    return results
+
+
+def bench_backend(log, parser='default', scale=1, size=1000):
+    # Parsed requests are repeated scale times and kept in memory, so only aggregation and report rows are measured
+    requests = list(la.parse(log, 1.0, la.PARSERS[parser])) * scale
+    results, expected = {}, None
+    for name, backend in la.BACKENDS.items():
+        if name == 'numpy' and la.np is None:
+            continue
+        started = time.perf_counter()
+        data = la.aggregate(requests, data=backend())
+        rows = la.summarize(data, la.select_top(data, size))
+        seconds = time.perf_counter() - started
+        expected = rows if expected is None else expected
+        results[name] = {'lines': len(requests), 'seconds': round(seconds, 3),
+                         'lines_per_sec': round(len(requests) / seconds), 'same_rows': rows == expected}
+    return results
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='stage', required=True)
+
+    suite = subparsers.add_parser('suite', help='Generate logs and measure every stage')
+    suite.add_argument('--lines', type=int, default=100000)
+    suite.add_argument('--urls', type=int, default=1000, help='Number of distinct URLs')
+    suite.add_argument('--error-rate', type=float, default=0.0, help='Share of broken lines')
+    suite.add_argument('--formats', nargs='+', choices=list(FORMATS), default=list(FORMATS))
+    suite.add_argument('--decompress', choices=DECOMPRESS_MODES, default='inline')
+    suite.add_argument('--backend', choices=list(la.BACKENDS), default='python')
+    suite.add_argument('--no-memory', action='store_true', help='Do not measure peak memory with tracemalloc')
+    suite.add_argument('--output', help='Path to save results as JSON')
+    suite.add_argument('--baseline', help='Path to JSON results of a previous run to compare with')
+
+    generate = subparsers.add_parser('generate', help='Generate synthetic ui_short log')
+    generate.add_argument('log', help='Path to log, .gz and .bz2 logs are compressed')
+    generate.add_argument('--lines', type=int, default=100000)
+    generate.add_argument('--urls', type=int, default=1000)
+    generate.add_argument('--error-rate', type=float, default=0.0)
+
+    decompress = subparsers.add_parser('decompress', help='Compare DECOMPRESS modes')
+    decompress.add_argument('log', help='Path to .gz or .bz2 log')
+
+    backend = subparsers.add_parser('backend', help='Compare aggregation BACKENDs')
+    backend.add_argument('log', help='Path to log')
+    backend.add_argument('--scale', type=int, default=1, help='How many times parsed log is repeated')
+
+    for sub in (suite, decompress, backend):
+        sub.add_argument('--parser', choices=list(la.PARSERS), default='default')
+    return parser.parse_args()
+
+
+def print_suite(results, baseline=None):
+    ratios = compare(baseline, results) if baseline else {}
+    for name, result in results['formats'].items():
+        print(f'{name}: {result["lines"]} lines, {result["bytes"] / 2 ** 20:.1f} MB, {result["urls"]} URLs')
+        for stage in STAGES:
+            r = result[stage]
+            ratio = f', x{ratios[name][stage]} of baseline' if name in ratios else ''
+            memory = f', peak {r["peak_memory_mb"]} MB' if r['peak_memory_mb'] is not None else ''
+            print(f'{stage:>10}: {r["seconds"]}s, {r["lines_per_sec"]} lines/sec, {r["mb_per_sec"]} MB/sec'
+                  f'{memory}{ratio}')
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    if args.stage == 'suite':
+        results = run_suite(args.lines, args.urls, args.error_rate, args.formats, args.parser, args.decompress,
+                            args.backend, not args.no_memory)
+        baseline = None
+        if args.baseline:
+            with open(args.baseline) as f:
+                baseline = json.load(f)
+        print_suite(results, baseline)
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump(results, f, indent=2)
+    elif args.stage == 'generate':
+        generate_log(args.log, args.lines, args.urls, args.error_rate)
+    else:
+        if args.stage == 'decompress':
+            results = bench_decompress(args.log, args.parser)
+        else:
+            results = bench_backend(args.log, args.parser, args.scale)
+        for mode, result in results.items():
+            print(f'{mode:>10}: {result["lines"]} lines in {result["seconds"]}s, {result["lines_per_sec"]} lines/sec'
+                  + ('' if result.get('same_rows', True) else ', rows differ'))
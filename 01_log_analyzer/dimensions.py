@@ -0,0 +1,319 @@
+# -*- coding: utf-8 -*-
+# Additional per-URL aggregates computed in the same pass as the main ones. Detailed parsers yield
+# (url, request_time, fields), where fields are raw strings of detail_fields() of enabled dimensions, and
+# Dimensions.add(url_id, t, fields) updates every enabled dimension. Like quantile engines, dimensions are indexed
+# by url_id and support merge(other, id_map), so they survive parallel parsing, checkpoints and range reports.
+import calendar
+from array import array
+from bisect import bisect_left
+
+DETAIL_FIELDS = ('time_local', 'status', 'body_bytes_sent', 'http_user_agent')
+STATUS_CLASSES = ('1xx', '2xx', '3xx', '4xx', '5xx')
+US = 1000000  # Time sums are kept in integer microseconds
+MONTHS = {name: n for n, name in enumerate(('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun',
+                                            'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec'), 1)}
+
+
+def detail_fields(latency_buckets=None, time_window=None, traffic=False, top_agents=None):
+    # Fields of DETAIL_FIELDS needed by enabled dimensions, in the order of DETAIL_FIELDS.
+    # Histograms need only request times, so lines without other fields are still parsed for them
+    needed = set()
+    if time_window is not None:
+        needed.add('time_local')
+    if traffic:
+        needed.update(('status', 'body_bytes_sent'))
+    if top_agents is not None:
+        needed.add('http_user_agent')
+    return tuple(name for name in DETAIL_FIELDS if name in needed)
+
+
+class TimestampParser(object):
+    """
+    $time_local (29/Jun/2017:03:50:22 +0300) -> Unix time. Lines of one minute share the prefix 29/Jun/2017:03:50
+    and the zone, so the minute is converted once and cached, only seconds are parsed for every line.
+    Month names are English as nginx writes them, locale is not used. The cache is dropped when it reaches cache_size.
+    """
+
+    def __init__(self, cache_size=10000):
+        self.cache_size = cache_size
+        self.cache = {}
+
+    @staticmethod
+    def minute(prefix, zone):
+        day, month, rest = prefix.split('/')
+        year, hour, minute = rest.split(':')
+        offset = (int(zone[1:3]) * 60 + int(zone[3:5])) * 60 * (-1 if zone[0] == '-' else 1)
+        return calendar.timegm((int(year), MONTHS[month], int(day), int(hour), int(minute), 0)) - offset
+
+    def __call__(self, value):
+        key = value[:17] + value[20:]
+        minute = self.cache.get(key)
+        if minute is None:
+            if len(self.cache) >= self.cache_size:
+                self.cache.clear()
+            minute = self.cache[key] = self.minute(value[:17], value[21:])
+        return minute + int(value[18:20])
+
+
+class LatencyHistograms(object):
+    """
+    Fixed-bucket histogram of request times per URL. bounds are upper bounds of buckets in seconds, a value equal
+    to a bound goes into its bucket, values above the last bound go into the last +Inf bucket.
+    Counts of all URLs are kept in one flat array, len(bounds) + 1 slots per url_id.
+    """
+
+    def __init__(self, bounds):
+        self.bounds = tuple(bounds)
+        self.size = len(self.bounds) + 1
+        self.counts = array('q')
+
+    def grow(self, i):
+        missing = (i + 1) * self.size - len(self.counts)
+        if missing > 0:
+            self.counts.frombytes(bytes(missing * self.counts.itemsize))
+
+    def add(self, i, t):
+        pos = i * self.size + bisect_left(self.bounds, t)
+        if pos >= len(self.counts):
+            self.grow(i)
+        self.counts[pos] += 1
+
+    def merge(self, other, id_map):
+        for j in range(len(other)):
+            i = id_map[j]
+            self.grow(i)
+            for b in range(self.size):
+                self.counts[i * self.size + b] += other.counts[j * self.size + b]
+        return self
+
+    def __len__(self):
+        return len(self.counts) // self.size
+
+    def row(self, i):
+        counts = self.counts[i * self.size:(i + 1) * self.size] if i < len(self) else [0] * self.size
+        labels = [f'{bound:g}' for bound in self.bounds] + ['+Inf']
+        return dict(zip(labels, counts))
+
+
+class TimeWindows(object):
+    """
+    Count and time sum of requests per URL in fixed windows of `window` seconds by $time_local.
+    Windows are kept sparsely in a dict {window: [count, time_sum]} per url_id, URLs requested in a few windows
+    cost a few entries. Like in Aggregates, time sums are integer microseconds, so merged windows do not depend
+    on the order of merging.
+    """
+
+    def __init__(self, window):
+        self.window = window
+        self.windows = []
+
+    def __setstate__(self, state):
+        # Checkpoints saved before time sums were kept in microseconds have float sums in seconds
+        for windows in state['windows']:
+            for cell in windows.values():
+                if isinstance(cell[1], float):
+                    cell[1] = round(cell[1] * US)
+        self.__dict__.update(state)
+
+    def grow(self, i):
+        while len(self.windows) <= i:
+            self.windows.append({})
+
+    def add(self, i, t, timestamp):
+        if i >= len(self.windows):
+            self.grow(i)
+        w, us = timestamp // self.window, round(t * US)
+        cell = self.windows[i].get(w)
+        if cell is None:
+            self.windows[i][w] = [1, us]
+        else:
+            cell[0] += 1
+            cell[1] += us
+
+    def merge(self, other, id_map):
+        for j, windows in enumerate(other.windows):
+            i = id_map[j]
+            self.grow(i)
+            for w, (count, time_us) in windows.items():
+                cell = self.windows[i].setdefault(w, [0, 0])
+                cell[0] += count
+                cell[1] += time_us
+        return self
+
+    def row(self, i):
+        # [[window start as Unix time, count, time_sum], ...] in the order of time
+        windows = self.windows[i] if i < len(self.windows) else {}
+        return [[w * self.window, count, round(time_us / US, 3)] for w, (count, time_us) in sorted(windows.items())]
+
+
+class TrafficStats(object):
+    """
+    Counts of responses by status class and sum of $body_bytes_sent per URL, in flat arrays indexed by url_id.
+    Statuses out of 1xx-5xx are not counted in classes, bytes which are not a number are counted as 0.
+    """
+    size = len(STATUS_CLASSES)
+
+    def __init__(self):
+        self.statuses = array('q')
+        self.bytes_sum = array('q')
+
+    def grow(self, i):
+        missing = i + 1 - len(self.bytes_sum)
+        if missing > 0:
+            self.bytes_sum.frombytes(bytes(missing * self.bytes_sum.itemsize))
+            self.statuses.frombytes(bytes(missing * self.size * self.statuses.itemsize))
+
+    def add(self, i, status, body_bytes):
+        if i >= len(self.bytes_sum):
+            self.grow(i)
+        if '1' <= status[:1] <= '5':
+            self.statuses[i * self.size + int(status[0]) - 1] += 1
+        if body_bytes.isdigit():
+            self.bytes_sum[i] += int(body_bytes)
+
+    def merge(self, other, id_map):
+        for j in range(len(other.bytes_sum)):
+            i = id_map[j]
+            self.grow(i)
+            self.bytes_sum[i] += other.bytes_sum[j]
+            for c in range(self.size):
+                self.statuses[i * self.size + c] += other.statuses[j * self.size + c]
+        return self
+
+    def row(self, i, count):
+        # error_perc is the share of 5xx responses
+        statuses = self.statuses[i * self.size:(i + 1) * self.size] if i < len(self.bytes_sum) else [0] * self.size
+        row = {f'status_{name}': n for name, n in zip(STATUS_CLASSES, statuses)}
+        row['error_perc'] = statuses[-1] / count if count else 0.0
+        row['bytes_sum'] = self.bytes_sum[i] if i < len(self.bytes_sum) else 0
+        return row
+
+    def totals(self):
+        statuses = [sum(self.statuses[c::self.size]) for c in range(self.size)]
+        return {'statuses': dict(zip(STATUS_CLASSES, statuses)), 'bytes_sum': sum(self.bytes_sum)}
+
+
+class HeavyHitters(object):
+    """
+    Misra-Gries summary of the most frequent keys in at most `size` counters. When a new key does not fit,
+    all counters are decremented, which costs O(size) at most once per size + 1 added keys. Count of a key is
+    underestimated by the number of decrements, which is not more than total / (size + 1), so any key with
+    a larger count is kept. Summaries are merged by adding counters and subtracting the (size + 1)-th largest count.
+    """
+
+    def __init__(self, size=100):
+        self.size = size
+        self.counters = {}
+        self.total = 0
+        self.decrements = 0
+
+    def add(self, key):
+        self.total += 1
+        counters = self.counters
+        if key in counters:
+            counters[key] += 1
+        elif len(counters) < self.size:
+            counters[key] = 1
+        else:
+            self.decrements += 1
+            for k in list(counters):
+                if counters[k] == 1:
+                    del counters[k]
+                else:
+                    counters[k] -= 1
+
+    def merge(self, other):
+        self.total += other.total
+        self.decrements += other.decrements
+        for key, count in other.counters.items():
+            self.counters[key] = self.counters.get(key, 0) + count
+        if len(self.counters) > self.size:
+            cut = sorted(self.counters.values(), reverse=True)[self.size]
+            self.decrements += cut
+            self.counters = {key: count - cut for key, count in self.counters.items() if count > cut}
+        return self
+
+    def error(self):
+        # Maximum underestimation of counts
+        return self.decrements
+
+    def top(self, n):
+        return sorted(self.counters.items(), key=lambda item: (-item[1], item[0]))[:n]
+
+
+class Dimensions(object):
+    """
+    Enabled additional aggregates. settings are kept to check that aggregates of checkpoints are compatible.
+    fields passed to add() are values of detail_fields(**settings).
+    Requests with broken $time_local are counted in histograms, but not in time windows.
+    User agents are not kept per URL, top_agents of the whole log are found with a HeavyHitters summary
+    of 10 * top_agents counters.
+    """
+
+    def __init__(self, latency_buckets=None, time_window=None, traffic=False, top_agents=None):
+        self.settings = {'latency_buckets': None if latency_buckets is None else list(latency_buckets),
+                         'time_window': time_window, 'traffic': traffic, 'top_agents': top_agents}
+        self.histograms = None if latency_buckets is None else LatencyHistograms(latency_buckets)
+        self.windows = None if time_window is None else TimeWindows(time_window)
+        self.traffic = TrafficStats() if traffic else None
+        self.agents = None if top_agents is None else HeavyHitters(10 * top_agents)
+        self.timestamp = TimestampParser()
+        self.fields = {name: k for k, name in enumerate(detail_fields(**self.settings))}  # Positions of fields
+
+    def __getstate__(self):
+        # Cache of timestamps and positions of fields are not pickled into checkpoints
+        state = self.__dict__.copy()
+        state['timestamp'] = state['fields'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.timestamp = TimestampParser()
+        self.fields = {name: k for k, name in enumerate(detail_fields(**self.settings))}
+
+    def add(self, i, t, fields):
+        at = self.fields
+        if self.histograms is not None:
+            self.histograms.add(i, t)
+        if self.windows is not None:
+            try:
+                self.windows.add(i, t, self.timestamp(fields[at['time_local']]))
+            except (ValueError, KeyError, IndexError):  # Broken $time_local
+                pass
+        if self.traffic is not None:
+            self.traffic.add(i, fields[at['status']], fields[at['body_bytes_sent']])
+        if self.agents is not None:
+            self.agents.add(fields[at['http_user_agent']])
+
+    def merge(self, other, id_map):
+        if other.settings != self.settings:
+            raise ValueError(f'Dimensions {other.settings} can not be merged into {self.settings}')
+        if self.histograms is not None:
+            self.histograms.merge(other.histograms, id_map)
+        if self.windows is not None:
+            self.windows.merge(other.windows, id_map)
+        if self.traffic is not None:
+            self.traffic.merge(other.traffic, id_map)
+        if self.agents is not None:
+            self.agents.merge(other.agents)
+        return self
+
+    def row(self, i, count):
+        row = {}
+        if self.histograms is not None:
+            row['time_hist'] = self.histograms.row(i)
+        if self.windows is not None:
+            row['time_windows'] = self.windows.row(i)
+        if self.traffic is not None:
+            row.update(self.traffic.row(i, count))
+        return row
+
+    def summary(self):
+        # Totals of the whole log which are not split by URL
+        summary = {}
+        if self.traffic is not None:
+            summary.update(self.traffic.totals())
+        if self.agents is not None:
+            summary['top_agents'] = [[agent, count] for agent, count in self.agents.top(self.settings['top_agents'])]
+            summary['top_agents_error'] = self.agents.error()
+        return summary
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+# Columnar export of log_analyzer aggregates. Every column is written as NumPy .npy file without NumPy itself,
+# so columns can be opened later with numpy.load(path, mmap_mode='r') and not parsed again.
+import os
+import ast
+import sys
+from array import array
+
+NPY_MAGIC = b'\x93NUMPY\x01\x00'
+BYTE_ORDER = '<' if sys.byteorder == 'little' else '>'
+KINDS = {'b': 'i', 'h': 'i', 'i': 'i', 'l': 'i', 'q': 'i', 'B': 'u', 'H': 'u', 'I': 'u', 'L': 'u', 'Q': 'u',
+         'f': 'f', 'd': 'f'}
+
+
+def write_npy(path, values):
+    # values is array.array or 1-d NumPy array, its native layout is written as is after the .npy header
+    descr = values.dtype.str if hasattr(values, 'dtype') else f'{BYTE_ORDER}{KINDS[values.typecode]}{values.itemsize}'
+    header = "{'descr': '%s', 'fortran_order': False, 'shape': (%d,), }" % (descr, len(values))
+    header += ' ' * (63 - (len(NPY_MAGIC) + 2 + len(header)) % 64) + '\n'  # Data is aligned by 64 bytes
+    with open(path, 'wb') as f:
+        f.write(NPY_MAGIC)
+        f.write(len(header).to_bytes(2, 'little'))
+        f.write(header.encode('latin1'))
+        values.tofile(f)
+
+
+def read_npy(path):
+    # Reads 1-d .npy file written by write_npy into array.array
+    with open(path, 'rb') as f:
+        if f.read(len(NPY_MAGIC)) != NPY_MAGIC:
+            raise ValueError(f'Not a .npy v1.0 file: {path}')
+        header = ast.literal_eval(f.read(int.from_bytes(f.read(2), 'little')).decode('latin1'))
+        descr = header['descr']
+        typecode = next(t for t, k in KINDS.items() if k == descr[1] and array(t).itemsize == int(descr[2:]))
+        values = array(typecode)
+        values.frombytes(f.read())
+    if descr[0] != BYTE_ORDER and values.itemsize > 1:
+        values.byteswap()
+    return values
+
+
+def export_aggregates(data, directory, quantiles=(), raw=False):
+    """
+    Writes per-URL columns indexed by url_id: urls.txt (one URL per line), count, time_sum, time_max, time_avg
+    and given quantiles [(name, q)]. With raw=True also writes (url_id, request_time) of every request,
+    if the quantiles engine keeps them.
+    """
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, 'urls.txt'), 'w', encoding='utf8') as f:
+        for url in data.urls:
+            f.write(url + '\n')
+    write_npy(os.path.join(directory, 'count.npy'), data.count)
+    write_npy(os.path.join(directory, 'time_sum.npy'), data.time_sum)
+    write_npy(os.path.join(directory, 'time_max.npy'), data.time_max)
+    write_npy(os.path.join(directory, 'time_avg.npy'), array('d', (s / c for s, c in zip(data.time_sum, data.count))))
+
+    columns = [array('d') for _ in quantiles]
+    for i in range(len(data)):
+        for column, value in zip(columns, data.durations.quantiles(i, [q for _, q in quantiles])):
+            column.append(value)
+    for (name, _), column in zip(quantiles, columns):
+        write_npy(os.path.join(directory, f'{name}.npy'), column)
+
+    if raw:
+        if not hasattr(data.durations, 'values'):
+            raise ValueError('Raw request times are kept only by exact quantiles engine')
+        write_npy(os.path.join(directory, 'url_id.npy'), data.durations.ids)
+        write_npy(os.path.join(directory, 'request_time.npy'), data.durations.values)
@@ -8,14 +8,40 @@ import os
 import sys
 import json
 import logging
+import pickle
 import gzip
 import re
-from string import Template
-from statistics import median
-from collections import namedtuple
+import time
+from datetime import datetime, timedelta
+from collections import namedtuple, Counter
 import argparse
+import heapq
+import math
+import signal
+import multiprocessing
+from functools import partial
+from itertools import islice
+from array import array
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from quantiles import ExactQuantiles, TDigestQuantiles
+from log_format import LogFormat, UI_SHORT
+from readers import open_log, open_range, compression, raw_position, DECOMPRESS_MODES
+from export import export_aggregates
+from metrics import Metrics
+from dimensions import Dimensions, DETAIL_FIELDS, US, detail_fields
+
+try:
+    import numpy as np
+except ImportError:  # Only numpy BACKEND needs it
+    np = None
 
 Logdata = namedtuple('Log', 'path name date')
+QUANTILE_ENGINES = {'exact': ExactQuantiles, 'tdigest': TDigestQuantiles}
+PERCENTILES = (('time_med', 0.5), ('time_p90', 0.9), ('time_p95', 0.95), ('time_p99', 0.99))
+METHODS = ['GET', 'HEAD', 'POST', 'PUT', 'DELETE', 'CONNECT', 'OPTIONS', 'TRACE']
+OTHER_URL = '[other]'
+LOG_NAME = re.compile(r'^nginx-access-ui\.log-\d{8}(\.gz$|\.bz2$|$)')
+SORT_METRICS = ('count', 'time_sum', 'time_max', 'time_avg') + tuple(name for name, _ in PERCENTILES)
 
 
 def create_app_logger(logpath):
@@ -23,9 +49,17 @@ def create_app_logger(logpath):
     logging.basicConfig(filename=logpath, format=fmt, datefmt=dfmt, level=logging.INFO)
 
 
+def parse_date(value):
+    datetime.strptime(value, '%Y%m%d')
+    return value
+
+
 def parse_args():
     parser = argparse.ArgumentParser()
     parser.add_argument('--config', help='Path to config')
+    parser.add_argument('--date-from', type=parse_date, help='First day of range report, YYYYMMDD')
+    parser.add_argument('--date-to', type=parse_date, help='Last day of range report, YYYYMMDD. Default: date-from')
+    parser.add_argument('--watch', action='store_true', help='Follow the live log and update the report periodically')
     return parser.parse_args()
 
 
@@ -34,7 +68,33 @@ def read_config(args):
               'ERROR_LEVEL': 0.2,
               'APP_LOG': None,
               'REPORT_DIR': './reports',
-              'LOG_DIR': '/var/log/nginx'}
+              'LOG_DIR': '/var/log/nginx',
+              'WORKERS': 1,
+              'QUANTILES': 'exact',
+              'SORT_BY': 'count',
+              'PARSER': 'default',
+              'LOG_FORMAT': None,
+              'DECOMPRESS': 'inline',
+              'MMAP_THRESHOLD': 64 * 1024 * 1024,
+              'URL_STRIP_QUERY': False,
+              'URL_COLLAPSE_IDS': False,
+              'URL_RULES': [],
+              'MAX_URLS': None,
+              'REPORT_GZIP': False,
+              'EXPORT_DIR': None,
+              'EXPORT_RAW': False,
+              'BACKEND': 'python',
+              'PROGRESS_INTERVAL': 10,
+              'HOST_BREAKDOWN': False,
+              'WATCH_LOG': None,
+              'WATCH_INTERVAL': 60,
+              'ERROR_SAMPLE': 1000,
+              'ERROR_CHECK_EVERY': 100000,
+              'LATENCY_BUCKETS': None,
+              'TIME_WINDOW': None,
+              'TRAFFIC_STATS': False,
+              'TOP_AGENTS': None,
+              'RANGE_MAX_VALUES': 50000000}
 
     if args.config is not None:
         with open(args.config, 'r') as c:
@@ -48,102 +108,1140 @@ def check_config(config):
     if not os.path.isdir(config['REPORT_DIR']):
         os.mkdir(config['REPORT_DIR'])
 
-    if not os.path.isdir(config['LOG_DIR']):
-        f = config['LOG_DIR']
-        raise Exception(f'Log folder not found: \"{f}\"')
+    for f in log_dirs(config):
+        if not os.path.isdir(f):
+            raise Exception(f'Log folder not found: \"{f}\"')
+
+    if config['QUANTILES'] not in QUANTILE_ENGINES:
+        q = config['QUANTILES']
+        raise Exception(f'Unknown quantiles engine: \"{q}\". Available: {", ".join(QUANTILE_ENGINES)}')
+
+    if config['SORT_BY'] not in SORT_METRICS:
+        m = config['SORT_BY']
+        raise Exception(f'Unknown metric to sort by: \"{m}\". Available: {", ".join(SORT_METRICS)}')
+
+    if config['PARSER'] not in PARSERS:
+        p = config['PARSER']
+        raise Exception(f'Unknown parser: \"{p}\". Available: {", ".join(PARSERS)}')
+
+    if config['DECOMPRESS'] not in DECOMPRESS_MODES:
+        d = config['DECOMPRESS']
+        raise Exception(f'Unknown decompress mode: \"{d}\". Available: {", ".join(DECOMPRESS_MODES)}')
+
+    if config['PARSER'] == 'format':
+        get_parser(config)  # Raises ValueError if $request, $request_time or fields of dimensions are missing
+
+    if config['EXPORT_RAW'] and config['QUANTILES'] != 'exact':
+        raise Exception('EXPORT_RAW requires exact QUANTILES engine, other engines do not keep request times')
+
+    if config['BACKEND'] not in BACKENDS:
+        b = config['BACKEND']
+        raise Exception(f'Unknown backend: \"{b}\". Available: {", ".join(BACKENDS)}')
+
+    if config['BACKEND'] == 'numpy':
+        if np is None:
+            raise Exception('numpy BACKEND requires NumPy, install it with: pip install numpy')
+        if config['QUANTILES'] != 'exact':
+            raise Exception('numpy BACKEND supports only exact QUANTILES engine')
+
+    if config['PROGRESS_INTERVAL'] is not None and not isinstance(config['PROGRESS_INTERVAL'], (int, float)):
+        raise Exception(f'PROGRESS_INTERVAL must be a number of seconds or null, got: {config["PROGRESS_INTERVAL"]}')
+
+    if not isinstance(config['WATCH_INTERVAL'], (int, float)) or config['WATCH_INTERVAL'] <= 0:
+        raise Exception(f'WATCH_INTERVAL must be a positive number of seconds, got: {config["WATCH_INTERVAL"]}')
+
+    for key in ('ERROR_SAMPLE', 'ERROR_CHECK_EVERY'):
+        if config[key] is not None and (not isinstance(config[key], int) or config[key] <= 0):
+            raise Exception(f'{key} must be a positive number of lines or null, got: {config[key]}')
+
+    buckets = config['LATENCY_BUCKETS']
+    if buckets is not None and (not isinstance(buckets, list) or not buckets
+                                or not all(isinstance(b, (int, float)) and b > 0 for b in buckets)
+                                or sorted(set(buckets)) != buckets):
+        raise Exception(f'LATENCY_BUCKETS must be an increasing list of positive seconds or null, got: {buckets}')
+
+    if config['TIME_WINDOW'] is not None and (not isinstance(config['TIME_WINDOW'], int) or config['TIME_WINDOW'] <= 0):
+        raise Exception(f'TIME_WINDOW must be a positive number of seconds or null, got: {config["TIME_WINDOW"]}')
+
+    if config['RANGE_MAX_VALUES'] is not None and (not isinstance(config['RANGE_MAX_VALUES'], int)
+                                                   or config['RANGE_MAX_VALUES'] <= 0):
+        raise Exception(f'RANGE_MAX_VALUES must be a positive number or null, got: {config["RANGE_MAX_VALUES"]}')
+
+    if config['TOP_AGENTS'] is not None and (not isinstance(config['TOP_AGENTS'], int) or config['TOP_AGENTS'] <= 0):
+        raise Exception(f'TOP_AGENTS must be a positive number or null, got: {config["TOP_AGENTS"]}')
+
+    for rule in config['URL_RULES']:
+        if not isinstance(rule, list) or len(rule) != 2:
+            raise Exception(f'URL rule must be a pair [regex, replacement], got: {rule}')
+        re.compile(rule[0])
+
+
+def log_dirs(config):
+    # LOG_DIR is a folder or a list of folders, one per frontend host
+    return [config['LOG_DIR']] if isinstance(config['LOG_DIR'], str) else list(config['LOG_DIR'])
+
+
+def host_names(dirs):
+    # Hosts are named by their log folders, full paths are used only if folder names are not unique
+    names = [os.path.basename(os.path.normpath(d)) for d in dirs]
+    return names if len(set(names)) == len(names) else [os.path.normpath(d) for d in dirs]
+
+
+def find_last_log(dir_path):
+    # Returns Logdata of the latest log in the folder or None. Only names are checked, files are not opened
+    with os.scandir(dir_path) as entries:
+        logs = [e.name for e in entries if e.name.startswith('nginx-access-ui.log-') and LOG_NAME.search(e.name)
+                and e.is_file()]
+    if not logs:
+        return None
+    log = max(logs)  # If exist .gz, .bz2 and plain text log with same date - gz log is returned
+    return Logdata(f'{dir_path}/{log}', log, log.split('.')[1].split('-')[1])
 
 
 def get_last_log(dir_path):
-    files, pat = os.listdir(dir_path), re.compile(r'^nginx-access-ui\.log-\d{8}(\.gz$|$)')
-    logs = [f for f in files if pat.search(f)]
-    if len(logs) == 0:
+    log = find_last_log(dir_path)
+    if log is None:
         msg = f'Logs not found in {dir_path}'
         logging.error(msg)
         raise Exception(msg)
-    log = max(logs)  # If exist .gz and plain text log with same date - gz log is returned
-    log = (log, log.split('.')[1].split('-')[1])
-    logging.info(f'Got log: {log[0]} from {dir_path}')
-    return Logdata(f'{dir_path}/{log[0]}', log[0], log[1])
+    logging.info(f'Got log: {log.name} from {dir_path}')
+    return log
 
 
-def is_parsed(log_date, report_dir):
-    return os.path.isfile(f'{report_dir}/report-{log_date}.html')
+def scan_log_dir(dir_path):
+    try:
+        return find_last_log(dir_path)
+    except OSError as e:
+        logging.warning(f'Unable to scan {dir_path}: {e}')
+        return None
 
 
-def parse(log, err_level):
-    total_rows, unparsed_rows = 0, 0
-    f = gzip.open(log, 'rb') if log.endswith('gz') else open(log, 'rb')
-    for line in f:
-        total_rows += 1
+def get_last_logs(dirs):
+    # Folders of all hosts are scanned concurrently. Returns {host: Logdata} of the latest date found among hosts,
+    # hosts without a log of this date or with unavailable folders are skipped with a warning
+    with ThreadPoolExecutor(max_workers=min(len(dirs), 32)) as executor:
+        found = dict(zip(host_names(dirs), executor.map(scan_log_dir, dirs)))
+    dates = [log.date for log in found.values() if log is not None]
+    if not dates:
+        msg = f'Logs not found in {", ".join(dirs)}'
+        logging.error(msg)
+        raise Exception(msg)
+    logs = {}
+    for host, log in found.items():
+        if log is None or log.date != max(dates):
+            logging.warning(f'No log of {max(dates)} for host {host}, it is skipped')
+            continue
+        logging.info(f'Got log: {log.name} of host {host}')
+        logs[host] = log
+    return logs
+
+
+def log_signature(log):
+    # Name and size of the log. Logs of several hosts are passed as {host: path} and give lists of names and sizes
+    if isinstance(log, dict):
+        return [f'{host}/{os.path.basename(path)}' for host, path in log.items()], \
+               [os.path.getsize(path) for path in log.values()]
+    return os.path.basename(log), os.path.getsize(log)
+
+
+def is_parsed(log_date, report_dir, log=None):
+    # Report is up to date if log was not changed after the last run. Reports without checkpoints are never updated
+    checkpoint = f'{report_dir}/report-{log_date}.checkpoint'
+    if not os.path.isfile(f'{report_dir}/report-{log_date}.html'):
+        return False
+    if log is None or not os.path.isfile(checkpoint):
+        return True
+    header = read_checkpoint(checkpoint, header_only=True)
+    return (header['log'], header['size']) == log_signature(log)
+
+
+def read_checkpoint(path, header_only=False):
+    # Checkpoint is two pickles: small header {'log', 'size', 'stats'} and Aggregates
+    with open(path, 'rb') as f:
+        header = pickle.load(f)
+        return header if header_only else (header, pickle.load(f))
+
+
+def load_checkpoint(log, log_date, report_dir, engine=ExactQuantiles, backend=None, dimensions=None):
+    # Returns (stats, data) to resume from or None if log was rotated or replaced since the checkpoint was saved.
+    # Aggregates made with other backend (by default - Aggregates), quantiles engine or dimensions are not resumed
+    backend = Aggregates if backend is None else backend
+    path = f'{report_dir}/report-{log_date}.checkpoint'
+    if not os.path.isfile(path):
+        return None
+    try:
+        header, data = read_checkpoint(path)
+    except Exception as e:
+        logging.error(f'Unable to read checkpoint {path}: {e}')
+        return None
+    if header['log'] != os.path.basename(log) or header['size'] > os.path.getsize(log) \
+            or type(data) is not backend or not isinstance(data.durations, engine) \
+            or dimension_settings(data) != (None if dimensions is None else Dimensions(**dimensions).settings):
+        logging.info(f'Checkpoint {path} does not match {log}, log is parsed from the start')
+        return None
+    logging.info(f'Resuming {log} from offset {header["stats"]["offset"]}')
+    return header['stats'], data
+
+
+def save_checkpoint(log, log_date, report_dir, size, stats, data):
+    path = f'{report_dir}/report-{log_date}.checkpoint'
+    with open(f'{path}.tmp', 'wb') as f:
+        pickle.dump({'log': log_signature(log)[0], 'size': size, 'stats': stats}, f, pickle.HIGHEST_PROTOCOL)
+        pickle.dump(data, f, pickle.HIGHEST_PROTOCOL)
+    os.replace(f'{path}.tmp', path)
+
+
+# Getters of DETAIL_FIELDS for parse_lines: (words of the line, line) -> value.
+# [$time_local] is split into two words, $http_user_agent may contain spaces
+WORD_FIELDS = {'time_local': lambda words, text: words[4][1:] + ' ' + words[5][:-1],
+               'status': lambda words, text: words[9],
+               'body_bytes_sent': lambda words, text: words[10],
+               'http_user_agent': lambda words, text: text.split('"')[5]}
+
+# Getters of DETAIL_FIELDS for parse_lines_fast: (bytes before $request, bytes after it) -> value
+BYTES_FIELDS = {'time_local': lambda head, rest: head[head.rfind(b'[') + 1:-2],
+                'status': lambda head, rest: rest.split(b' ', 3)[1],
+                'body_bytes_sent': lambda head, rest: rest.split(b' ', 3)[2],
+                'http_user_agent': lambda head, rest: rest.split(b'"', 4)[3]}
+
+
+def parse_lines(lines, stats, detailed=False, fields=DETAIL_FIELDS):
+    # If detailed, (url, request_time, values) are yielded, values are strings of `fields`. Only these fields
+    # are extracted, so lines without the other ones are not counted as unparsed
+    getters = [WORD_FIELDS[name] for name in fields]
+    for line in lines:
+        stats['total'] += 1
         try:
-            line = line.decode('utf8').rstrip('\n').split(' ')
+            text = line.decode('utf8').rstrip('\n')
+            line = text.split(' ')
             # Request is first "string" attribute with spaces, consisting of $METHOD, $URL, $PROTOCOL.
             # So if method not found at line[6] app is unable to get URL
-            if line[6].replace('\"', '') not in ['GET', 'HEAD', 'POST', 'PUT', 'DELETE', 'CONNECT', 'OPTIONS', 'TRACE']:
-                unparsed_rows += 1
+            if line[6].replace('\"', '') not in METHODS:
+                stats['unparsed'] += 1
                 continue
             row = (line[7], float(line[-1]))  # (url, request_time)
+            if detailed:
+                row += (tuple(get(line, text) for get in getters),)
             yield row
         except Exception:
-            unparsed_rows += 1
+            stats['unparsed'] += 1
             continue
-    f.close()
+
+
+def parse_lines_fast(lines, stats, detailed=False, fields=DETAIL_FIELDS):
+    # ui_short only: $request is the first quoted field right after [$time_local], $request_time is the last field.
+    # Works on bytes, only URL (and `fields` of detailed requests) is decoded
+    methods, getters = frozenset(m.encode() for m in METHODS), [BYTES_FIELDS[name] for name in fields]
+    for line in lines:
+        stats['total'] += 1
+        try:
+            head, request, rest = line.split(b'"', 2)
+            method, url, _ = request.split(b' ', 2)
+            if method not in methods or not head.endswith(b'] '):
+                stats['unparsed'] += 1
+                continue
+            if detailed:  # $status $body_bytes_sent "$http_referer" "$http_user_agent" follow $request
+                values = tuple(get(head, rest).decode('utf8') for get in getters)
+                yield url.decode('utf8'), float(line[line.rfind(b' ') + 1:]), values
+            else:
+                yield url.decode('utf8'), float(line[line.rfind(b' ') + 1:])
+        except (ValueError, IndexError):  # Not enough fields, UnicodeDecodeError or wrong $request_time
+            stats['unparsed'] += 1
+
+
+def parse_lines_format(lines, stats, log_format=None, detailed=False, fields=DETAIL_FIELDS):
+    # Any nginx log_format, compiled once into LogFormat extractor of method, URL, request time
+    # and `fields` if detailed
+    log_format = log_format or LogFormat(UI_SHORT, format_fields(detailed, fields))
+    methods, extract = frozenset(m.encode() for m in METHODS), log_format.extract
+    for line in lines:
+        stats['total'] += 1
+        fields = extract(line)
+        if fields is None or fields[0] not in methods:
+            stats['unparsed'] += 1
+            continue
+        try:
+            if detailed:
+                yield fields[1].decode('utf8'), float(fields[2]), tuple(f.decode('utf8') for f in fields[3:])
+            else:
+                yield fields[1].decode('utf8'), float(fields[2])
+        except ValueError:
+            stats['unparsed'] += 1
+
+
+def format_fields(detailed=False, fields=DETAIL_FIELDS):
+    return ('request_method', 'request_uri', 'request_time') + (tuple(fields) if detailed else ())
+
+
+PARSERS = {'default': parse_lines, 'fast': parse_lines_fast, 'format': parse_lines_format}
+
+
+class UrlNormalizer(object):
+    """
+    Maps URLs with different query strings, numeric or hex ids into one key, e.g.
+    /api/v2/banner/25019354?x=1 -> /api/v2/banner/{id}. User rules are (regex, replacement) pairs applied in order.
+    Normalized URLs are cached, the cache is dropped when it reaches cache_size.
+    """
+    NUMERIC = re.compile(r'(?<=/)\d+(?=/|$)')
+    HEX = re.compile(r'(?<=/)[0-9a-fA-F]*\d[0-9a-fA-F]*(?=/|$)')
+
+    def __init__(self, strip_query=False, collapse_ids=False, rules=(), cache_size=100000):
+        self.strip_query = strip_query
+        self.collapse_ids = collapse_ids
+        self.rules = [(re.compile(pattern), replacement) for pattern, replacement in rules]
+        self.cache_size = cache_size
+        self.cache = {}
+
+    def normalize(self, url):
+        if self.strip_query:
+            url = url.split('?', 1)[0]
+        if self.collapse_ids:
+            path, sep, query = url.partition('?')
+            path = self.NUMERIC.sub('{id}', path)
+            url = self.HEX.sub(lambda m: '{hex}' if len(m.group()) >= 8 else m.group(), path) + sep + query
+        for pattern, replacement in self.rules:
+            url = pattern.sub(replacement, url)
+        return url
+
+    def __call__(self, url):
+        normalized = self.cache.get(url)
+        if normalized is None:
+            if len(self.cache) >= self.cache_size:
+                self.cache.clear()
+            normalized = self.cache[url] = self.normalize(url)
+        return normalized
+
+
+def parse_normalized(lines, stats, parser=parse_lines, normalizer=None):
+    for url, *rest in parser(lines, stats):
+        yield (normalizer(url), *rest)
+
+
+def get_parser(config):
+    # Parsers yield details of requests only if additional dimensions are enabled, and only the fields they need
+    dimensions = get_dimensions(config)
+    detailed, fields = dimensions is not None, () if dimensions is None else detail_fields(**dimensions)
+    if config['PARSER'] == 'format':
+        log_format = LogFormat(config['LOG_FORMAT'] or UI_SHORT, format_fields(detailed, fields))
+        parser = partial(parse_lines_format, log_format=log_format, detailed=detailed, fields=fields)
+    else:
+        parser = partial(PARSERS[config['PARSER']], detailed=True, fields=fields) if detailed \
+            else PARSERS[config['PARSER']]
+    if config['URL_STRIP_QUERY'] or config['URL_COLLAPSE_IDS'] or config['URL_RULES']:
+        normalizer = UrlNormalizer(config['URL_STRIP_QUERY'], config['URL_COLLAPSE_IDS'], config['URL_RULES'])
+        parser = partial(parse_normalized, parser=parser, normalizer=normalizer)
+    return parser
+
+
+def log_throughput(log, lines, seconds):
+    rate = lines / seconds if seconds else 0.0
+    logging.info(f'Parsed {lines} lines of {log} in {seconds:.2f}s ({rate:.0f} lines/sec)')
+
+
+def check_errors(log, stats, err_level, budget=None):
     try:
-        err_share = round(unparsed_rows / total_rows, 2)
+        err_share = round(stats['unparsed'] / stats['total'], 2)
     except ZeroDivisionError:
         logging.error(f'Log is empty: {log} ')
         err_share = 1.0
     if err_share >= err_level:
-        msg = f'{err_share * 100}% ({unparsed_rows}) log were not parsed.'
+        msg = f'{err_share * 100}% ({stats["unparsed"]}) log were not parsed.'
+        if budget is not None and budget.patterns:
+            msg += ' ' + budget.describe()
         logging.error(msg)
         raise Exception(msg)
 
 
-def analyze(gen):
-    data = {'report': {}, 'total_time': 0.0, 'count_total': 0}
-    for log_row in gen:
-        url, t = log_row
-        data['total_time'] += t
-        data['count_total'] += 1
+def wilson_lower_bound(failed, total, z=3.0):
+    # Lower bound of the failure rate confidence interval, z=3 gives ~99.9% confidence for one-sided check
+    if not total:
+        return 0.0
+    p, z2 = failed / total, z * z
+    bound = (p + z2 / (2 * total) - z * math.sqrt(p * (1 - p) / total + z2 / (4 * total * total))) / (1 + z2 / total)
+    return max(bound, 0.0)
+
+
+class AbortedByOther(Exception):
+    """Parsing of a part of the log is stopped because ErrorBudget of another part aborted it"""
+
+
+class SharedErrors(object):
+    """
+    Line counters of all ranges of aggregate_parallel, shared by worker processes, so ErrorBudget of every range
+    checks the unparsed share of the whole log, not of its own range. The share is estimated over ranges weighted
+    by their sizes in bytes, so a range which is read faster than the others does not outweigh them. Until every
+    range has passed its first check the share is unknown and nothing is aborted.
+    abort is set by the budget which aborts, the others stop at their next check.
+    """
+
+    def __init__(self, sizes):
+        self.weights = [size / sum(sizes) for size in sizes]
+        self.counts = multiprocessing.Array('q', 2 * len(sizes))  # total, unparsed of every range
+        self.abort = multiprocessing.Event()
+
+    def update(self, part, total, unparsed):
+        # Returns (unparsed, total) of the whole log estimated from the counters of all ranges or None
+        with self.counts.get_lock():
+            self.counts[2 * part:2 * part + 2] = [total, unparsed]
+            counts = self.counts[:]
+        totals, failed = counts[::2], counts[1::2]
+        if not all(totals):
+            return None
+        lines = sum(totals)
+        return lines * sum(w * u / t for w, t, u in zip(self.weights, totals, failed)), lines
 
-        if url not in data['report']:
-            data['report'][url] = {'count': 1, 'time_avg': t, 'time_max': t, 'time_sum': t, 'url': url,
-                                   'time_med': t, 'durations': [t]}
 
+class ErrorBudget(object):
+    """
+    Streaming check of the unparsed share, so a log of unexpected format fails after the first lines instead of
+    the whole file. Lines are passed to the parser as they are read and counted by parts: the first `sample` lines,
+    then every `every` lines. After each part parsing is aborted if the lower confidence bound of the unparsed share
+    is not below err_level. Failed lines are grouped into patterns for the error message. They are caught one by one
+    only in the first part and in parts after the ones with failures, until max_failed of them are collected,
+    other parts are passed through without per-line work.
+    Budgets of ranges parsed in parallel get SharedErrors and the number of their range, then the share of
+    the whole log is checked.
+    """
+
+    def __init__(self, log, err_level, sample=1000, every=100000, z=3.0, max_failed=100, shared=None, part=0):
+        self.log = log
+        self.shared = shared
+        self.part = part
+        self.err_level = err_level
+        self.sample = sample
+        self.every = every
+        self.z = z
+        self.max_failed = max_failed
+        self.patterns = Counter()
+        self.examples = {}
+
+    def monitor(self, lines, stats):
+        # When the generator is resumed after a part, the parser is done with its last line
+        it, size, collect = iter(lines), self.sample, True
+        while True:
+            total, unparsed = stats['total'], stats['unparsed']
+            if collect and sum(self.patterns.values()) < self.max_failed:
+                yield from self.failed(islice(it, size), stats)
+            else:
+                yield from islice(it, size)
+            if stats['total'] == total:
+                return
+            self.check(stats)
+            if stats['total'] - total < size:
+                return
+            size, collect = self.every, stats['unparsed'] > unparsed
+
+    def failed(self, lines, stats):
+        # Failed line is seen by the change of unparsed counter after the parser has taken the next line
+        for line in lines:
+            unparsed = stats['unparsed']
+            yield line
+            if stats['unparsed'] != unparsed:
+                pattern = self.pattern(line)
+                self.patterns[pattern] += 1
+                self.examples.setdefault(pattern, line.decode('utf8', 'replace').rstrip()[:300])
+
+    def check(self, stats):
+        unparsed, total = stats['unparsed'], stats['total']
+        if self.shared is not None:
+            if self.shared.abort.is_set():
+                raise AbortedByOther(f'Parsing of {self.log} is aborted because another part has too many errors')
+            estimate = self.shared.update(self.part, total, unparsed)
+            if estimate is None:
+                return
+            unparsed, total = estimate
+        if wilson_lower_bound(unparsed, total, self.z) >= self.err_level:
+            msg = f'Parsing of {self.log} is aborted after {total} lines: ' \
+                  f'{unparsed / total:.1%} ({unparsed:.0f}) lines were not parsed, ' \
+                  f'ERROR_LEVEL is {self.err_level:.0%}. {self.describe()}'
+            logging.error(msg)
+            if self.shared is not None:
+                self.shared.abort.set()
+            raise Exception(msg)
+
+    @staticmethod
+    def pattern(line):
+        # Shape of the line: quoted values and numbers are masked
+        line = line.decode('utf8', 'replace').rstrip()
+        return re.sub(r'\d+', '9', re.sub(r'"[^"]*"', '"*"', line))[:200]
+
+    def describe(self, top=3):
+        return 'Failed line patterns: ' + '; '.join(f'{count} x {pattern} (e.g. {self.examples[pattern]})'
+                                                    for pattern, count in self.patterns.most_common(top))
+
+
+def complete_lines(f, stats):
+    # Unfinished last line of a log which is still being written is left for the next run
+    line = b''
+    for line in f:
+        if not line.endswith(b'\n'):
+            break
+        yield line
+    stats['offset'] = f.tell() - (0 if line.endswith(b'\n') else len(line))
+
+
+def parse(log, err_level, parser=parse_lines, stats=None, decompress='inline', mmap_threshold=None, metrics=None,
+          error_check=None):
+    # stats of the previous run may be passed to continue from its offset, counters are accumulated.
+    # If metrics are passed, time of reading (with decompression) and parsing is recorded and progress is logged.
+    # error_check=(sample, every) enables early abort by ErrorBudget
+    stats = {'total': 0, 'unparsed': 0, 'offset': 0} if stats is None else stats
+    total, started = stats['total'], time.perf_counter()
+    budget = None if error_check is None else ErrorBudget(log, err_level, *error_check)
+    f = open_log(log, stats['offset'], decompress, mmap_threshold)
+    try:
+        lines = complete_lines(f, stats)
+        if budget is not None:
+            lines = budget.monitor(lines, stats)
+        if metrics is None:
+            yield from parser(lines, stats)
         else:
-            data['report'][url]['count'] += 1
-            data['report'][url]['time_sum'] += t
-            data['report'][url]['durations'].append(t)
-            data['report'][url]['time_avg'] = data['report'][url]['time_sum'] / data['report'][url]['count']
-            if t > data['report'][url]['time_max']:
-                data['report'][url]['time_max'] = t
-
-    rows = []
-    for k, v in data['report'].items():
-        v['time_perc'] = v['time_sum'] / data['total_time']
-        v['count_perc'] = v['count'] / data['count_total']
-        v['time_med'] = median(v['durations'])
-        del v['durations']
+            start, size = raw_position(f), os.path.getsize(log)
+            progress = metrics.progress(partial(raw_position, f), size)
+            lines = metrics.timed(lines, 'read', 61, on_sample=progress)
+            yield from metrics.timed(parser(lines, stats), 'parse', 64, nested=('read',))
+            metrics.count('lines', stats['total'] - total)
+            if start is not None:
+                metrics.count('bytes_read', (raw_position(f) or size) - start)
+    finally:
+        f.close()
+    log_throughput(log, stats['total'] - total, time.perf_counter() - started)
+    check_errors(log, stats, err_level, budget)
+
+
+def complete_size(log):
+    # Size of the plain text log without unfinished last line
+    with open(log, 'rb') as f:
+        end = f.seek(0, os.SEEK_END)
+        while end > 0:
+            block = max(end - 65536, 0)
+            f.seek(block)
+            pos = f.read(end - block).rfind(b'\n')
+            if pos >= 0:
+                return block + pos + 1
+            end = block
+    return 0
+
+
+def split_log(log, parts, start=0, end=None):
+    # Chunk bounds are moved to the start of the next line, so no line is shared between chunks
+    size = os.path.getsize(log) if end is None else end
+    bounds = [start]
+    with open(log, 'rb') as f:
+        for i in range(1, parts):
+            f.seek(max(start + (size - start) * i // parts - 1, bounds[-1]))
+            f.readline()
+            bounds.append(min(f.tell(), size))
+    bounds.append(size)
+    return [(start, end) for start, end in zip(bounds, bounds[1:]) if start < end]
+
+
+def read_range(log, start, end, mmap_threshold=None):
+    f = open_range(log, start, end, mmap_threshold)
+    try:
+        yield from f
+    finally:
+        f.close()
+
+
+class Aggregates(object):
+    """
+    Per-URL aggregates. URLs are interned into integer ids, metrics are kept in typed arrays indexed by id,
+    so a distinct URL costs a few array slots instead of a dict with a list of floats.
+    If max_urls is set, URLs seen after max_urls distinct ones are counted in OTHER_URL bucket.
+    dimensions are settings of additional aggregates {name: value} passed to Dimensions, requests are added
+    with their details then.
+    Time sums are kept in integer microseconds, so they are exact and do not depend on the order requests are added
+    and aggregates are merged in: parallel, resumed and range reports give the same sums as a serial run.
+    """
+    dimensions = None  # Aggregates of checkpoints saved before dimensions were added have no such attribute
+
+    def __init__(self, engine=ExactQuantiles, max_urls=None, dimensions=None):
+        self.max_urls = max_urls
+        self.dimensions = None if dimensions is None else Dimensions(**dimensions)
+        self.ids = {}
+        self.urls = []
+        self.count = array('q')
+        self.time_us = array('q')
+        self.time_max = array('d')
+        self.durations = engine()
+        self.count_total = 0
+        self.total_us = 0
+
+    def __setstate__(self, state):
+        # Checkpoints saved before time sums were kept in microseconds have float time_sum and total_time
+        if 'time_sum' in state:
+            state['time_us'] = array('q', (round(t * US) for t in state.pop('time_sum')))
+        if 'total_time' in state:
+            state['total_us'] = round(state.pop('total_time') * US)
+        self.__dict__.update(state)
+
+    def __len__(self):
+        return len(self.urls)
+
+    @property
+    def time_sum(self):
+        return array('d', (us / US for us in self.time_us))
+
+    @property
+    def total_time(self):
+        return self.total_us / US
 
+    def url_id(self, url):
+        i = self.ids.get(url)
+        if i is None:
+            if self.max_urls is not None and len(self.urls) >= self.max_urls and url != OTHER_URL:
+                return self.url_id(OTHER_URL)
+            i = self.ids[url] = len(self.urls)
+            self.urls.append(url)
+            self.new_url()
+        return i
+
+    def new_url(self):
+        self.count.append(0)
+        self.time_us.append(0)
+        self.time_max.append(0.0)
+
+    def add(self, url, t, fields=None):
+        i, us = self.url_id(url), round(t * US)
+        self.count_total += 1
+        self.total_us += us
+        self.count[i] += 1
+        self.time_us[i] += us
+        self.durations.add(i, t)
+        if t > self.time_max[i]:
+            self.time_max[i] = t
+        if fields is not None:
+            self.dimensions.add(i, t, fields)
+
+    def merge(self, other):
+        self.count_total += other.count_total
+        self.total_us += other.total_us
+        id_map = array('l')
+        for j, url in enumerate(other.urls):
+            i = self.url_id(url)
+            id_map.append(i)
+            self.count[i] += other.count[j]
+            self.time_us[i] += other.time_us[j]
+            if other.time_max[j] > self.time_max[i]:
+                self.time_max[i] = other.time_max[j]
+        self.durations.merge(other.durations, id_map)
+        if self.dimensions is not None:
+            self.dimensions.merge(other.dimensions, id_map)
+        return self
+
+    def metric(self, name):
+        # Returns function url_id -> raw value of the metric
+        if name in ('count', 'time_max'):
+            return getattr(self, name).__getitem__
+        if name == 'time_sum':
+            return lambda i: self.time_us[i] / US
+        if name == 'time_avg':
+            return lambda i: self.time_us[i] / US / self.count[i]
+        q = dict(PERCENTILES)[name]
+        return lambda i: self.durations.quantiles(i, [q])[0]
+
+    def row(self, i):
+        time_sum = self.time_us[i] / US
+        row = {'count': self.count[i], 'time_max': self.time_max[i], 'time_sum': time_sum,
+               'url': self.urls[i], 'time_avg': time_sum / self.count[i],
+               'time_perc': self.time_us[i] / self.total_us, 'count_perc': self.count[i] / self.count_total}
+        for (name, _), value in zip(PERCENTILES, self.durations.quantiles(i, [q for _, q in PERCENTILES])):
+            row[name] = value
+        if self.dimensions is not None:
+            row.update(self.dimensions.row(i, row['count']))
+        return row
+
+    def top(self, size, metric):
+        # Heap based selection of top url ids by raw metric values, same order as sorted(..., reverse=True)[:size]
+        return heapq.nlargest(size, range(len(self)), key=self.metric(metric))
+
+
+class NumpyAggregates(Aggregates):
+    """
+    Vectorized aggregates. add() only interns URL and appends (url_id, request_time) to the columns of ExactQuantiles,
+    per-URL metrics are computed at once over these columns with NumPy: count and time_sum (of times rounded
+    to integer microseconds, like in Aggregates) by np.bincount,
+    time_max and percentiles from request times sorted by (url_id, time). Metrics are cached until new requests
+    are added. Report rows are the same as of Aggregates with exact quantiles.
+    """
+
+    def __init__(self, engine=ExactQuantiles, max_urls=None, dimensions=None):
+        if np is None:
+            raise Exception('numpy BACKEND requires NumPy, install it with: pip install numpy')
+        if engine is not ExactQuantiles:
+            raise Exception('numpy BACKEND supports only exact QUANTILES engine')
+        self.max_urls = max_urls
+        self.dimensions = None if dimensions is None else Dimensions(**dimensions)
+        self.ids = {}
+        self.urls = []
+        self.durations = ExactQuantiles()
+        self.count_total = 0
+        self.columns = None
+
+    def __getstate__(self):
+        # Cached metrics are not pickled into checkpoints, they are computed again
+        state = self.__dict__.copy()
+        state['columns'] = None
+        return state
+
+    def __setstate__(self, state):
+        state.pop('total_time', None)  # Checkpoints saved before the total was computed from the columns have it
+        self.__dict__.update(state)
+
+    def new_url(self):
+        pass
+
+    def add(self, url, t, fields=None):
+        i = self.url_id(url)
+        self.durations.add(i, t)
+        self.count_total += 1
+        if fields is not None:
+            self.dimensions.add(i, t, fields)
+
+    def merge(self, other):
+        self.count_total += other.count_total
+        id_map = np.array([self.url_id(url) for url in other.urls], dtype=self.durations.ids.typecode)
+        other_ids = np.frombuffer(other.durations.ids, dtype=self.durations.ids.typecode)
+        self.durations.extend(id_map[other_ids], other.durations.values)
+        if self.dimensions is not None:
+            self.dimensions.merge(other.dimensions, id_map.tolist())
+        return self
+
+    def compute(self):
+        size = len(self.durations.values)
+        if self.columns is not None and self.columns['size'] == size:
+            return self.columns
+        ids = np.frombuffer(self.durations.ids, dtype=self.durations.ids.typecode)
+        times = np.frombuffer(self.durations.values, dtype=np.float64)
+        count = np.bincount(ids, minlength=len(self))
+        time_us = np.bincount(ids, np.round(times * US), len(self))  # Sums of integers below 2 ** 53 are exact
+        grouped = times[np.lexsort((times, ids))]  # Request times sorted by url_id, then by time
+        starts = np.cumsum(count) - count
+        self.columns = {'size': size, 'count': count, 'time_us': time_us, 'time_sum': time_us / US,
+                        'total_us': int(time_us.sum()), 'time_max': grouped[starts + count - 1], 'grouped': grouped,
+                        'starts': starts}
+        return self.columns
+
+    @property
+    def count(self):
+        return self.compute()['count']
+
+    @property
+    def time_sum(self):
+        return self.compute()['time_sum']
+
+    @property
+    def total_us(self):
+        return self.compute()['total_us']
+
+    @property
+    def time_max(self):
+        return self.compute()['time_max']
+
+    def quantile(self, q):
+        # Column of q-quantiles of all URLs, interpolated in the same way as quantiles.interpolate
+        columns = self.compute()
+        if q not in columns:
+            grouped, starts, count = columns['grouped'], columns['starts'], columns['count']
+            pos = (count - 1) * q
+            lo = pos.astype(count.dtype)
+            hi = np.minimum(lo + 1, count - 1)
+            columns[q] = grouped[starts + lo] * (1 - (pos - lo)) + grouped[starts + hi] * (pos - lo)
+        return columns[q]
+
+    def metric_values(self, name):
+        if name in ('count', 'time_sum', 'time_max'):
+            return getattr(self, name)
+        if name == 'time_avg':
+            return self.time_sum / self.count
+        return self.quantile(dict(PERCENTILES)[name])
+
+    def metric(self, name):
+        return self.metric_values(name).__getitem__
+
+    def row(self, i):
+        columns = self.compute()
+        count, time_us = int(columns['count'][i]), int(columns['time_us'][i])
+        row = {'count': count, 'time_max': float(self.time_max[i]), 'time_sum': time_us / US,
+               'url': self.urls[i], 'time_avg': time_us / US / count,
+               'time_perc': time_us / self.total_us, 'count_perc': count / self.count_total}
+        for name, q in PERCENTILES:
+            row[name] = float(self.quantile(q)[i])
+        if self.dimensions is not None:
+            row.update(self.dimensions.row(i, row['count']))
+        return row
+
+    def top(self, size, metric):
+        # Stable sort keeps ties in the order of url ids, like heapq.nlargest does
+        return np.argsort(-self.metric_values(metric), kind='stable')[:size].tolist()
+
+
+BACKENDS = {'python': Aggregates, 'numpy': NumpyAggregates}
+
+
+shared_errors = None  # SharedErrors of worker processes of aggregate_parallel
+
+
+def init_worker(errors):
+    global shared_errors
+    shared_errors = errors
+
+
+def aggregate_range(log, start, end, engine=ExactQuantiles, parser=parse_lines, mmap_threshold=None, max_urls=None,
+                    backend=Aggregates, dimensions=None, err_level=None, error_check=None, part=0):
+    # error_check=(sample, every) enables early abort by ErrorBudget. In worker processes of aggregate_parallel
+    # the share of the whole log is checked, `part` is the number of the range then
+    stats = {'total': 0, 'unparsed': 0}
+    lines = read_range(log, start, end, mmap_threshold)
+    if error_check is not None:
+        lines = ErrorBudget(log, err_level, *error_check, shared=shared_errors, part=part).monitor(lines, stats)
+    data = aggregate(parser(lines, stats), engine, backend(engine, max_urls, dimensions))
+    return data, stats
+
+
+def aggregate(gen, engine=ExactQuantiles, data=None):
+    # Requests are (url, request_time) or, if data has dimensions, (url, request_time, fields)
+    data = Aggregates(engine) if data is None else data
+    if data.dimensions is None:
+        for url, t in gen:
+            data.add(url, t)
+    else:
+        for url, t, fields in gen:
+            data.add(url, t, fields)
+    return data
+
+
+def dimension_settings(data):
+    return None if data.dimensions is None else data.dimensions.settings
+
+
+def select_top(data, size, metric='count'):
+    # Top url ids by raw metric values, same order as sorted(..., reverse=True)[:size]
+    return data.top(size, metric)
+
+
+def summarize(data, ids=None):
+    return list(iter_rows(data, ids))
+
+
+def iter_rows(data, ids=None):
+    # Only rows with given ids are materialized into dicts, by default - all of them
+    for i in range(len(data)) if ids is None else ids:
+        v = data.row(i)
         for metric in v:
-            if metric in ['count_perc', 'time_perc']:
+            if metric in ['count_perc', 'time_perc', 'error_perc']:
                 v[metric] = '{:.1%}'.format(v[metric])
-            elif metric in ['time_avg', 'time_sum', 'time_med']:
+            elif metric in ['time_avg', 'time_sum', 'time_med', 'time_p90', 'time_p95', 'time_p99']:
                 v[metric] = round(v[metric], 3)
 
-        rows.append(v)
-    return rows
+        yield v
+
+
+def analyze(gen, engine=ExactQuantiles, backend=Aggregates):
+    return summarize(aggregate(gen, engine, backend(engine)))
+
+
+def aggregate_parallel(log, err_level, workers, engine=ExactQuantiles, parser=parse_lines, stats=None, data=None,
+                       mmap_threshold=None, error_check=None):
+    # Plain text log is split into newline aligned byte ranges which are parsed and aggregated in separate processes.
+    # Partial aggregates are merged in the order of ranges, so the result is the same as for aggregate(parse(log)).
+    # Ranges are aggregated without max_urls, URLs are capped by data on merge in the order they are first seen.
+    # With error_check budgets of all ranges share their counters, so ERROR_LEVEL applies to the whole log
+    stats = {'total': 0, 'unparsed': 0, 'offset': 0} if stats is None else stats
+    data = Aggregates(engine) if data is None else data
+    end, total, started = complete_size(log), stats['total'], time.perf_counter()
+    chunks = split_log(log, workers, stats['offset'], end)
+    errors = SharedErrors([end - start for start, end in chunks])
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(errors,)) as executor:
+        futures = [executor.submit(aggregate_range, log, start, end, engine, parser, mmap_threshold, None,
+                                   type(data), dimension_settings(data), err_level, error_check, part)
+                   for part, (start, end) in enumerate(chunks)]
+        try:
+            for future in futures:
+                chunk_data, chunk_stats = future.result()
+                data.merge(chunk_data)
+                stats['total'] += chunk_stats['total']
+                stats['unparsed'] += chunk_stats['unparsed']
+        except AbortedByOther:  # Error of the range which was aborted first describes failed lines
+            errors = [future.exception() for future in futures]
+            raise next(e for e in errors if e is not None and not isinstance(e, AbortedByOther))
+    stats['offset'] = max(end, stats['offset'])
+    log_throughput(log, stats['total'] - total, time.perf_counter() - started)
+    check_errors(log, stats, err_level)
+    return data
+
+
+def aggregate_log(log, err_level, engine=ExactQuantiles, parser=parse_lines, decompress='inline', mmap_threshold=None,
+                  max_urls=None, backend=Aggregates, error_check=None, dimensions=None):
+    stats = {'total': 0, 'unparsed': 0, 'offset': 0}
+    parsed_log = parse(log, err_level, parser, stats, decompress, mmap_threshold, error_check=error_check)
+    return aggregate(parsed_log, engine, backend(engine, max_urls, dimensions)), stats
+
+
+def aggregate_hosts(logs, err_level, workers=1, engine=ExactQuantiles, parser=parse_lines, decompress='inline',
+                    mmap_threshold=None, max_urls=None, backend=Aggregates, keep_hosts=False, error_check=None,
+                    dimensions=None):
+    # Logs of several hosts {host: path} are aggregated in up to `workers` processes and merged in the order of hosts.
+    # Returns (data, stats, {host: data}), aggregates of hosts are kept only if keep_hosts is set.
+    # Hosts are aggregated without max_urls, it is applied to the merged data only
+    args = (err_level, engine, parser, decompress, mmap_threshold, None, backend, error_check, dimensions)
+    stats, data, hosts = {'total': 0, 'unparsed': 0, 'offset': 0}, backend(engine, max_urls, dimensions), {}
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=min(workers, len(logs))) as executor:
+            futures = [executor.submit(aggregate_log, log, *args) for log in logs.values()]
+            results = [future.result() for future in futures]
+    else:
+        results = (aggregate_log(log, *args) for log in logs.values())
+    for host, (host_data, host_stats) in zip(logs, results):
+        data.merge(host_data)
+        stats['total'] += host_stats['total']
+        stats['unparsed'] += host_stats['unparsed']
+        if keep_hosts:
+            hosts[host] = host_data
+    return data, stats, hosts
+
+
+def iter_host_rows(rows, hosts):
+    # Adds count and time_sum of the URL on every host {host: data} to report rows
+    time_sums = {host: data.metric('time_sum') for host, data in hosts.items()}
+    for row in rows:
+        for host, data in hosts.items():
+            i = data.ids.get(row['url'])
+            row[f'count_{host}'] = 0 if i is None else int(data.count[i])
+            row[f'time_sum_{host}'] = 0.0 if i is None else round(float(time_sums[host](i)), 3)
+        yield row
+
+
+def merge_checkpoints(report_dir, date_from, date_to, engine=ExactQuantiles, backend=Aggregates, dimensions=None,
+                      max_values=None):
+    # Aggregates saved by daily runs are merged, so logs are not parsed again. Exact quantiles keep every request
+    # time of the range in memory, so if max_values is set, a range with more requests is refused by the headers
+    # of checkpoints before any aggregates are loaded
+    paths, day = [], datetime.strptime(date_from, '%Y%m%d')
+    while day <= datetime.strptime(date_to, '%Y%m%d'):
+        path = f'{report_dir}/report-{day:%Y%m%d}.checkpoint'
+        day += timedelta(days=1)
+        if os.path.isfile(path):
+            paths.append(path)
+        else:
+            logging.warning(f'Aggregates not found: {path}')
+    if engine is ExactQuantiles and max_values is not None:
+        check_range_size(paths, date_from, date_to, max_values)
+    data, days = backend(engine, None, dimensions), 0
+    for path in paths:
+        header, day_data = read_checkpoint(path)
+        if type(day_data) is not backend or not isinstance(day_data.durations, engine) \
+                or dimension_settings(day_data) != dimension_settings(data):
+            logging.warning(f'Aggregates in {path} were made with other BACKEND, QUANTILES engine or dimensions')
+            continue
+        data.merge(day_data)
+        days += 1
+    logging.info(f'Merged aggregates of {days} days from {date_from} to {date_to}')
+    return data, days
+
+
+def check_range_size(paths, date_from, date_to, max_values):
+    # Request times of checkpoints are counted by parsed lines in their headers
+    values = 0
+    for path in paths:
+        stats = read_checkpoint(path, header_only=True)['stats']
+        values += stats['total'] - stats['unparsed']
+    if values > max_values:
+        msg = f'Range {date_from}-{date_to} has {values} requests, exact QUANTILES would keep all their times ' \
+              f'in memory (~{values * 16 / 2 ** 20:.0f} MB), RANGE_MAX_VALUES is {max_values}. ' \
+              f'Use QUANTILES=tdigest for daily runs to build long range reports'
+        logging.error(msg)
+        raise Exception(msg)
+
+
+def analyze_parallel(log, err_level, workers, engine=ExactQuantiles, parser=parse_lines, mmap_threshold=None):
+    return summarize(aggregate_parallel(log, err_level, workers, engine, parser, mmap_threshold=mmap_threshold))
 
 
-def create_report(data, report_dir, date):
+def create_report(data, report_dir, date, compress=False):
+    # Rows are written one by one between template parts, so the whole JSON is never kept in memory.
+    # data may be any iterable of rows
     template, report = './report.html', f'{report_dir}/report-{date}.html'
     if not os.path.isfile(template):
         msg = 'report.html TEMPLATE not found. Report was not created'
         logging.error(msg)
         raise Exception(msg)
 
-    with open(template, 'r') as tmp, open(report, 'w') as report:
-        report.write(Template(tmp.read()).safe_substitute(table_json=json.dumps(data)))
+    with open(template, 'r') as tmp:
+        prefix, placeholder, suffix = tmp.read().partition('$table_json')
+    if not placeholder:
+        msg = 'report.html TEMPLATE has no $table_json placeholder. Report was not created'
+        logging.error(msg)
+        raise Exception(msg)
+
+    paths = [report] + ([f'{report}.gz'] if compress else [])
+    outputs = [open(f'{report}.tmp', 'w', encoding='utf8')]
+    if compress:
+        outputs.append(gzip.open(f'{report}.gz.tmp', 'wt', encoding='utf8', compresslevel=6))
+    try:
+        for part in stream_report(prefix, data, suffix):
+            for out in outputs:
+                out.write(part)
+    finally:
+        for out in outputs:
+            out.close()
+    for path in paths:
+        os.replace(f'{path}.tmp', path)
+
+
+def stream_report(prefix, rows, suffix):
+    yield prefix
+    yield '['
+    for n, row in enumerate(rows):
+        yield (', ' if n else '') + json.dumps(row)
+    yield ']'
+    yield suffix
+
+
+def export(data, config, date):
+    if config['EXPORT_DIR'] is not None:
+        directory = os.path.join(config['EXPORT_DIR'], date)
+        export_aggregates(data, directory, PERCENTILES, config['EXPORT_RAW'])
+        logging.info(f'Aggregates of {len(data)} URLs are exported to {directory}')
+
+
+class LogWatcher(object):
+    """
+    Follows the live log for watch mode. The file is kept open, so lines written to it after rotation (rename)
+    are still read. Rotation is detected by the change of inode, truncation - by the file getting smaller than
+    the offset. Every poll() adds new complete lines to aggregates. On rotation the report of the finished period
+    is written and aggregates are started again for the new file.
+    """
+
+    def __init__(self, path, config, engine=ExactQuantiles, backend=Aggregates, parser=parse_lines):
+        self.path = path
+        self.config = config
+        self.engine = engine
+        self.backend = backend
+        self.parser = parser
+        self.f, self.stats, self.data, self.date = None, None, None, None
+        self.reported = None  # Offset the report was written for
+
+    def start(self, resume=True):
+        # Aggregates of the current period are resumed from its checkpoint if it was saved for the same file
+        self.f = open(self.path, 'rb')
+        inode, self.date = os.fstat(self.f.fileno()).st_ino, datetime.now().strftime('%Y%m%d')
+        dimensions = get_dimensions(self.config)
+        resumed = load_checkpoint(self.path, self.date, self.config['REPORT_DIR'], self.engine, self.backend,
+                                  dimensions) if resume else None
+        if resumed is not None and resumed[0].get('inode') == inode:
+            self.stats, self.data = resumed
+        else:
+            self.stats = {'total': 0, 'unparsed': 0, 'offset': 0, 'inode': inode}
+            self.data = self.backend(self.engine, self.config['MAX_URLS'], dimensions)
+        self.reported = None
+        logging.info(f'Watching {self.path} from offset {self.stats["offset"]}, report date {self.date}')
+
+    def read(self):
+        self.f.seek(self.stats['offset'])
+        self.data = aggregate(self.parser(complete_lines(self.f, self.stats), self.stats), self.engine, self.data)
+
+    def poll(self):
+        # Returns True if the log was rotated
+        self.read()
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:  # Rotated, but the new log is not created yet
+            return False
+        if st.st_ino != self.stats['inode']:
+            self.read()  # Lines written to the old file before nginx reopened the log
+            logging.info(f'{self.path} was rotated')
+            self.report()
+            self.close()
+            self.start(resume=False)
+            return True
+        if st.st_size < self.stats['offset']:
+            logging.warning(f'{self.path} was truncated, reading from the start')
+            self.stats['offset'] = 0
+        return False
+
+    def report(self):
+        # Report is not written again if there are no new lines
+        if not self.stats['total'] or self.stats['offset'] == self.reported:
+            return
+        try:
+            check_errors(self.path, self.stats, self.config['ERROR_LEVEL'])
+        except Exception:  # Already logged, watching goes on
+            pass
+        ids = select_top(self.data, int(self.config['REPORT_SIZE']), self.config['SORT_BY'])
+        create_report(iter_rows(self.data, ids), self.config['REPORT_DIR'], self.date, self.config['REPORT_GZIP'])
+        save_summary(self.data, self.config['REPORT_DIR'], self.date)
+        export(self.data, self.config, self.date)
+        save_checkpoint(self.path, self.date, self.config['REPORT_DIR'], self.stats['offset'], self.stats, self.data)
+        self.reported = self.stats['offset']
+        logging.info(f'Report {self.date} is updated: {self.stats["total"]} lines, {len(self.data)} URLs')
+
+    def close(self):
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+
+
+def watch(config, engine=ExactQuantiles, backend=Aggregates, parser=parse_lines, poll_interval=1.0):
+    # New lines are read every poll_interval seconds, the report is written every WATCH_INTERVAL seconds,
+    # on rotation and on exit (SIGTERM or Ctrl+C)
+    path = config['WATCH_LOG'] or os.path.join(log_dirs(config)[0], 'nginx-access-ui.log')
+    while not os.path.isfile(path):
+        logging.info(f'Waiting for {path}')
+        time.sleep(config['WATCH_INTERVAL'])
+    watcher = LogWatcher(path, config, engine, backend, parser)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    watcher.start()
+    reported = time.monotonic()
+    try:
+        while True:
+            if watcher.poll():
+                reported = time.monotonic()
+            elif time.monotonic() - reported >= config['WATCH_INTERVAL']:
+                watcher.report()
+                reported = time.monotonic()
+            time.sleep(poll_interval)
+    except (KeyboardInterrupt, SystemExit):
+        logging.info('Watching is stopped')
+    finally:
+        watcher.report()
+        watcher.close()
+
+
+def get_error_check(config):
+    # (sample, every) for ErrorBudget or None if early abort is disabled
+    if config['ERROR_SAMPLE'] is None or config['ERROR_CHECK_EVERY'] is None:
+        return None
+    return config['ERROR_SAMPLE'], config['ERROR_CHECK_EVERY']
+
+
+def get_dimensions(config):
+    # Settings of additional aggregates for Dimensions or None if all of them are disabled
+    if config['LATENCY_BUCKETS'] is None and config['TIME_WINDOW'] is None and not config['TRAFFIC_STATS'] \
+            and config['TOP_AGENTS'] is None:
+        return None
+    return {'latency_buckets': config['LATENCY_BUCKETS'], 'time_window': config['TIME_WINDOW'],
+            'traffic': bool(config['TRAFFIC_STATS']), 'top_agents': config['TOP_AGENTS']}
+
+
+def save_summary(data, report_dir, date):
+    # Totals of the log over all URLs go to report-DATE.summary.json, if traffic stats or top agents are enabled
+    summary = {} if data.dimensions is None else data.dimensions.summary()
+    if not summary:
+        return
+    summary = {'requests': data.count_total, 'time_sum': round(data.total_time, 3), 'urls': len(data), **summary}
+    if 'statuses' in summary and data.count_total:
+        summary['error_perc'] = '{:.1%}'.format(summary['statuses']['5xx'] / data.count_total)
+    path = f'{report_dir}/report-{date}.summary.json'
+    with open(f'{path}.tmp', 'w', encoding='utf8') as f:
+        json.dump(summary, f, indent=2, ensure_ascii=False)
+    os.replace(f'{path}.tmp', path)
+
+
+def save_metrics(metrics, report_dir, date):
+    # Stage times and counters go to the app log and to report-DATE.metrics.json next to the report
+    metrics.save(f'{report_dir}/report-{date}.metrics.json', metrics.log_summary())
 
 
 def main(args):
@@ -154,22 +1252,105 @@ def main(args):
         sys.exit(f'Unable to get config. {e}')
 
     create_app_logger(config['APP_LOG'])
-    log, log_name, log_date = get_last_log(config['LOG_DIR'])
+    engine = QUANTILE_ENGINES[config['QUANTILES']]
+    backend = BACKENDS[config['BACKEND']]
+    dimensions = get_dimensions(config)
+    metrics = Metrics(config['PROGRESS_INTERVAL'])
+    if getattr(args, 'watch', False):
+        watch(config, engine, backend, get_parser(config))
+        return
 
-    if is_parsed(log_date, config['REPORT_DIR']):
-        logging.info(f'Log was already parsed and analyzed.')
-    else:
-        logging.info(f'Parsing {log}')
+    date_from = getattr(args, 'date_from', None)
+    if date_from is not None:
+        date_to = getattr(args, 'date_to', None) or date_from
         try:
-            parsed_log = parse(log, config['ERROR_LEVEL'])
+            with metrics.stage('merge'):
+                data, days = merge_checkpoints(config['REPORT_DIR'], date_from, date_to, engine, backend, dimensions,
+                                               config['RANGE_MAX_VALUES'])
         except Exception as e:
             sys.exit(e)
-        logging.info(f'Analysis is launched')
-        data = analyze(parsed_log)
+        if not days:
+            sys.exit(f'No daily aggregates found from {date_from} to {date_to}')
+        with metrics.stage('sort'):
+            ids = select_top(data, int(config['REPORT_SIZE']), config['SORT_BY'])
+        with metrics.stage('render'):
+            create_report(iter_rows(data, ids), config['REPORT_DIR'], f'{date_from}-{date_to}', config['REPORT_GZIP'])
+            save_summary(data, config['REPORT_DIR'], f'{date_from}-{date_to}')
+        with metrics.stage('export'):
+            export(data, config, f'{date_from}-{date_to}')
+        metrics.count('urls', len(data))
+        save_metrics(metrics, config['REPORT_DIR'], f'{date_from}-{date_to}')
+        return
+
+    dirs = log_dirs(config)
+    with metrics.stage('discovery'):
+        if len(dirs) == 1:
+            log, log_name, log_date = get_last_log(dirs[0])
+        else:  # Several hosts, log is {host: path}
+            logs = get_last_logs(dirs)
+            log, log_date = {host: data.path for host, data in logs.items()}, next(iter(logs.values())).date
+        parsed = is_parsed(log_date, config['REPORT_DIR'], log)
+
+    if parsed:
+        logging.info(f'Log was already parsed and analyzed.')
+    else:
+        logging.info(f'Parsing {log}')
+        workers = int(config['WORKERS'])
+        parser = get_parser(config)
+        log_size, hosts = log_signature(log)[1], {}
+        if isinstance(log, dict):  # Logs of several hosts are parsed from the start, each one in its own process
+            logging.info('Analysis is launched')
+            try:
+                with metrics.stage('aggregate'):
+                    data, stats, hosts = aggregate_hosts(log, config['ERROR_LEVEL'], workers, engine, parser,
+                                                         config['DECOMPRESS'], config['MMAP_THRESHOLD'],
+                                                         config['MAX_URLS'], backend, config['HOST_BREAKDOWN'],
+                                                         get_error_check(config), dimensions)
+            except Exception as e:
+                sys.exit(e)
+            total, unparsed = 0, 0
+            metrics.count('lines', stats['total'])
+        else:
+            with metrics.stage('resume'):
+                stats, data = load_checkpoint(log, log_date, config['REPORT_DIR'], engine, backend, dimensions) \
+                    or (None, None)
+            stats = {'total': 0, 'unparsed': 0, 'offset': 0} if stats is None else stats
+            data = backend(engine, config['MAX_URLS'], dimensions) if data is None else data
+            total, unparsed = stats['total'], stats['unparsed']
+            logging.info('Analysis is launched')
+            if workers > 1 and compression(log) is None:  # Compressed log can not be split into byte ranges
+                try:
+                    with metrics.stage('aggregate'):  # Reading and parsing in worker processes are included
+                        data = aggregate_parallel(log, config['ERROR_LEVEL'], workers, engine, parser, stats, data,
+                                                  config['MMAP_THRESHOLD'], get_error_check(config))
+                except Exception as e:
+                    sys.exit(e)
+                metrics.count('lines', stats['total'] - total)
+            else:
+                try:
+                    parsed_log = parse(log, config['ERROR_LEVEL'], parser, stats, config['DECOMPRESS'],
+                                       config['MMAP_THRESHOLD'], metrics, get_error_check(config))
+                except Exception as e:
+                    sys.exit(e)
+                with metrics.stage('aggregate', nested=('read', 'parse')):
+                    data = aggregate(parsed_log, engine, data)
         logging.info(f'Analysis is finished')
 
-        data = sorted(data, key=lambda x: x['count'], reverse=True)[0:int(config['REPORT_SIZE'])]  # If SIZE is str
-        create_report(data, config['REPORT_DIR'], log_date)
+        size = int(config['REPORT_SIZE'])  # If SIZE is str
+        with metrics.stage('sort'):
+            ids = select_top(data, size, config['SORT_BY'])
+        with metrics.stage('render'):
+            rows = iter_rows(data, ids)
+            create_report(iter_host_rows(rows, hosts) if hosts else rows, config['REPORT_DIR'], log_date,
+                          config['REPORT_GZIP'])
+            save_summary(data, config['REPORT_DIR'], log_date)
+        with metrics.stage('export'):
+            export(data, config, log_date)
+        with metrics.stage('checkpoint'):
+            save_checkpoint(log, log_date, config['REPORT_DIR'], log_size, stats, data)
+        metrics.count('urls', len(data))
+        metrics.count('unparsed', stats['unparsed'] - unparsed)
+        save_metrics(metrics, config['REPORT_DIR'], log_date)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+# Compiler of nginx log_format strings into extractors of the requested fields.
+import re
+
+UI_SHORT = ('$remote_addr  $remote_user $http_x_real_ip [$time_local] "$request" '
+            '$status $body_bytes_sent "$http_referer" '
+            '"$http_user_agent" "$http_x_forwarded_for" "$http_X_REQUEST_ID" "$http_X_RB_USER" '
+            '$request_time')
+
+# Parts of $request which can be requested as separate fields, like the same nginx variables
+REQUEST_PARTS = ('request_method', 'request_uri', 'server_protocol')
+VARIABLE = re.compile(r'\$(?:\{(\w+)\}|(\w+))')
+
+
+class LogFormat(object):
+    """
+    log_format is compiled once into an anchored bytes regex. Every variable becomes a "[^d]*" class,
+    where d is the next literal char of the format, so matching never backtracks. Only requested fields
+    are captured. Runs of spaces in the format match one or more spaces in the log.
+    Variables which follow each other without a literal between them ($host$request_uri) can not be split
+    by such classes, formats with them are rejected.
+    """
+
+    def __init__(self, log_format=UI_SHORT, fields=('request_uri', 'request_time')):
+        self.log_format = log_format
+        self.fields = tuple(fields)
+        self.pattern = self.compile(log_format, self.fields)
+
+    @staticmethod
+    def compile(log_format, fields):
+        tokens, pos = [], 0
+        for m in VARIABLE.finditer(log_format):
+            if m.start() > pos:
+                tokens.append((False, log_format[pos:m.start()]))
+            tokens.append((True, m.group(1) or m.group(2)))
+            pos = m.end()
+        if pos < len(log_format):
+            tokens.append((False, log_format[pos:]))
+
+        captured, regex = set(), []
+        for i, (is_var, value) in enumerate(tokens):
+            if not is_var:
+                regex.append(' +'.join(re.escape(part) for part in re.split(' +', value)))
+                continue
+            if i + 1 < len(tokens) and tokens[i + 1][0]:
+                raise ValueError(f'Variables ${value} and ${tokens[i + 1][1]} are not separated in log_format: '
+                                 f'{log_format}')
+            stop = tokens[i + 1][1][0] if i + 1 < len(tokens) else '\n'
+            any_value = '[^%s]*' % re.escape(stop)
+            if value == 'request' and set(REQUEST_PARTS) & set(fields):
+                part = '[^ %s]*' % re.escape(stop)
+                groups = []
+                for name in REQUEST_PARTS:
+                    groups.append(f'(?P<{name}>{part})' if name in fields and name not in captured else part)
+                    captured.add(name)
+                regex.append('%s %s(?: %s)?' % tuple(groups))
+            elif value in fields and value not in captured:
+                regex.append(f'(?P<{value}>{any_value})')
+                captured.add(value)
+            else:
+                regex.append(any_value)
+
+        missing = [f for f in fields if f not in captured]
+        if missing:
+            raise ValueError(f'Fields {", ".join(missing)} are not found in log_format: {log_format}')
+        return re.compile(''.join(regex).encode() + br'\r?$')
+
+    def extract(self, line):
+        # Returns bytes values of requested fields in the requested order or None if line does not match
+        m = self.pattern.match(line)
+        if m is None:
+            return None
+        return m.group(*self.fields) if len(self.fields) > 1 else (m.group(self.fields[0]),)
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+# Timing of log_analyzer stages and progress of log parsing.
+import os
+import json
+import logging
+from time import perf_counter
+from itertools import islice
+from contextlib import contextmanager
+
+
+class Metrics(object):
+    """
+    Wall time of analyzer stages and counters of the run. Stages which are run one after another are timed with
+    stage(), stages of the lazy read -> parse -> aggregate pipeline are timed with timed() around their iterators.
+    If progress_interval is set, progress of reading is logged every progress_interval seconds.
+    """
+
+    def __init__(self, progress_interval=None):
+        self.progress_interval = progress_interval
+        self.seconds = {}
+        self.counters = {}
+        self.started = perf_counter()
+
+    def add(self, stage, seconds):
+        self.seconds[stage] = self.seconds.get(stage, 0.0) + seconds
+
+    def count(self, name, value):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def nested_seconds(self, nested):
+        return sum(self.seconds.get(stage, 0.0) for stage in nested)
+
+    @contextmanager
+    def stage(self, name, nested=()):
+        # Time of nested stages recorded inside the block is not counted twice
+        before, started = self.nested_seconds(nested), perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, perf_counter() - started - (self.nested_seconds(nested) - before))
+
+    def timed(self, iterable, stage, every=64, nested=(), on_sample=None):
+        # Time spent in the iterator is measured on every `every`-th item only and scaled, so the overhead is
+        # a couple of clock calls per `every` items. Periods of nested timed iterators should be coprime,
+        # otherwise their samples coincide. on_sample(items, now) is called on every sample
+        it, stop, seconds, before, n = iter(iterable), object(), 0.0, self.nested_seconds(nested), 0
+        try:
+            while True:
+                yield from islice(it, every - 1)
+                started = perf_counter()
+                item = next(it, stop)
+                now = perf_counter()
+                seconds += (now - started) * every
+                if item is stop:
+                    break
+                n += every
+                if on_sample is not None:
+                    on_sample(n, now)
+                yield item
+        finally:
+            self.add(stage, max(seconds - (self.nested_seconds(nested) - before), 0.0))
+
+    def progress(self, position, size=None):
+        # Returns on_sample callback for timed() which logs lines processed, bytes read, rate and ETA
+        # every progress_interval seconds. position() returns bytes read from the log file or None if it is unknown
+        if self.progress_interval is None:
+            return None
+        start, started = position(), perf_counter()
+        reported = started
+
+        def report(lines, now):
+            nonlocal reported
+            if now - reported >= self.progress_interval:
+                reported = now
+                logging.info(self.progress_message(lines, now - started, start, position(), size))
+        return report
+
+    @staticmethod
+    def progress_message(lines, seconds, start, pos, size):
+        msg = f'Progress: {lines} lines, {lines / seconds:.0f} lines/sec'
+        if start is None or pos is None:
+            return msg
+        msg += f', {(pos - start) / 2 ** 20:.1f} MB read'
+        if size and pos > start:
+            msg += f', {pos / size:.1%} of {size / 2 ** 20:.1f} MB, ETA {seconds * (size - pos) / (pos - start):.0f}s'
+        return msg
+
+    def summary(self):
+        total = perf_counter() - self.started
+        summary = {'total_seconds': round(total, 3),
+                   'stages': {stage: round(seconds, 3) for stage, seconds in self.seconds.items()}}
+        summary.update(self.counters)
+        if 'lines' in self.counters and total:
+            summary['lines_per_sec'] = round(self.counters['lines'] / total)
+        if 'bytes_read' in self.counters and total:
+            summary['mb_per_sec'] = round(self.counters['bytes_read'] / total / 2 ** 20, 2)
+        return summary
+
+    def log_summary(self):
+        summary = self.summary()
+        total = summary['total_seconds'] or 1.0
+        logging.info('Stage times: ' + ', '.join(f'{stage} {seconds:.2f}s ({seconds / total:.0%})'
+                                                  for stage, seconds in summary['stages'].items()))
+        logging.info('Run metrics: ' + ', '.join(f'{k}={v}' for k, v in summary.items() if k != 'stages'))
+        return summary
+
+    def save(self, path, summary=None):
+        with open(f'{path}.tmp', 'w') as f:
+            json.dump(self.summary() if summary is None else summary, f, indent=2)
+        os.replace(f'{path}.tmp', path)
@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+# Quantile engines used by log_analyzer to get median and percentiles of $request_time per URL.
+# Every engine keeps values of all URLs by url_id and supports add(url_id, value), merge(other, id_map) and
+# quantiles(url_id, qs), so engines are interchangeable.
+import math
+from array import array
+from bisect import bisect_left
+
+
+def interpolate(values, qs):
+    # Linear interpolation between closest ranks of sorted values, q=0.5 gives the same value as statistics.median
+    if not values:
+        return [math.nan for _ in qs]
+    result = []
+    for q in qs:
+        pos = (len(values) - 1) * q
+        lo = int(pos)
+        hi = min(lo + 1, len(values) - 1)
+        result.append(values[lo] * (1 - (pos - lo)) + values[hi] * (pos - lo))
+    return result
+
+
+class ExactQuantiles(object):
+    """
+    Stores every (url_id, value) pair in two typed columns, 16 bytes per value on 64-bit platforms (8-byte ids
+    of array('l') and 8-byte doubles) and nothing per URL.
+    Values are grouped by url_id with a counting sort on the first quantiles() call. Result is exact.
+    """
+
+    def __init__(self):
+        self.ids = array('l')
+        self.values = array('d')
+        self.offsets, self.grouped = None, None
+
+    def add(self, i, value):
+        self.ids.append(i)
+        self.values.append(value)
+        self.offsets = None
+
+    def merge(self, other, id_map):
+        self.ids.extend(id_map[j] for j in other.ids)
+        self.values.extend(other.values)
+        self.offsets = None
+        return self
+
+    def extend(self, ids, values):
+        # Appends pairs given as two columns, ids and values may be any buffers with the layout of the own columns
+        self.ids.frombytes(memoryview(ids).cast('B'))
+        self.values.frombytes(memoryview(values).cast('B'))
+        self.offsets = None
+
+    def group(self):
+        offsets = array('l', [0]) * (max(self.ids, default=-1) + 2)
+        for i in self.ids:
+            offsets[i + 1] += 1
+        for i in range(1, len(offsets)):
+            offsets[i] += offsets[i - 1]
+        grouped, pos = array('d', bytes(8 * len(self.values))), array('l', offsets)
+        for i, value in zip(self.ids, self.values):
+            grouped[pos[i]] = value
+            pos[i] += 1
+        self.offsets, self.grouped = offsets, grouped
+
+    def quantiles(self, i, qs):
+        if self.offsets is None:
+            self.group()
+        if i + 1 >= len(self.offsets):
+            return interpolate([], qs)
+        return interpolate(sorted(self.grouped[self.offsets[i]:self.offsets[i + 1]]), qs)
+
+
+class TDigestQuantiles(object):
+    """Keeps a bounded size TDigest per url_id, so memory does not depend on the number of values."""
+
+    def __init__(self, compression=100):
+        self.compression = compression
+        self.digests = []
+
+    def digest(self, i):
+        while len(self.digests) <= i:
+            self.digests.append(TDigest(self.compression))
+        return self.digests[i]
+
+    def add(self, i, value):
+        self.digest(i).add(value)
+
+    def merge(self, other, id_map):
+        for j, digest in enumerate(other.digests):
+            self.digest(id_map[j]).merge(digest)
+        return self
+
+    def quantiles(self, i, qs):
+        if i >= len(self.digests):
+            return interpolate([], qs)
+        return self.digest(i).quantiles(qs)
+
+
+class TDigest(object):
+    """
+    Merging t-digest (T. Dunning, "Computing extremely accurate quantiles using t-digests").
+    Values are clustered into centroids (mean, weight), the number of centroids is bounded by ~compression,
+    so memory per URL does not depend on the number of requests.
+    Error is bounded in terms of rank and is the smallest near the tails: for compression=100 the rank of the
+    returned value differs from the requested one by less than ~1% for the median and ~0.1% for p99.
+    """
+    __slots__ = ('compression', 'buffer_size', 'means', 'weights', 'buffer', 'count', 'min', 'max')
+
+    def __init__(self, compression=100, buffer_size=None):
+        self.compression = compression
+        self.buffer_size = buffer_size or compression * 5
+        self.means, self.weights = [], []
+        self.buffer = []
+        self.count = 0
+        self.min, self.max = math.inf, -math.inf
+
+    def __len__(self):
+        return self.count
+
+    def add(self, value, weight=1):
+        self.buffer.append((value, weight))
+        self.count += weight
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+        if len(self.buffer) >= self.buffer_size:
+            self.compress()
+
+    def merge(self, other):
+        other.compress()
+        for mean, weight in zip(other.means, other.weights):
+            self.add(mean, weight)
+        self.min, self.max = min(self.min, other.min), max(self.max, other.max)
+        return self
+
+    def _k(self, q):
+        # k1 scale function, makes centroids small near q=0 and q=1
+        return self.compression / (2 * math.pi) * math.asin(2 * min(max(q, 0.0), 1.0) - 1)
+
+    def compress(self):
+        if not self.buffer:
+            return
+        points = sorted(list(zip(self.means, self.weights)) + self.buffer)
+        self.buffer = []
+        means, weights = [points[0][0]], [points[0][1]]
+        done, k_lo = 0, self._k(0)
+        for mean, weight in points[1:]:
+            if self._k((done + weights[-1] + weight) / self.count) - k_lo <= 1:
+                total = weights[-1] + weight
+                means[-1] += (mean - means[-1]) * weight / total
+                weights[-1] = total
+            else:
+                done += weights[-1]
+                k_lo = self._k(done / self.count)
+                means.append(mean)
+                weights.append(weight)
+        self.means, self.weights = means, weights
+
+    def quantiles(self, qs):
+        self.compress()
+        if not self.count:
+            return [math.nan for _ in qs]
+        # Centroid mean is placed at the middle of its rank range, min and max are placed at the ends
+        ranks, values, done = [0], [self.min], 0
+        for mean, weight in zip(self.means, self.weights):
+            ranks.append(done + weight / 2)
+            values.append(mean)
+            done += weight
+        ranks.append(self.count)
+        values.append(self.max)
+
+        result = []
+        for q in qs:
+            rank = q * self.count
+            i = min(max(bisect_left(ranks, rank), 1), len(ranks) - 1)
+            span = ranks[i] - ranks[i - 1]
+            frac = (rank - ranks[i - 1]) / span if span else 0.0
+            result.append(values[i - 1] + (values[i] - values[i - 1]) * frac)
+        return result
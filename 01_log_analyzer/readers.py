@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+# Readers of plain text, gzip and bz2 logs. Every reader is iterated by lines (bytes) and supports tell() and close().
+import io
+import os
+import bz2
+import gzip
+import mmap
+import queue
+import shutil
+import logging
+import threading
+import subprocess
+from functools import partial
+
+BLOCK_SIZE = 1 << 20
+DECOMPRESS_MODES = ('inline', 'thread', 'external')
+OPENERS = {'.gz': gzip.open, '.bz2': bz2.open}
+# External decompressors in order of preference, parallel ones go first
+COMMANDS = {'.gz': (('pigz', '-dc'), ('gzip', '-dc')),
+            '.bz2': (('lbzip2', '-dc'), ('pbzip2', '-dc'), ('bzip2', '-dc'))}
+
+
+def compression(log):
+    ext = os.path.splitext(log)[1]
+    return ext if ext in OPENERS else None
+
+
+class BlockReader(object):
+    """
+    Splits a stream of large decompressed blocks into lines. First `skip` bytes of the stream are dropped.
+    The last line is returned even if it has no trailing newline. tell() is exact when iteration is over.
+    source is the decompressing file object the blocks are read from, if any.
+    """
+
+    def __init__(self, blocks, skip=0, close=None, source=None):
+        self.blocks = blocks
+        self.skip = skip
+        self.position = 0
+        self.on_close = close
+        self.source = source
+
+    def __iter__(self):
+        tail = b''
+        for block in self.blocks:
+            self.position += len(block)
+            if self.skip:
+                dropped = min(self.skip, len(block))
+                block, self.skip = block[dropped:], self.skip - dropped
+            buf = io.BytesIO(tail + block if tail else block)
+            tail = b''
+            for line in buf:
+                if line.endswith(b'\n'):
+                    yield line
+                else:
+                    tail = line
+        if tail:
+            yield tail
+
+    def tell(self):
+        return self.position
+
+    def close(self):
+        if self.on_close is not None:
+            self.on_close()
+            self.on_close = None
+
+
+class MmapLines(object):
+    """
+    Plain text log (or its [start, end) range) mapped into memory. Lines are cut from the mapped buffer by blocks:
+    block end is moved to the last newline inside it, the block is copied out of the mapping once and split
+    into lines at once. There are no read() syscalls and no Python-level buffered reader, but every line is
+    still a new bytes object. tell() is exact when iteration is over.
+    """
+
+    def __init__(self, log, start=0, end=None, block_size=BLOCK_SIZE):
+        with open(log, 'rb') as f:  # Mapping stays valid after the file is closed
+            size = os.fstat(f.fileno()).st_size
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size else None
+        self.position = start
+        self.end = size if end is None else min(end, size)
+        self.block_size = block_size
+
+    def __iter__(self):
+        mm, end = self.mm, self.end
+        while self.position < end:
+            stop = mm.rfind(b'\n', self.position, min(self.position + self.block_size, end)) + 1
+            if not stop:  # Line is longer than block or it is the unfinished last line
+                stop = mm.find(b'\n', self.position, end) + 1 or end
+            block, self.position = mm[self.position:stop], stop
+            yield from io.BytesIO(block)
+
+    def tell(self):
+        return self.position
+
+    def close(self):
+        if self.mm is not None:
+            self.mm.close()
+            self.mm = None
+
+
+class ThreadedBlocks(object):
+    """
+    Reads blocks from a decompressing file object in a separate thread, zlib and bz2 release GIL meanwhile.
+    The thread is started on iteration, so the file is not read before that.
+    """
+
+    def __init__(self, f, block_size=BLOCK_SIZE, depth=8):
+        self.f = f
+        self.queue = queue.Queue(depth)
+        self.closed = False
+        self.thread = threading.Thread(target=self.run, args=(f, block_size), daemon=True)
+
+    def put(self, item):
+        while not self.closed:
+            try:
+                self.queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def run(self, f, block_size):
+        try:
+            while not self.closed:
+                block = f.read(block_size)
+                self.put(block)
+                if not block:
+                    break
+        except Exception as e:
+            self.put(e)
+        finally:
+            f.close()
+
+    def __iter__(self):
+        self.thread.start()
+        while True:
+            block = self.queue.get()
+            if isinstance(block, Exception):
+                raise block
+            if not block:
+                return
+            yield block
+
+    def close(self):
+        self.closed = True
+        if self.thread.ident is None:
+            self.f.close()
+        else:
+            self.thread.join()
+
+
+def find_command(ext):
+    for command in COMMANDS[ext]:
+        if shutil.which(command[0]):
+            return command
+    return None
+
+
+def external_blocks(proc, block_size=BLOCK_SIZE):
+    yield from iter(partial(proc.stdout.read, block_size), b'')
+    if proc.wait() != 0:
+        raise Exception(f'{proc.args[0]} exited with code {proc.returncode}: {proc.stderr.read().decode().strip()}')
+
+
+def stop_process(proc):
+    if proc.poll() is None:
+        proc.kill()
+    proc.wait()
+    proc.stdout.close()
+    proc.stderr.close()
+
+
+class RangeLines(object):
+    """Lines of a file object which start before end offset."""
+
+    def __init__(self, f, start, end):
+        self.f = f
+        self.position = start
+        self.end = end
+
+    def __iter__(self):
+        while self.position < self.end:
+            line = self.f.readline()
+            if not line:
+                break
+            self.position += len(line)
+            yield line
+
+    def tell(self):
+        return self.position
+
+    def close(self):
+        self.f.close()
+
+
+def open_range(log, start=0, end=None, mmap_threshold=None):
+    # Plain text logs not smaller than mmap_threshold are mapped into memory
+    if mmap_threshold is not None and os.path.getsize(log) >= mmap_threshold:
+        return MmapLines(log, start, end)
+    f = open(log, 'rb')
+    f.seek(start)
+    return f if end is None else RangeLines(f, start, end)
+
+
+def open_log(log, offset=0, mode='inline', mmap_threshold=None):
+    # Plain text logs are read directly or mapped into memory. Compressed logs are decompressed in the reading
+    # thread (inline), in a separate thread (thread) or by external pigz/gzip/bzip2 process (external)
+    ext = compression(log)
+    if ext is None:
+        return open_range(log, offset, None, mmap_threshold)
+
+    if mode == 'external':
+        command = find_command(ext)
+        if command is not None:
+            proc = subprocess.Popen(command + (log,), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            return BlockReader(external_blocks(proc), offset, partial(stop_process, proc))
+        logging.warning(f'No external decompressor found for {log}, using thread')
+        mode = 'thread'
+
+    f = OPENERS[ext](log, 'rb')
+    if mode == 'thread':
+        blocks = ThreadedBlocks(f)
+        return BlockReader(blocks, offset, blocks.close, f)
+    f.seek(offset)
+    return f
+
+
+def raw_position(f):
+    # Bytes read from the log file itself by a reader of open_log, for compressed logs - from the compressed file.
+    # Position is approximate because of read-ahead buffers. None if it is unknown
+    try:
+        if isinstance(f, BlockReader):
+            return None if f.source is None else raw_position(f.source)
+        if isinstance(f, gzip.GzipFile):
+            return f.fileobj.tell()
+        if isinstance(f, bz2.BZ2File):
+            return f._fp.tell()
+        return f.tell()
+    except (ValueError, AttributeError, OSError):  # File is already closed by a decompressing thread
+        return None
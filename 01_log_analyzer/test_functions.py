@@ -1,6 +1,20 @@
 import unittest
 import os
+import tempfile
+import gzip
+import bz2
+import json
+from string import Template
 import log_analyzer as la
+from log_format import LogFormat
+from export import export_aggregates, read_npy
+from benchmark import generate_log, bench_stages
+from metrics import Metrics
+from dimensions import TimestampParser, HeavyHitters
+from benchmark import AGENTS
+from collections import Counter
+from datetime import datetime
+from statistics import median
 from collections import namedtuple
 
 configs = './test_sources/configs'
@@ -27,12 +41,147 @@ class TestFunctions(unittest.TestCase):
         self.assertEqual(la.get_last_log(self.log_folder_2)[1], 'nginx-access-ui.log-20170611')
         self.assertRaises(Exception, la.get_last_log, self.log_folder_3)
 
+    def test_get_last_logs(self):
+        logs = la.get_last_logs([self.log_folder_1, self.log_folder_2, self.log_folder_3])
+        self.assertEqual(list(logs), ['log_folder_2'])
+        self.assertEqual(logs['log_folder_2'].name, 'nginx-access-ui.log-20170611')
+        self.assertRaises(Exception, la.get_last_logs, [self.log_folder_3])
+        self.assertEqual(la.host_names(['a/logs', 'b/logs/']), ['a/logs', 'b/logs'])
+
+    def test_aggregate_hosts(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            logs = {}
+            for host, src in (('front1', self.test_log_1), ('front2', self.test_log_5)):
+                os.mkdir(os.path.join(tmp, host))
+                logs[host] = os.path.join(tmp, host, 'nginx-access-ui.log-20170630')
+                with open(src, 'rb') as f, open(logs[host], 'wb') as dst:
+                    dst.write(f.read())
+            found = la.get_last_logs([os.path.dirname(log) for log in logs.values()])
+            self.assertEqual({host: log.path for host, log in found.items()}, logs)
+            expected = la.analyze(list(la.parse(self.test_log_1, self.err_level)) +
+                                  list(la.parse(self.test_log_5, self.err_level)))
+            for workers in (1, 2):
+                data, stats, hosts = la.aggregate_hosts(logs, self.err_level, workers, keep_hosts=True)
+                self.assertEqual(la.summarize(data), expected)
+                self.assertEqual(stats['total'], 20)
+                self.assertEqual(list(hosts), ['front1', 'front2'])
+            for row in la.iter_host_rows(la.iter_rows(data), hosts):
+                self.assertEqual(row['count_front1'] + row['count_front2'], row['count'])
+            self.assertEqual(la.aggregate_hosts(logs, self.err_level)[2], {})
+
     def test_parse(self):
         self.assertEqual(len(list(la.parse(self.test_log_1, self.err_level))), 10)
         self.assertRaises(Exception, la.parse, (self.test_log_2, self.err_level))
         self.assertRaises(Exception, la.parse, (self.test_log_3, self.err_level))
         self.assertRaises(Exception, la.parse, (self.test_log_4, self.err_level))
 
+    def test_parse_fast(self):
+        for log in (self.test_log_1, self.test_log_5):
+            self.assertEqual(list(la.parse(log, self.err_level, la.parse_lines_fast)),
+                             list(la.parse(log, self.err_level)))
+        for log in (self.test_log_2, self.test_log_3, self.test_log_4):
+            with self.assertRaises(Exception):
+                list(la.parse(log, self.err_level, la.parse_lines_fast))
+
+    def test_parse_format(self):
+        for log in (self.test_log_1, self.test_log_5):
+            self.assertEqual(list(la.parse(log, self.err_level, la.parse_lines_format)),
+                             list(la.parse(log, self.err_level)))
+        for log in (self.test_log_2, self.test_log_3, self.test_log_4):
+            with self.assertRaises(Exception):
+                list(la.parse(log, self.err_level, la.parse_lines_format))
+
+    def test_log_format(self):
+        log_format = LogFormat('$remote_addr [$time_local] "$request" $status $request_time', ('status', 'request_uri'))
+        self.assertEqual(log_format.extract(b'1.1.1.1 [29/Jun/2017:03:50:22 +0300] "GET /api/1 HTTP/1.1" 200 0.1\n'),
+                         (b'200', b'/api/1'))
+        self.assertIsNone(log_format.extract(b'1.1.1.1 "GET /api/1 HTTP/1.1" 200 0.1\n'))
+        self.assertRaises(ValueError, LogFormat, '$remote_addr $status', ('request_time',))
+        self.assertRaises(ValueError, LogFormat, '$scheme://$host$request_uri $request_time', ('request_uri',))
+        self.assertRaises(ValueError, LogFormat, '${host}$request_uri $request_time', ('request_time',))
+        log_format = LogFormat('$scheme://${host}/$uri $request_time', ('host', 'uri'))
+        self.assertEqual(log_format.extract(b'https://example.org/api/v2/banner/1 0.1'),
+                         (b'example.org', b'api/v2/banner/1'))
+
+    def test_decompress(self):
+        with open(self.test_log_5, 'rb') as f:
+            content = f.read()
+        expected = list(la.parse(self.test_log_5, self.err_level))
+        with tempfile.TemporaryDirectory() as tmp:
+            for ext, module in (('.gz', gzip), ('.bz2', bz2)):
+                log = os.path.join(tmp, f'nginx-access-ui.log-20170630{ext}')
+                with module.open(log, 'wb') as f:
+                    f.write(content)
+                for mode in la.DECOMPRESS_MODES:
+                    stats = {'total': 0, 'unparsed': 0, 'offset': 0}
+                    self.assertEqual(list(la.parse(log, self.err_level, stats=stats, decompress=mode)), expected)
+                    self.assertEqual(stats['offset'], len(content))
+                    stats['offset'] = len(content.split(b'\n', 3)[0]) + 1
+                    self.assertEqual(len(list(la.parse(log, self.err_level, stats=stats, decompress=mode))), 9)
+
+    def test_metrics(self):
+        rows = la.analyze(la.parse(self.test_log_5, self.err_level))
+        with tempfile.TemporaryDirectory() as tmp:
+            log = os.path.join(tmp, 'nginx-access-ui.log-20170630.gz')
+            with open(self.test_log_5, 'rb') as src, gzip.open(log, 'wb') as dst:
+                dst.write(src.read())
+            for mode in la.DECOMPRESS_MODES:
+                metrics = Metrics(progress_interval=0)
+                with metrics.stage('aggregate', nested=('read', 'parse')):
+                    data = la.aggregate(la.parse(log, self.err_level, decompress=mode, metrics=metrics))
+                self.assertEqual(la.summarize(data), rows)
+                summary = metrics.summary()
+                self.assertEqual(list(summary['stages']), ['read', 'parse', 'aggregate'])
+                self.assertEqual(summary['lines'], 10)
+                if mode != 'external':
+                    self.assertEqual(summary['bytes_read'], os.path.getsize(log))
+            metrics.save(os.path.join(tmp, 'metrics.json'))
+            with open(os.path.join(tmp, 'metrics.json')) as f:
+                self.assertEqual(json.load(f)['lines'], 10)
+        self.assertIn('Progress: 128 lines', Metrics.progress_message(128, 1.0, 0, 50, 100))
+        self.assertIn('50.0% of', Metrics.progress_message(128, 1.0, 0, 50, 100))
+
+    def test_mmap(self):
+        expected = list(la.parse(self.test_log_5, self.err_level))
+        self.assertEqual(list(la.parse(self.test_log_5, self.err_level, mmap_threshold=0)), expected)
+        lines = [line for start, end in la.split_log(self.test_log_5, 3)
+                 for line in la.read_range(self.test_log_5, start, end, mmap_threshold=0)]
+        with open(self.test_log_5, 'rb') as f:
+            self.assertEqual(lines, f.readlines())
+        self.assertEqual(la.analyze_parallel(self.test_log_5, self.err_level, 3, mmap_threshold=0),
+                         la.analyze(la.parse(self.test_log_5, self.err_level)))
+        self.assertEqual(list(la.parse(self.test_log_4, 1.1, mmap_threshold=0)), [])  # Empty file can not be mapped
+
+    def test_url_normalizer(self):
+        normalizer = la.UrlNormalizer(strip_query=True, collapse_ids=True, rules=[['^/export/.*', '/export/*']])
+        self.assertEqual(normalizer('/api/v2/banner/25019354'), '/api/v2/banner/{id}')
+        self.assertEqual(normalizer('/api/v2/group/7786679/statistic/?date_type=day'), '/api/v2/group/{id}/statistic/')
+        self.assertEqual(normalizer('/api/v2/user/2a828197ae235b0b3cb/info'), '/api/v2/user/{hex}/info')
+        self.assertEqual(normalizer('/api/v2/slot/groups'), '/api/v2/slot/groups')
+        self.assertEqual(normalizer('/export/appinstall_raw/2017-06-29/'), '/export/*')
+        self.assertEqual(la.UrlNormalizer(collapse_ids=True)('/api/1/list/?id=25'), '/api/{id}/list/?id=25')
+
+    def test_max_urls(self):
+        data = la.aggregate(la.parse(self.test_log_1, self.err_level), data=la.Aggregates(max_urls=3))
+        self.assertEqual(len(data), 4)
+        self.assertEqual(data.urls[-1], la.OTHER_URL)
+        self.assertEqual(sum(data.count), 10)
+
+    def test_max_urls_parallel(self):
+        line = ('1.196.116.32 -  - [29/Jun/2017:03:50:22 +0300] "GET {} HTTP/1.1" 200 927 "-" "Lynx/2.8.8dev.9" "-" '
+                '"1498697422-2190034393-4708-9752759" "dc7161be3" 0.5\n')
+        urls = ['/a'] * 20 + ['/b'] * 20 + ['/c'] * 10 + ['/d'] * 10 + ['/a'] * 20
+        with tempfile.TemporaryDirectory() as tmp:
+            log = os.path.join(tmp, 'nginx-access-ui.log-20170630')
+            with open(log, 'w') as f:
+                f.writelines(line.format(url) for url in urls)
+            serial = la.aggregate(la.parse(log, self.err_level), data=la.Aggregates(max_urls=2))
+            parallel = la.aggregate_parallel(log, self.err_level, 2, data=la.Aggregates(max_urls=2))
+            self.assertEqual(dict(zip(parallel.urls, parallel.count)), {'/a': 40, '/b': 20, la.OTHER_URL: 20})
+            self.assertEqual(la.summarize(parallel), la.summarize(serial))
+            data, _, _ = la.aggregate_hosts({'front1': log, 'front2': log}, self.err_level, 2, max_urls=2)
+            self.assertEqual(dict(zip(data.urls, data.count)), {'/a': 80, '/b': 40, la.OTHER_URL: 40})
+
     def test_analyze(self):
         data_1 = la.analyze(la.parse(self.test_log_5, self.err_level))
         self.assertEqual(data_1[0]['time_max'], 0.5)
@@ -41,6 +190,328 @@ class TestFunctions(unittest.TestCase):
         self.assertEqual(data_1[0]['time_med'], 0.3)
         self.assertEqual(data_1[0]['time_perc'], '50.0%')
 
+    def test_analyze_tdigest(self):
+        data_1 = la.analyze(la.parse(self.test_log_5, self.err_level), la.TDigestQuantiles)
+        self.assertEqual(data_1[0]['count'], 5)
+        self.assertEqual(data_1[0]['time_med'], 0.3)
+        self.assertEqual(data_1[0]['time_p99'], 0.5)
+
+    def test_quantiles(self):
+        values = [i / 1000 for i in range(1, 10001)]
+        exact, digest = la.ExactQuantiles(), la.TDigestQuantiles()
+        for v in values:
+            exact.add(1, v)
+            digest.add(1, v)
+        self.assertEqual(exact.quantiles(1, [0.5]), [median(values)])
+        for e, d in zip(exact.quantiles(1, [0.5, 0.9, 0.99]), digest.quantiles(1, [0.5, 0.9, 0.99])):
+            self.assertAlmostEqual(e, d, delta=0.1)  # 1% of rank
+
+    def test_aggregates(self):
+        data_1 = la.aggregate(la.parse(self.test_log_1, self.err_level))
+        data_2 = la.aggregate(la.parse(self.test_log_5, self.err_level))
+        merged = la.aggregate(list(la.parse(self.test_log_1, self.err_level)) +
+                              list(la.parse(self.test_log_5, self.err_level)))
+        data_1.merge(data_2)
+        self.assertEqual(la.summarize(data_1), la.summarize(merged))
+
+    def test_select_top(self):
+        data = la.aggregate(la.parse(self.test_log_5, self.err_level))
+        rows = la.analyze(la.parse(self.test_log_5, self.err_level))
+        for metric in la.SORT_METRICS:
+            top = la.summarize(data, la.select_top(data, 2, metric))
+            self.assertEqual(top, sorted(rows, key=lambda x: data.metric(metric)(data.ids[x['url']]), reverse=True)[:2])
+        self.assertEqual(la.summarize(data, la.select_top(data, 1))[0]['count'], 5)
+
+    @unittest.skipUnless(la.np is not None, 'NumPy is not installed')
+    def test_numpy_backend(self):
+        data = la.aggregate(la.parse(self.test_log_1, self.err_level))
+        vectorized = la.aggregate(la.parse(self.test_log_1, self.err_level), data=la.NumpyAggregates())
+        self.assertEqual(la.summarize(vectorized), la.summarize(data))
+        for metric in la.SORT_METRICS:
+            self.assertEqual(la.select_top(vectorized, 3, metric), la.select_top(data, 3, metric))
+        data.merge(la.aggregate(la.parse(self.test_log_5, self.err_level)))
+        vectorized.merge(la.aggregate(la.parse(self.test_log_5, self.err_level), data=la.NumpyAggregates()))
+        self.assertEqual(la.summarize(vectorized), la.summarize(data))
+        self.assertEqual(la.analyze_parallel(self.test_log_5, self.err_level, 3),
+                         la.analyze(la.parse(self.test_log_5, self.err_level), backend=la.NumpyAggregates))
+
+    def test_split_log(self):
+        chunks = la.split_log(self.test_log_5, 3)
+        self.assertEqual(chunks[0][0], 0)
+        self.assertEqual(chunks[-1][1], os.path.getsize(self.test_log_5))
+        lines = [line for start, end in chunks for line in la.read_range(self.test_log_5, start, end)]
+        with open(self.test_log_5, 'rb') as f:
+            self.assertEqual(lines, f.readlines())
+
+    def test_analyze_parallel(self):
+        data_1 = la.analyze(la.parse(self.test_log_5, self.err_level))
+        data_2 = la.analyze_parallel(self.test_log_5, self.err_level, 3)
+        self.assertEqual(data_1, data_2)
+        self.assertRaises(Exception, la.analyze_parallel, self.test_log_2, self.err_level, 3)
+
+    def test_parallel_equals_serial(self):
+        dimensions = {'latency_buckets': None, 'time_window': 60, 'traffic': False, 'top_agents': None}
+        parser = la.partial(la.parse_lines, detailed=True, fields=la.detail_fields(**dimensions))
+        with tempfile.TemporaryDirectory() as tmp:
+            log, full = os.path.join(tmp, 'nginx-access-ui.log-20170630'), os.path.join(tmp, 'full.log')
+            generate_log(full, 100000, urls=300)
+            serial = la.aggregate(la.parse(full, 1.0, parser), data=la.Aggregates(dimensions=dimensions))
+            data = la.aggregate_parallel(full, 1.0, 3, parser=parser, data=la.Aggregates(dimensions=dimensions))
+            self.assertEqual(la.summarize(data), la.summarize(serial))
+            self.assertEqual(data.total_time, serial.total_time)
+
+            with open(full, 'rb') as f:
+                lines = f.readlines()
+            with open(log, 'wb') as f:  # Log is resumed from the first third
+                f.writelines(lines[:30000])
+            stats = {'total': 0, 'unparsed': 0, 'offset': 0}
+            data = la.aggregate(la.parse(log, 1.0, parser, stats), data=la.Aggregates(dimensions=dimensions))
+            with open(log, 'ab') as f:
+                f.writelines(lines[30000:])
+            data = la.aggregate_parallel(log, 1.0, 3, parser=parser, stats=stats, data=data)
+            self.assertEqual(la.summarize(data), la.summarize(serial))
+
+    def test_resume(self):
+        with open(self.test_log_5, 'rb') as f:
+            lines = f.readlines()
+        with tempfile.TemporaryDirectory() as tmp:
+            log = os.path.join(tmp, 'nginx-access-ui.log-20170630')
+            with open(log, 'wb') as f:
+                f.writelines(lines[:6])
+                f.write(lines[6][:20])  # Line is still being written
+            stats = {'total': 0, 'unparsed': 0, 'offset': 0}
+            data = la.aggregate(la.parse(log, self.err_level, stats=stats))
+            self.assertEqual(stats, {'total': 6, 'unparsed': 0, 'offset': sum(map(len, lines[:6]))})
+            la.save_checkpoint(log, '20170630', tmp, os.path.getsize(log), stats, data)
+            with open(log, 'wb') as f:
+                f.writelines(lines)
+
+            stats, data = la.load_checkpoint(log, '20170630', tmp)
+            data = la.aggregate(la.parse(log, self.err_level, stats=stats), data=data)
+            self.assertEqual(stats['total'], 10)
+            self.assertEqual(la.summarize(data), la.analyze(la.parse(self.test_log_5, self.err_level)))
+            stats, data = la.load_checkpoint(log, '20170630', tmp)
+            data = la.aggregate_parallel(log, self.err_level, 2, stats=stats, data=data)
+            self.assertEqual(stats['total'], 10)
+            self.assertEqual(la.summarize(data), la.analyze(la.parse(self.test_log_5, self.err_level)))
+
+            with open(log, 'wb') as f:  # Log was rotated
+                f.writelines(lines[:2])
+            self.assertIsNone(la.load_checkpoint(log, '20170630', tmp))
+
+    def test_merge_checkpoints(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            for date, log in (('20170630', self.test_log_1), ('20170702', self.test_log_5)):
+                stats = {'total': 0, 'unparsed': 0, 'offset': 0}
+                data = la.aggregate(la.parse(log, self.err_level, stats=stats))
+                la.save_checkpoint(log, date, tmp, os.path.getsize(log), stats, data)
+            data, days = la.merge_checkpoints(tmp, '20170629', '20170705')
+            self.assertEqual(days, 2)
+            expected = la.aggregate(list(la.parse(self.test_log_1, self.err_level)) +
+                                    list(la.parse(self.test_log_5, self.err_level)))
+            self.assertEqual(la.summarize(data), la.summarize(expected))
+            self.assertEqual(la.merge_checkpoints(tmp, '20170701', '20170701')[1], 0)
+            self.assertEqual(la.merge_checkpoints(tmp, '20170629', '20170705', max_values=20)[1], 2)
+            with self.assertRaisesRegex(Exception, 'has 20 requests.*QUANTILES=tdigest'):
+                la.merge_checkpoints(tmp, '20170629', '20170705', max_values=19)
+            self.assertEqual(la.merge_checkpoints(tmp, '20170630', '20170630', max_values=19)[1], 1)
+
+    def test_watch(self):
+        with open(self.test_log_5, 'rb') as f:
+            lines = f.readlines()
+        with tempfile.TemporaryDirectory() as tmp:
+            config = la.read_config(self.test_args)
+            config['REPORT_DIR'] = tmp
+            live = os.path.join(tmp, 'nginx-access-ui.log')
+            with open(live, 'wb') as f:
+                f.writelines(lines[:4])
+                f.write(lines[4][:20])  # Unfinished line
+            watcher = la.LogWatcher(live, config)
+            watcher.start()
+            self.assertFalse(watcher.poll())
+            self.assertEqual(watcher.stats['total'], 4)
+            with open(live, 'ab') as f:
+                f.write(lines[4][20:])
+                f.writelines(lines[5:8])
+            self.assertFalse(watcher.poll())
+            self.assertEqual(watcher.stats['total'], 8)
+
+            os.rename(live, f'{live}-20170630')
+            with open(f'{live}-20170630', 'ab') as f:  # Written before nginx reopened the log
+                f.writelines(lines[8:])
+            with open(live, 'wb') as f:
+                f.writelines(lines[:3])
+            date = watcher.date
+            self.assertTrue(watcher.poll())
+            with open(os.path.join(tmp, f'report-{date}.html')) as f:
+                self.assertIn('"count": 5', f.read())
+            self.assertEqual(watcher.stats['total'], 0)
+            watcher.poll()
+            self.assertEqual(watcher.stats['total'], 3)
+            watcher.report()
+            watcher.close()
+
+            resumed = la.LogWatcher(live, config)
+            resumed.start()
+            self.assertEqual(resumed.stats['offset'], sum(map(len, lines[:3])))
+            self.assertEqual(len(resumed.data), len(watcher.data))
+            resumed.close()
+
+    def test_create_report(self):
+        rows = la.analyze(la.parse(self.test_log_5, self.err_level))
+        with open('./report.html') as f:
+            expected = Template(f.read()).safe_substitute(table_json=json.dumps(rows))
+        with tempfile.TemporaryDirectory() as tmp:
+            la.create_report(iter(rows), tmp, '20170630', compress=True)
+            with open(os.path.join(tmp, 'report-20170630.html')) as f:
+                self.assertEqual(f.read(), expected)
+            with gzip.open(os.path.join(tmp, 'report-20170630.html.gz'), 'rt') as f:
+                self.assertEqual(f.read(), expected)
+            self.assertEqual(sorted(os.listdir(tmp)), ['report-20170630.html', 'report-20170630.html.gz'])
+
+    def test_export(self):
+        data = la.aggregate(la.parse(self.test_log_5, self.err_level))
+        rows = la.summarize(data)
+        with tempfile.TemporaryDirectory() as tmp:
+            export_aggregates(data, tmp, la.PERCENTILES, raw=True)
+            with open(os.path.join(tmp, 'urls.txt')) as f:
+                self.assertEqual(f.read().splitlines(), [row['url'] for row in rows])
+            self.assertEqual(list(read_npy(os.path.join(tmp, 'count.npy'))), [row['count'] for row in rows])
+            self.assertEqual([round(v, 3) for v in read_npy(os.path.join(tmp, 'time_med.npy'))],
+                             [row['time_med'] for row in rows])
+            self.assertEqual(len(read_npy(os.path.join(tmp, 'url_id.npy'))), 10)
+            self.assertEqual(read_npy(os.path.join(tmp, 'request_time.npy')), data.durations.values)
+            with open(os.path.join(tmp, 'count.npy'), 'rb') as f:
+                self.assertEqual(f.read().index(b'\n') + 1, 128)  # Header is aligned
+
+    def test_generate_log(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            log = os.path.join(tmp, 'nginx-access-ui.log-20170630.gz')
+            generate_log(log, 1000, urls=20, error_rate=0.1)
+            stats = {'total': 0, 'unparsed': 0, 'offset': 0}
+            data = la.aggregate(la.parse(log, 1.0, stats=stats))
+            self.assertEqual(stats['total'], 1000)
+            self.assertAlmostEqual(stats['unparsed'] / stats['total'], 0.1, delta=0.03)
+            self.assertLessEqual(len(data), 20)
+            for parser in ('fast', 'format'):
+                self.assertEqual(la.summarize(la.aggregate(la.parse(log, 1.0, la.PARSERS[parser]))), la.summarize(data))
+            results = bench_stages(log, memory=False)
+            self.assertEqual(results['lines'], 1000)
+            for stage in ('read', 'parse', 'aggregate', 'report'):
+                self.assertGreater(results[stage]['lines_per_sec'], 0)
+
+    def test_error_budget(self):
+        self.assertEqual(la.wilson_lower_bound(0, 1000), 0.0)
+        self.assertLess(la.wilson_lower_bound(300, 1000), 0.3)
+        self.assertGreater(la.wilson_lower_bound(300, 1000), 0.2)
+        with tempfile.TemporaryDirectory() as tmp:
+            log = os.path.join(tmp, 'nginx-access-ui.log-20170630')
+            generate_log(log, 20000, urls=20, error_rate=0.5)
+            stats = {'total': 0, 'unparsed': 0, 'offset': 0}
+            with self.assertRaisesRegex(Exception, 'aborted after 1000 lines.*"\\*" 9 9 '):
+                la.aggregate(la.parse(log, 0.2, stats=stats, error_check=(1000, 1000)))
+            self.assertEqual(stats['total'], 1000)
+
+            generate_log(log, 20000, urls=20, error_rate=0.1)
+            stats = {'total': 0, 'unparsed': 0, 'offset': 0}
+            la.aggregate(la.parse(log, 0.2, stats=stats, error_check=(1000, 1000)))
+            self.assertEqual(stats['total'], 20000)
+            stats = {'total': 0, 'unparsed': 0, 'offset': 0}
+            la.aggregate_parallel(log, 0.2, 2, stats=stats, error_check=(1000, 1000))
+            self.assertEqual(stats['total'], 20000)
+
+            bad = os.path.join(tmp, 'bad.log')  # Only the second part of the log is broken
+            generate_log(bad, 20000, urls=20, error_rate=0.5)
+            with open(log, 'ab') as f, open(bad, 'rb') as src:
+                f.write(src.read())
+            with self.assertRaisesRegex(Exception, 'aborted after \\d+ lines.*"\\*" 9 9 '):
+                la.aggregate_parallel(log, 0.2, 2, error_check=(1000, 1000))
+
+            generate_log(log, 30000, urls=20)  # 12.5% of lines are broken, all of them in the last quarter
+            generate_log(bad, 10000, urls=20, error_rate=0.5)
+            with open(log, 'ab') as f, open(bad, 'rb') as src:
+                f.write(src.read())
+            serial = {'total': 0, 'unparsed': 0, 'offset': 0}
+            la.aggregate(la.parse(log, 0.2, stats=serial, error_check=(1000, 1000)))
+            stats = {'total': 0, 'unparsed': 0, 'offset': 0}
+            la.aggregate_parallel(log, 0.2, 4, stats=stats, error_check=(1000, 1000))
+            self.assertEqual(stats, serial)
+
+    def test_dimensions(self):
+        parse_time = TimestampParser()
+        for value in ('29/Jun/2017:03:50:22 +0300', '29/Jun/2017:03:50:59 +0300', '01/Dec/2016:23:59:01 -0130'):
+            self.assertEqual(parse_time(value), datetime.strptime(value, '%d/%b/%Y:%H:%M:%S %z').timestamp())
+        self.assertEqual(len(parse_time.cache), 2)
+
+        dimensions = {'latency_buckets': [0.1, 0.5, 1], 'time_window': 300, 'traffic': True, 'top_agents': 3}
+        with tempfile.TemporaryDirectory() as tmp:
+            log = os.path.join(tmp, 'nginx-access-ui.log-20170630')
+            generate_log(log, 30000, urls=20, error_rate=0.01)
+            parsers = [la.partial(parser, detailed=True) for parser in (la.parse_lines, la.parse_lines_fast)]
+            parsers.append(la.partial(la.parse_lines_format, log_format=LogFormat(fields=la.format_fields(True)),
+                                      detailed=True))
+            expected = la.aggregate(la.parse(log, 1.0, parsers[0]), data=la.Aggregates(dimensions=dimensions))
+            rows = la.summarize(expected)
+            for parser in parsers[1:]:
+                data = la.aggregate(la.parse(log, 1.0, parser), data=la.Aggregates(dimensions=dimensions))
+                self.assertEqual(la.summarize(data), rows)
+            data = la.aggregate_parallel(log, 1.0, 2, parser=parsers[0], data=la.Aggregates(dimensions=dimensions))
+            self.assertEqual(la.summarize(data), rows)
+            for row in rows:
+                self.assertEqual(list(row['time_hist']), ['0.1', '0.5', '1', '+Inf'])
+                self.assertEqual(sum(row['time_hist'].values()), row['count'])
+                self.assertEqual(sum(count for _, count, _ in row['time_windows']), row['count'])
+                self.assertEqual(sum(row[f'status_{c}xx'] for c in range(1, 6)), row['count'])
+                self.assertGreater(row['bytes_sum'], row['count'] * 10)
+            summary = expected.dimensions.summary()
+            self.assertEqual(sum(summary['statuses'].values()), expected.count_total)
+            self.assertEqual(summary['bytes_sum'], sum(row['bytes_sum'] for row in rows))
+            self.assertEqual(len(summary['top_agents']), 3)
+            self.assertTrue(all(agent in AGENTS for agent, _ in summary['top_agents']))
+            la.save_summary(expected, tmp, '20170630')
+            with open(os.path.join(tmp, 'report-20170630.summary.json')) as f:
+                self.assertEqual(json.load(f)['requests'], expected.count_total)
+            # 100 lines per second from 29/Jun/2017:03:50:22 +0300 till 03:55:21 fall into two windows
+            starts = sorted({start for row in rows for start, _, _ in row['time_windows']})
+            self.assertEqual(starts, [1498697400, 1498697700])
+            plain = la.summarize(la.aggregate(la.parse(log, 1.0)))
+            self.assertEqual(plain, [{k: row[k] for k in plain[0]} for row in rows])
+
+    def test_detail_fields(self):
+        config = la.read_config(self.test_args)
+        config['LOG_FORMAT'] = '$remote_addr $remote_user $http_x_real_ip [$time_local] "$request" $request_time'
+        line = b'1.196.116.32 -  - [29/Jun/2017:03:50:22 +0300] "GET /api/1 HTTP/1.1" 0.5\n'  # No $status and others
+        for parser in la.PARSERS:
+            config.update(PARSER=parser, LATENCY_BUCKETS=[0.1], TIME_WINDOW=None, TRAFFIC_STATS=False)
+            self.assertEqual(list(la.get_parser(config)([line], {'total': 0, 'unparsed': 0})), [('/api/1', 0.5, ())])
+            config['TIME_WINDOW'] = 60
+            self.assertEqual(list(la.get_parser(config)([line], {'total': 0, 'unparsed': 0})),
+                             [('/api/1', 0.5, ('29/Jun/2017:03:50:22 +0300',))])
+            config['TRAFFIC_STATS'] = True
+            if parser == 'format':
+                self.assertRaises(ValueError, la.get_parser, config)
+            else:
+                stats = {'total': 0, 'unparsed': 0}
+                self.assertEqual(list(la.get_parser(config)([line], stats)), [])
+                self.assertEqual(stats['unparsed'], 1)
+
+    def test_heavy_hitters(self):
+        keys = [f'k{i % 7}' if i % 3 else f'rare{i}' for i in range(3000)]
+        exact = Counter(keys)
+        sketch, parts = HeavyHitters(20), [HeavyHitters(20), HeavyHitters(20)]
+        for n, key in enumerate(keys):
+            sketch.add(key)
+            parts[n % 2].add(key)
+        merged = parts[0].merge(parts[1])
+        self.assertLessEqual(sketch.error(), 3000 // 21)
+        for summary in (sketch, merged):
+            self.assertEqual(summary.total, 3000)
+            self.assertLessEqual(len(summary.counters), 20)
+            self.assertEqual({key for key, _ in summary.top(7)}, {f'k{i}' for i in range(7)})
+            for key, count in summary.counters.items():
+                self.assertLessEqual(exact[key] - summary.error(), count)
+                self.assertLessEqual(count, exact[key])
+
     def test_read_configs(self):
         config_default = la.read_config(self.test_args)
         config_default_expected = {
@@ -48,7 +519,33 @@ class TestFunctions(unittest.TestCase):
             'REPORT_DIR': './reports',
             'LOG_DIR': '/var/log/nginx',
             'APP_LOG': './app.log',
-            'ERROR_LEVEL': 0.2}
+            'ERROR_LEVEL': 0.2,
+            'WORKERS': 1,
+            'QUANTILES': 'exact',
+            'SORT_BY': 'count',
+            'PARSER': 'default',
+            'LOG_FORMAT': None,
+            'DECOMPRESS': 'inline',
+            'MMAP_THRESHOLD': 64 * 1024 * 1024,
+            'URL_STRIP_QUERY': False,
+            'URL_COLLAPSE_IDS': False,
+            'URL_RULES': [],
+            'MAX_URLS': None,
+            'REPORT_GZIP': False,
+            'EXPORT_DIR': None,
+            'EXPORT_RAW': False,
+            'BACKEND': 'python',
+            'PROGRESS_INTERVAL': 10,
+            'HOST_BREAKDOWN': False,
+            'WATCH_LOG': None,
+            'WATCH_INTERVAL': 60,
+            'ERROR_SAMPLE': 1000,
+            'ERROR_CHECK_EVERY': 100000,
+            'LATENCY_BUCKETS': None,
+            'TIME_WINDOW': None,
+            'TRAFFIC_STATS': False,
+            'TOP_AGENTS': None,
+            'RANGE_MAX_VALUES': 50000000}
         self.assertEqual(config_default, config_default_expected)
 
 
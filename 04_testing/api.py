@@ -1,8 +1,14 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import os
+import sys
 import abc
 import json
+import socket
+import signal
+import threading
+import Queue
 import datetime
 import logging
 import hashlib
@@ -23,13 +29,18 @@ FORBIDDEN = 403
 NOT_FOUND = 404
 INVALID_REQUEST = 422
 INTERNAL_ERROR = 500
+SERVICE_UNAVAILABLE = 503
 ERRORS = {
     BAD_REQUEST: "Bad Request",
     FORBIDDEN: "Forbidden",
     NOT_FOUND: "Not Found",
     INVALID_REQUEST: "Invalid Request",
     INTERNAL_ERROR: "Internal Server Error",
+    SERVICE_UNAVAILABLE: "Service Unavailable",
 }
+SERVER_MODES = ('single', 'thread', 'fork')
+REJECTED_RESPONSE = ('HTTP/1.0 503 Service Unavailable\r\nContent-Type: application/json\r\nContent-Length: %d\r\n'
+                     'Connection: close\r\n\r\n%s')
 UNKNOWN = 0
 MALE = 1
 FEMALE = 2
@@ -40,7 +51,16 @@ GENDERS = {
 }
 
 
+NOT_SET = object()  # Field methods check the value given to the constructor if no value is passed
+LETTERS_ONLY_FIELDS = ('first_name', 'last_name')
+NOT_LETTERS = re.compile(u'[@_!#$%^&*()<>?/|}{~:;.,+=№\]\[0123456789]')  # Searched in unicode text
+
+
 class Field(object):
+    """
+    Declaration of a request field. Field instances are shared by all requests of the class, so values
+    of requests are passed to validate(value) and are never stored in the field.
+    """
     def __init__(self, required, nullable=False, value=None, name=None):
         self.required = required
         self.nullable = nullable
@@ -53,25 +73,34 @@ class Field(object):
     def __repr__(self):
         return str(self.value)
 
-    def check_requirements(self):
-        if self.required and self.value is None:
-            msg = 'Value for field \'%s\' is required, received \'%s\' instead ' % (self.name, self.value)
+    def get_value(self, value):
+        return self.value if value is NOT_SET else value
+
+    def check_requirements(self, value=NOT_SET):
+        value = self.get_value(value)
+        if self.required and value is None:
+            msg = 'Value for field \'%s\' is required, received \'%s\' instead ' % (self.name, value)
             raise ValidationError(msg)
-        elif not self.nullable and not isinstance(self.value, (int, float)) and self.value is not None and len(self.value) == 0:
-            msg = 'Value for field \'%s\' can not be empty, received \'%s\' instead ' % (self.name, self.value)
+        elif not self.nullable and not isinstance(value, (int, float)) and value is not None and len(value) == 0:
+            msg = 'Value for field \'%s\' can not be empty, received \'%s\' instead ' % (self.name, value)
             raise ValidationError(msg)
 
     @abc.abstractmethod
-    def check_type(self):
+    def check_type(self, value=NOT_SET):
         raise NotImplementedError('check_type function is not defined for %s' % self.__class__.__name__)
 
-    def validate(self):
-        self.check_requirements()
-        self.check_type()
+    def validate(self, value=NOT_SET):
+        value = self.get_value(value)
+        self.check_requirements(value)
+        self.check_type(value)
+
+    @staticmethod
+    def empty(value):
+        return not isinstance(value, (int, float)) and (value is None or len(value) == 0)
 
     @property
     def is_empty(self):
-        return not isinstance(self.value, (int, float)) and (self.value is None or len(self.value) == 0)
+        return self.empty(self.value)
 
     @property
     def is_none(self):
@@ -79,68 +108,74 @@ class Field(object):
 
 
 class CharField(Field):
-    def check_type(self):
-        accepted = (str, int, float)
-        if self.name in ('first_name', 'last_name'):
-            regex = re.compile('[@_!#$%^&*()<>?/|}{~:;.,+=№\]\[0123456789]')
-            if regex.search(str(self.value)):
+    def check_type(self, value=NOT_SET):
+        value = self.get_value(value)
+        accepted = (basestring, int, float)  # Strings of JSON requests are unicode, of fields made in code - str
+        if self.name in LETTERS_ONLY_FIELDS:
+            text = value.decode('utf-8', 'replace') if isinstance(value, str) else unicode(value)
+            if NOT_LETTERS.search(text):
                 msg = 'Value for field \'%s\' should contain only letters' % self.name
                 raise ValidationError(msg)
-            accepted = (str,)
-        if not isinstance(self.value, accepted) and self.value is not None:
+            accepted = (basestring,)
+        if not isinstance(value, accepted) and value is not None:
             msg = 'Value for field \'%s\' has wrong type' % self.name
             raise ValidationError(msg)
 
 
 class ArgumentsField(Field):
-    def check_type(self):
+    def check_type(self, value=NOT_SET):
+        value = self.get_value(value)
         accepted = (dict, list, tuple)
-        if not isinstance(self.value, accepted) and self.value is not None:
+        if not isinstance(value, accepted) and value is not None:
             msg = 'Value for field \'%s\' can must be dict or array-like, received \'%s\' instead ' % (self.name,
-                                                                                                       self.value)
+                                                                                                       value)
             raise ValidationError(msg)
 
 
 class EmailField(CharField):
-    def validate(self):
-        if not self.is_empty and '@' not in str(self.value):
+    def validate(self, value=NOT_SET):
+        value = self.get_value(value)
+        if not self.empty(value) and '@' not in str(value):
             msg = 'Value for field \'%s\' must be an email string, received \'%s\' instead' % (
-                self.name, self.value)
+                self.name, value)
             raise ValidationError(msg)
 
 
 
 class PhoneField(CharField):
-    def validate(self):
+    def validate(self, value=NOT_SET):
+        value = self.get_value(value)
         l, c = 11, '7'
         msg = '''Value for field \'%s\' must be an %s symbols long starting with %s, received \'%s\' instead''' \
-              % (self.name, l, c, self.value)
-        if not self.is_empty and not self.is_none:
-            if len(str(self.value)) != l or str(self.value)[0] != c and '.' not in str(self.value):
+              % (self.name, l, c, value)
+        if not self.empty(value) and value is not None:
+            if len(str(value)) != l or str(value)[0] != c and '.' not in str(value):
                 raise ValidationError(msg)
             try:
-                int(self.value)
+                int(value)
             except Exception:
                 raise ValidationError(msg)
 
 
 class DateField(CharField):
-    def validate(self):
-        if not self.is_empty:
+    def validate(self, value=NOT_SET):
+        value = self.get_value(value)
+        if not self.empty(value):
             try:
-                datetime.datetime.strptime(self.value, '%d.%m.%Y')
+                datetime.datetime.strptime(value, '%d.%m.%Y')
             except:
                 msg = 'Value for field \'%s\' must be in format dd.mm.yyyy, received \'%s\' instead' % (
-                    self.name, self.value)
+                    self.name, value)
                 raise ValidationError(msg)
 
 
 class BirthDayField(DateField):
-    def validate(self):
+    def validate(self, value=NOT_SET):
+        value = self.get_value(value)
         age_limit = 70
-        if not self.is_empty:
-            super(BirthDayField, self).validate()  # Check if date in expected format
-            birth_date, today_date = self.value, datetime.datetime.today().strftime('%d.%m.%Y')
+        if not self.empty(value):
+            super(BirthDayField, self).validate(value)  # Check if date in expected format
+            birth_date, today_date = value, datetime.datetime.today().strftime('%d.%m.%Y')
             bday, bmonth, byear = map(int, birth_date.split('.'))
             day, month, year = map(int, today_date.split('.'))
             msg = 'Your age must be equal or below %s' % age_limit
@@ -163,53 +198,71 @@ class BirthDayField(DateField):
                         raise ValidationError(msg2)
 
 class GenderField(CharField):
-    def validate(self):
+    def validate(self, value=NOT_SET):
+        value = self.get_value(value)
         accepted = (0, 1, 2, '', None)
-        if self.value not in accepted:
+        if value not in accepted:
             msg = '''Value for field \'%s\' must be one of (%s), received %s instead''' \
-                  % (self.name, ', '.join([str(i) for i in accepted]), self.value)
+                  % (self.name, ', '.join([str(i) for i in accepted]), value)
             raise ValidationError(msg)
 
 
 class ClientIDsField(ArgumentsField):
-    def validate(self):
-        if self.is_empty:
+    def validate(self, value=NOT_SET):
+        value = self.get_value(value)
+        if self.empty(value):
             raise ValidationError('Value for field \'%s\'can not be empty.' % self.name)
-        elif not isinstance(self.value, list):
+        elif not isinstance(value, list):
             raise ValidationError('Value for field \'%s\' must be an array' % self.name)
-        for i in self.value:
+        for i in value:
             if not isinstance(i, int):
                 raise ValidationError('Array for field \'%s\'can must contain only integers' % self.name)
 
 
+class RequestMeta(type):
+    """
+    Collects Field declarations of the request class and its bases once, when the class is created.
+    Declarations are moved into cls.fields {name: Field} and their names become __slots__,
+    so every request keeps its own values and shared fields are never modified.
+    """
+    def __new__(mcs, name, bases, attrs):
+        fields = {}
+        for base in reversed(bases):
+            fields.update(getattr(base, 'fields', {}))
+        own = [k for k, v in attrs.items() if isinstance(v, Field)]
+        for k in own:
+            fields[k] = attrs.pop(k)
+            fields[k].name = fields[k].name or k
+        attrs['fields'] = fields
+        attrs['__slots__'] = tuple(own) + tuple(attrs.get('__slots__', ()))
+        return super(RequestMeta, mcs).__new__(mcs, name, bases, attrs)
+
+
 class Request(object):
+    __metaclass__ = RequestMeta
+    __slots__ = ('request', 'errors')
+
     def __init__(self, request):
-        self.available_fields = {'first_name', 'last_name', 'phone', 'email', 'birthday', 'gender', 'account',
-                                 'token', 'arguments', 'method', 'client_ids', 'date', 'login'}
         self.request = request
         self.errors = []
-        self.fields = self.get_class_fields()
+        for k in self.fields:
+            setattr(self, k, None)
 
     def read_arguments(self, arguments):
-        for k, v in self.fields.items():
+        for k, field in self.fields.items():
             try:
-                self.fields[k].value = arguments[k]
-                setattr(self, k, arguments[k])
+                value = arguments[k]
             except KeyError:
-                self.fields[k].value = None
-                setattr(self, k, None)
+                value = None
+            setattr(self, k, value)
             try:
-                self.fields[k].validate()
+                field.validate(value)
             except ValidationError as e:
                 self.errors.append(e.message)
 
-    def get_class_fields(self):
-        fields = {}
-        for attr_name in dir(self):
-            value = getattr(self, attr_name, None)
-            if isinstance(value, Field):
-                fields[attr_name] = value
-        return fields
+    @classmethod
+    def get_class_fields(cls):
+        return cls.fields
 
     def is_valid(self):
         return len(self.errors) == 0
@@ -224,13 +277,10 @@ class ClientsInterestsRequest(Request):
     date = DateField(required=False, nullable=True, name='date')
 
     def store_available(self, store):
-        try:
-            return store.echo(1)
-        except:
-            return 0
+        return store.is_available()
 
     def get_interests(self, store):
-        return {c: scoring.get_interests(store, c) for c in self.client_ids}
+        return scoring.get_interests_many(store, self.client_ids)
 
     def nclients(self):
         return {'nclients': len(self.request['client_ids'])}
@@ -291,6 +341,10 @@ class MethodRequest(Request):
         return True
 
 
+SCORING_REQUESTS = {'online_score': OnlineScoreRequest,
+                    'clients_interests': ClientsInterestsRequest}
+
+
 def check_auth(request):
     if request.is_admin:
         digest = hashlib.sha512(datetime.datetime.now().strftime("%Y%m%d%H") + ADMIN_SALT).hexdigest()
@@ -311,46 +365,69 @@ def online_scoring_handler(sr, ctx, store, is_admin=False):
 def clients_interests_handler(sr, ctx, store):
     ctx.update(sr.nclients())
     if sr.store_available(store):
-        return sr.get_interests(store), OK
+        interests = sr.get_interests(store)
+        if interests is not None:
+            return interests, OK
     return 'Store is not available', INTERNAL_ERROR
 
 
-def scoring_handler(request, ctx, store):
+def read_scoring_request(request):
+    # Returns the request of the scoring method and whether it is valid
     method, arguments = request.request['method'], request.request['arguments']
-    actions = {'online_score': OnlineScoreRequest,
-               'clients_interests': ClientsInterestsRequest}
-    sr = actions[method](arguments)
+    sr = SCORING_REQUESTS[method](arguments)
     sr.read_arguments(arguments)
     if sr.is_valid() and not sr.is_empty:
-        if method == 'online_score':
-            return online_scoring_handler(sr, ctx, store, is_admin=request.is_admin)
-        elif method == 'clients_interests':
-            return clients_interests_handler(sr, ctx, store)
-
+        return sr, True
     logging.error('%s - %s' % (INVALID_REQUEST, sr.errors))
-    return sr.errors, INVALID_REQUEST
+    return sr, False
 
 
-def method_handler(request, ctx, store):
-    response, code = None, None
-    arguments = request['body']
+def scoring_handler(request, ctx, store):
+    sr, valid = read_scoring_request(request)
+    if not valid:
+        return sr.errors, INVALID_REQUEST
+    if request.request['method'] == 'online_score':
+        return online_scoring_handler(sr, ctx, store, is_admin=request.is_admin)
+    return clients_interests_handler(sr, ctx, store)
+
+
+def read_method_request(arguments):
+    # Returns the method request and the error code if it is invalid or not authorized, None otherwise
     mr = MethodRequest(arguments)
     mr.read_arguments(arguments)
-    if mr.is_empty:
-        response, code = mr.errors, INVALID_REQUEST
-        logging.error('%s - %s' % (code, response))
-    elif not mr.is_valid():
-        response, code = mr.errors, INVALID_REQUEST
-        logging.error('%s - %s' % (code, response))
+    if mr.is_empty or not mr.is_valid():
+        code = INVALID_REQUEST
     elif not mr.is_token_valid():
-        response, code = mr.errors, FORBIDDEN
-        logging.error('%s - %s' % (code, response))
+        code = FORBIDDEN
     else:
-        response, code = scoring_handler(mr, ctx, store)
-        logging.info('%s - %s' % (code, response))
+        return mr, None
+    logging.error('%s - %s' % (code, mr.errors))
+    return mr, code
+
+
+def method_handler(request, ctx, store):
+    mr, code = read_method_request(request['body'])
+    if code is not None:
+        return mr.errors, code
+    response, code = scoring_handler(mr, ctx, store)
+    logging.info('%s - %s' % (code, response))
     return response, code
 
 
+def read_body(data_string):
+    # Returns the decoded request body and the error code if it is not JSON
+    try:
+        return json.loads(data_string), OK
+    except:
+        return None, BAD_REQUEST
+
+
+def make_response(response, code):
+    if code not in ERRORS:
+        return {"response": response, "code": code}
+    return {"error": response or ERRORS.get(code, "Unknown Error"), "code": code}
+
+
 class MainHTTPHandler(BaseHTTPRequestHandler):
     router = {
         "method": method_handler
@@ -371,7 +448,7 @@ class MainHTTPHandler(BaseHTTPRequestHandler):
         request = None
         try:
             data_string = self.rfile.read(int(self.headers['Content-Length']))
-            request = json.loads(data_string)
+            request, code = read_body(data_string)
         except:
             code = BAD_REQUEST
 
@@ -391,27 +468,121 @@ class MainHTTPHandler(BaseHTTPRequestHandler):
         self.send_response(code)
         self.send_header("Content-Type", "application/json")
         self.end_headers()
-        if code not in ERRORS:
-            r = {"response": response, "code": code}
-        else:
-            r = {"error": response or ERRORS.get(code, "Unknown Error"), "code": code}
+        r = make_response(response, code)
         context.update(r)
         logging.info(context)
         self.wfile.write(json.dumps(r))
         return
 
 
+class PooledHTTPServer(HTTPServer):
+    """
+    Handles requests in a fixed pool of threads, so a slow store call blocks one thread instead of the whole server.
+    At most max_inflight requests are accepted and not finished yet (handled or waiting for a thread),
+    the rest are answered with 503 at once, so the queue can not grow without limit.
+    """
+    def __init__(self, server_address, handler, threads=8, max_inflight=64, bind_and_activate=True):
+        HTTPServer.__init__(self, server_address, handler, bind_and_activate)
+        self.threads = threads
+        self.max_inflight = max_inflight
+        self.inflight = threading.BoundedSemaphore(max_inflight)
+        self.requests = Queue.Queue()
+        self.workers = []
+
+    def start_workers(self):
+        # Threads are started in the serving process, they would not survive fork
+        while len(self.workers) < self.threads:
+            worker = threading.Thread(target=self.work)
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def serve_forever(self, poll_interval=0.5):
+        self.start_workers()
+        HTTPServer.serve_forever(self, poll_interval)
+
+    def process_request(self, request, client_address):
+        if not self.inflight.acquire(False):
+            self.reject(request, client_address)
+            return
+        self.requests.put((request, client_address))
+
+    def work(self):
+        while True:
+            request, client_address = self.requests.get()
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+                self.inflight.release()
+
+    def reject(self, request, client_address):
+        logging.warning('%s requests are in flight, request of %s is rejected' % (self.max_inflight, client_address[0]))
+        body = json.dumps({"error": ERRORS[SERVICE_UNAVAILABLE], "code": SERVICE_UNAVAILABLE})
+        try:
+            request.sendall(REJECTED_RESPONSE % (len(body), body))
+        except socket.error:
+            pass
+        self.shutdown_request(request)
+
+
+def make_server(server_address, handler, mode='single', threads=8, max_inflight=64):
+    if mode == 'single':
+        return HTTPServer(server_address, handler)
+    return PooledHTTPServer(server_address, handler, threads, max_inflight)
+
+
+def serve_forked(server, workers):
+    # Pre-forked workers accept connections from the shared listening socket, each one with its own thread pool.
+    # The socket is non-blocking, so workers which lost the race for a connection return to select
+    server.socket.setblocking(False)
+    children = []
+    for _ in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            try:
+                server.serve_forever()
+            finally:
+                os._exit(0)
+        children.append(pid)
+    logging.info("Started %s workers: %s" % (workers, ', '.join(str(pid) for pid in children)))
+    try:
+        for pid in children:
+            os.waitpid(pid, 0)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:  # Already exited
+                pass
+
+
 if __name__ == "__main__":
     op = OptionParser()
     op.add_option("-p", "--port", action="store", type=int, default=8080)
     op.add_option("-l", "--log", action="store", default=None)
+    op.add_option("-m", "--mode", action="store", type="choice", choices=SERVER_MODES, default="single",
+                  help="single: one request at a time, thread: pool of threads, fork: pre-forked workers with pools")
+    op.add_option("-w", "--workers", action="store", type=int, default=4, help="Processes in fork mode")
+    op.add_option("-t", "--threads", action="store", type=int, default=8, help="Threads of every process")
+    op.add_option("--max-inflight", action="store", type=int, default=64,
+                  help="Requests accepted by a process at once, the rest get 503")
     (opts, args) = op.parse_args()
     logging.basicConfig(filename=opts.log, level=logging.INFO,
                         format='[%(asctime)s] %(levelname).1s %(message)s', datefmt='%Y.%m.%d %H:%M:%S')
-    server = HTTPServer(("localhost", opts.port), MainHTTPHandler)
-    logging.info("Starting server at %s" % opts.port)
+    server = make_server(("localhost", opts.port), MainHTTPHandler, opts.mode, opts.threads, opts.max_inflight)
+    logging.info("Starting server at %s in %s mode" % (opts.port, opts.mode))
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
     try:
-        server.serve_forever()
-    except KeyboardInterrupt:
+        if opts.mode == 'fork':
+            serve_forked(server, opts.workers)
+        else:
+            server.serve_forever()
+    except (KeyboardInterrupt, SystemExit):
         pass
     server.server_close()
@@ -0,0 +1,231 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Scoring API served by one process on the event loop of async_store. Requests are validated by api.py,
+# store calls are non-blocking, so a slow Redis delays only requests waiting for it and keep-alive
+# connections cost a socket each instead of a thread.
+import uuid
+import json
+import socket
+import asyncore
+import asynchat
+import logging
+import mimetools
+from StringIO import StringIO
+from optparse import OptionParser
+from BaseHTTPServer import BaseHTTPRequestHandler
+import api
+import scoring
+from async_store import AsyncStore, Loop, Task, Return, coroutine
+
+NOT_IMPLEMENTED = 501
+MAX_HEADERS_SIZE = 65536
+
+
+@coroutine
+def get_score(store, phone, email, birthday=None, gender=None, first_name=None, last_name=None):
+    key = scoring.get_score_key(phone, birthday, first_name, last_name)
+    score = (yield store.cache_get(key)) or 0
+    if score:
+        raise Return(float(score))
+    score = scoring.calculate_score(phone, email, birthday, gender, first_name, last_name)
+    yield store.cache_set(key, score, 60 * 60)
+    raise Return(score)
+
+
+@coroutine
+def get_interests(store, client_ids):
+    # Like scoring.get_interests_many, keys of all clients are requested at once by MGET
+    cids, keys = scoring.interests_keys(client_ids)
+    values = yield store.get_many(keys)
+    raise Return(scoring.decode_interests_many(cids, values))
+
+
+@coroutine
+def online_scoring_handler(sr, ctx, store, is_admin=False):
+    ctx.update(sr.has)
+    if is_admin:
+        raise Return(({'score': 42}, api.OK))
+    score = yield get_score(store, sr.phone, sr.email, birthday=sr.birthday, gender=sr.gender,
+                            first_name=sr.first_name, last_name=sr.last_name)
+    raise Return(({'score': score}, api.OK))
+
+
+@coroutine
+def clients_interests_handler(sr, ctx, store):
+    ctx.update(sr.nclients())
+    if (yield store.is_available()):
+        interests = yield get_interests(store, sr.client_ids)
+        if interests is not None:
+            raise Return((interests, api.OK))
+    raise Return(('Store is not available', api.INTERNAL_ERROR))
+
+
+@coroutine
+def method_handler(request, ctx, store):
+    mr, code = api.read_method_request(request['body'])
+    if code is not None:
+        raise Return((mr.errors, code))
+    sr, valid = api.read_scoring_request(mr)
+    if not valid:
+        raise Return((sr.errors, api.INVALID_REQUEST))
+    if mr.request['method'] == 'online_score':
+        response, code = yield online_scoring_handler(sr, ctx, store, is_admin=mr.is_admin)
+    else:
+        response, code = yield clients_interests_handler(sr, ctx, store)
+    logging.info('%s - %s' % (code, response))
+    raise Return((response, code))
+
+
+class HTTPChannel(asynchat.async_chat):
+    """
+    Connection of one client. Requests are read one after another and answered in the same order,
+    a request which came while the previous one is handled waits in the queue. HTTP/1.1 connections
+    are kept alive unless the client asks to close them, HTTP/1.0 ones - only if the client asks to keep them.
+    """
+    router = {
+        "method": method_handler
+    }
+
+    def __init__(self, sock, server):
+        asynchat.async_chat.__init__(self, sock, map=server.loop.map)
+        self.server = server
+        self.data = []
+        self.head = None
+        self.requests = []
+        self.busy = False
+        self.set_terminator('\r\n\r\n')
+
+    def collect_incoming_data(self, data):
+        self.data.append(data)
+        if self.head is None and sum(len(d) for d in self.data) > MAX_HEADERS_SIZE:
+            self.close()
+
+    def found_terminator(self):
+        data, self.data = ''.join(self.data), []
+        if self.head is None:
+            self.head = data
+            length = self.read_head(data)[3].get('Content-Length', '0')
+            if length.isdigit() and int(length) > 0:
+                self.set_terminator(int(length))
+                return
+            data = ''
+        self.requests.append((self.head, data))
+        self.head = None
+        self.set_terminator('\r\n\r\n')
+        self.next_request()
+
+    @staticmethod
+    def read_head(head):
+        lines = head.split('\r\n', 1)
+        words = lines[0].split()
+        method, path, version = (words + ['', '', 'HTTP/0.9'])[:3]
+        return method, path, version, mimetools.Message(StringIO(lines[1] if len(lines) > 1 else ''))
+
+    def next_request(self):
+        if self.busy or not self.requests:
+            return
+        self.busy = True
+        head, body = self.requests.pop(0)
+        method, path, version, headers = self.read_head(head)
+        connection = headers.get('Connection', '').lower()
+        keep_alive = connection == 'keep-alive' or (version == 'HTTP/1.1' and connection != 'close')
+        if method != 'POST':
+            self.respond(NOT_IMPLEMENTED, {"error": "Unsupported method (%r)" % method, "code": NOT_IMPLEMENTED},
+                         False)
+            return
+        task = Task(self.handle_post(path, body, headers))
+        # Requests are finished by replies of the store, the response is sent from the loop, not from
+        # AsyncStore.handle_read, so errors of one client do not break the connection to Redis for all of them
+        task.add_done_callback(lambda t: self.server.loop.call_later(0, lambda: self.finish(t, keep_alive)))
+
+    def handle_post(self, path, data_string, headers):
+        # Same steps as api.MainHTTPHandler.do_POST
+        response, code = {}, api.OK
+        context = {"request_id": headers.get('HTTP_X_REQUEST_ID', uuid.uuid4().hex)}
+        request, code = api.read_body(data_string)
+        if request:
+            path = path.strip("/")
+            logging.info("%s: %s %s" % (path, data_string, context["request_id"]))
+            if path in self.router:
+                try:
+                    response, code = yield self.router[path]({"body": request, "headers": headers}, context,
+                                                             self.server.store)
+                except Exception, e:
+                    logging.exception("Unexpected error: %s" % e)
+                    code = api.INTERNAL_ERROR
+            else:
+                code = api.NOT_FOUND
+        r = api.make_response(response, code)
+        context.update(r)
+        logging.info(context)
+        raise Return((code, r))
+
+    def finish(self, task, keep_alive):
+        try:
+            self.respond(task.value[0], task.value[1], keep_alive)
+        except Exception:
+            logging.exception('Unable to respond to %s' % (self.addr,))
+            self.close()
+
+    def respond(self, code, r, keep_alive):
+        if not self.connected:  # Client has gone while the request was handled
+            return
+        body = json.dumps(r)
+        message = BaseHTTPRequestHandler.responses.get(code, ('',))[0]
+        self.push('HTTP/1.1 %d %s\r\nContent-Type: application/json\r\nContent-Length: %d\r\nConnection: %s\r\n\r\n%s'
+                  % (code, message, len(body), 'keep-alive' if keep_alive else 'close', body))
+        if not keep_alive:
+            self.close_when_done()
+            return
+        self.busy = False
+        self.next_request()
+
+
+class AsyncHTTPServer(asyncore.dispatcher):
+    def __init__(self, server_address, store=None, loop=None, backlog=1024):
+        self.loop = loop or Loop()
+        asyncore.dispatcher.__init__(self, map=self.loop.map)
+        self.store = store
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        self.bind(server_address)
+        self.listen(backlog)
+        self.server_address = self.socket.getsockname()
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is not None:
+            HTTPChannel(pair[0], self)
+
+    def serve_forever(self):
+        self.loop.run_forever()
+
+    def shutdown(self):
+        self.loop.stop()
+
+    def server_close(self):
+        for channel in self.loop.map.values():
+            channel.close()
+
+
+def make_store(loop):
+    handler = api.MainHTTPHandler
+    return AsyncStore(host=handler.HOST, port=handler.PORT, password=handler.PASSWORD, db=handler.DB,
+                      timeout=handler.TIMEOUT, max_retries=handler.MAX_RETRIES, loop=loop)
+
+
+if __name__ == "__main__":
+    op = OptionParser()
+    op.add_option("-p", "--port", action="store", type=int, default=8080)
+    op.add_option("-l", "--log", action="store", default=None)
+    (opts, args) = op.parse_args()
+    logging.basicConfig(filename=opts.log, level=logging.INFO,
+                        format='[%(asctime)s] %(levelname).1s %(message)s', datefmt='%Y.%m.%d %H:%M:%S')
+    loop = Loop()
+    server = AsyncHTTPServer(("localhost", opts.port), make_store(loop), loop)
+    logging.info("Starting async server at %s" % opts.port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
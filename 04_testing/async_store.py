@@ -0,0 +1,398 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Event loop, generator based coroutines and a non-blocking Redis client for the async server.
+# asyncio is not available in Python 2, so the loop is built on asyncore (poll) like asyncio is built on selectors:
+# coroutines yield a Future or a list of Futures (waited concurrently) and finish with raise Return(value).
+import time
+import heapq
+import socket
+import asyncore
+import logging
+import functools
+from collections import deque
+from store import HEALTH_TTL, MGET_CHUNK_SIZE
+
+
+class Return(Exception):
+    def __init__(self, value=None):
+        Exception.__init__(self)
+        self.value = value
+
+
+class StoreError(Exception):
+    pass
+
+
+class Future(object):
+    def __init__(self):
+        self.callbacks = []
+        self.finished = False
+        self.value = None
+        self.error = None
+
+    def done(self):
+        return self.finished
+
+    def result(self):
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+    def add_done_callback(self, callback):
+        if self.finished:
+            callback(self)
+        else:
+            self.callbacks.append(callback)
+
+    def finish(self, value=None, error=None):
+        if self.finished:
+            return
+        self.finished, self.value, self.error = True, value, error
+        callbacks, self.callbacks = self.callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+    def set_result(self, value):
+        self.finish(value=value)
+
+    def set_exception(self, error):
+        self.finish(error=error)
+
+
+def gather(futures):
+    # Future of the list of results, fails with the first error
+    gathered = Future()
+    results = [None] * len(futures)
+    left = [len(futures)]
+
+    def collect(i, future):
+        if future.error is not None:
+            gathered.set_exception(future.error)
+            return
+        results[i] = future.value
+        left[0] -= 1
+        if not left[0]:
+            gathered.set_result(results)
+
+    if not futures:
+        gathered.set_result(results)
+    for i, future in enumerate(futures):
+        future.add_done_callback(functools.partial(collect, i))
+    return gathered
+
+
+class Task(Future):
+    """Runs a generator coroutine, the coroutine is resumed when the Future it yielded is done."""
+    def __init__(self, coro):
+        Future.__init__(self)
+        self.coro = coro
+        self.step()
+
+    def step(self, value=None, error=None):
+        try:
+            if error is not None:
+                waiting = self.coro.throw(error)
+            else:
+                waiting = self.coro.send(value)
+        except Return as e:
+            self.set_result(e.value)
+        except StopIteration:
+            self.set_result(None)
+        except Exception as e:
+            self.set_exception(e)
+        else:
+            if isinstance(waiting, list):
+                waiting = gather(waiting)
+            waiting.add_done_callback(self.wakeup)
+
+    def wakeup(self, future):
+        self.step(future.value, future.error)
+
+
+def coroutine(f):
+    @functools.wraps(f)
+    def wrapper(*args, **kwargs):
+        return Task(f(*args, **kwargs))
+    return wrapper
+
+
+class Loop(object):
+    """
+    Polls sockets of its map and runs timers. One loop serves all connections of the process.
+    Callbacks which should not run inside handlers of another connection are scheduled with call_later(0, ...).
+    """
+    def __init__(self, poll_interval=0.05):
+        self.map = {}
+        self.timers = []
+        self.counter = 0
+        self.poll_interval = poll_interval
+        self.running = False
+
+    def call_later(self, delay, callback):
+        self.counter += 1
+        heapq.heappush(self.timers, (time.time() + delay, self.counter, callback))
+
+    def run_once(self):
+        timeout = self.poll_interval
+        if self.timers:
+            timeout = max(0, min(timeout, self.timers[0][0] - time.time()))
+        asyncore.loop(timeout, True, self.map, 1)
+        now = time.time()
+        while self.timers and self.timers[0][0] <= now:
+            try:
+                heapq.heappop(self.timers)[2]()
+            except Exception:  # Error of one callback must not stop the loop
+                logging.exception('Error in callback of the loop')
+
+    def run_until_complete(self, future):
+        while not future.done():
+            self.run_once()
+        return future.result()
+
+    def run_forever(self):
+        self.running = True
+        while self.running:
+            self.run_once()
+
+    def stop(self):
+        self.running = False
+
+
+def encode_command(*args):
+    parts = ['*%d\r\n' % len(args)]
+    for arg in args:
+        arg = arg.encode('utf-8') if isinstance(arg, unicode) else str(arg)
+        parts.append('$%d\r\n%s\r\n' % (len(arg), arg))
+    return ''.join(parts)
+
+
+class ReplyError(Exception):
+    pass
+
+
+class Incomplete(Exception):
+    pass
+
+
+def parse_reply(buf, pos=0):
+    # RESP reply starting at pos -> (reply, position after it). Raises Incomplete if buf ends before the reply
+    end = buf.find('\r\n', pos)
+    if end < 0:
+        raise Incomplete()
+    kind, line = buf[pos], buf[pos + 1:end]
+    pos = end + 2
+    if kind == '+':
+        return line, pos
+    if kind == '-':
+        return ReplyError(line), pos
+    if kind == ':':
+        return int(line), pos
+    if kind == '$':
+        size = int(line)
+        if size < 0:
+            return None, pos
+        if len(buf) < pos + size + 2:
+            raise Incomplete()
+        return buf[pos:pos + size], pos + size + 2
+    if kind == '*':
+        size = int(line)
+        if size < 0:
+            return None, pos
+        items = []
+        for _ in range(size):
+            item, pos = parse_reply(buf, pos)
+            items.append(item)
+        return items, pos
+    raise StoreError('Unknown reply type %r' % kind)
+
+
+class AsyncStore(asyncore.dispatcher):
+    """
+    Redis client of one connection with the interface of Store, methods return Futures.
+    Commands are pipelined: they are sent at once and replies come in the same order, so concurrent gets of
+    one request cost one round trip. When the connection is lost or a reply does not come in timeout seconds,
+    the connection is reopened and unanswered commands are sent again, up to max_retries attempts per command.
+    Like Store, get, get_many, cache_get and cache_set give None when Redis is not available and echo fails.
+    """
+    def __init__(self, host, port, password, db, timeout, max_retries, loop, health_ttl=HEALTH_TTL):
+        asyncore.dispatcher.__init__(self, map=loop.map)
+        self.host = host
+        self.port = port
+        self.password = password
+        self.db = db
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.loop = loop
+        self.health_ttl = health_ttl
+        self.healthy = None
+        self.checked = 0
+        self.pending = deque()  # [future, command, attempts, sent at] waiting for replies, in order of sending
+        self.out = ''
+        self.buf = ''
+        self.opened = False
+        self.connecting = False
+        self.progress = 0  # Time of the last reply or of opening the connection
+        self.watching = False
+
+    def execute(self, *args):
+        future = Future()
+        command = [future, encode_command(*args), 0, None]
+        if not self.opened:
+            self.open()
+        self.send_command(command)
+        return future
+
+    def open(self):
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.opened = self.connecting = True
+        self.out, self.buf, self.progress = '', '', time.time()
+        # AUTH and SELECT go first on every connection, they are not retried separately
+        setup = []
+        if self.password:
+            setup.append(encode_command('AUTH', self.password))
+        if self.db:
+            setup.append(encode_command('SELECT', self.db))
+        for command in setup:
+            self.pending.append([Future(), command, self.max_retries, self.progress])
+            self.out += command
+        try:
+            self.connect((self.host, self.port))
+        except socket.error as e:
+            self.loop.call_later(0, lambda: self.fail(e))
+        self.watch()
+
+    def send_command(self, command):
+        command[2] += 1
+        command[3] = time.time()
+        self.pending.append(command)
+        self.out += command[1]
+        self.watch()
+
+    def deadline(self):
+        # The oldest unanswered command must get its reply in timeout seconds after it is sent or after the last
+        # reply, whichever is later. New commands do not move the deadline, so a steady load can not hide a stall
+        return max(self.pending[0][3], self.progress) + self.timeout
+
+    def watch(self):
+        if self.pending and not self.watching:
+            self.watching = True
+            self.loop.call_later(self.deadline() - time.time(), self.check_timeout)
+
+    def check_timeout(self):
+        self.watching = False
+        if not self.pending:
+            return
+        now, deadline = time.time(), self.deadline()
+        if now >= deadline:
+            self.fail(StoreError('Timeout of %s seconds' % self.timeout))
+        else:
+            self.watching = True
+            self.loop.call_later(deadline - now, self.check_timeout)
+
+    def close(self):
+        # The connection is opened again by the next command
+        if self.opened:
+            self.opened = self.connecting = False
+            asyncore.dispatcher.close(self)
+
+    def fail(self, error):
+        self.close()
+        logging.info('Unable to use Redis: %s' % error)
+        pending, self.pending = self.pending, deque()
+        retry = []
+        for command in pending:
+            if command[2] < self.max_retries:
+                retry.append(command)
+            else:
+                command[0].set_exception(error if isinstance(error, StoreError) else StoreError(error))
+        if retry:
+            self.open()
+            for command in retry:
+                self.send_command(command)
+
+    def handle_connect(self):
+        self.connecting = False
+
+    def writable(self):
+        return self.connecting or bool(self.out)
+
+    def handle_write(self):
+        sent = self.send(self.out)
+        self.out = self.out[sent:]
+
+    def handle_read(self):
+        data = self.recv(65536)
+        if not data:
+            return
+        self.buf += data
+        pos = 0
+        while self.pending:
+            try:
+                reply, pos = parse_reply(self.buf, pos)
+            except Incomplete:
+                break
+            future = self.pending.popleft()[0]
+            self.progress = time.time()
+            if isinstance(reply, ReplyError):
+                future.set_exception(reply)
+            else:
+                future.set_result(reply)
+        self.buf = self.buf[pos:]
+
+    def handle_close(self):
+        self.fail(StoreError('Connection closed'))
+
+    def handle_error(self):
+        self.fail(StoreError(asyncore.compact_traceback()[2]))
+
+    def mark(self, healthy):
+        self.healthy, self.checked = healthy, time.time()
+
+    def maintain(self, future):
+        # Future of the reply or None if Redis is not available
+        maintained = Future()
+
+        def done(f):
+            self.mark(f.error is None)
+            maintained.set_result(None if f.error is not None else f.value)
+        future.add_done_callback(done)
+        return maintained
+
+    def is_available(self):
+        # Like Store.is_available, Redis is pinged only if there were no calls to it in health_ttl seconds
+        if self.healthy is not None and time.time() - self.checked < self.health_ttl:
+            available = Future()
+            available.set_result(self.healthy)
+            return available
+        return self.maintain(self.echo(1))
+
+    def echo(self, val):
+        return self.execute('ECHO', val)
+
+    def get(self, key):
+        return self.maintain(self.execute('GET', key))
+
+    def get_many(self, keys, chunk_size=MGET_CHUNK_SIZE):
+        chunks = [self.execute('MGET', *keys[i:i + chunk_size]) for i in range(0, len(keys), chunk_size)]
+        values = Future()
+
+        def join(f):
+            if f.error is not None:
+                values.set_exception(f.error)
+            else:
+                values.set_result([value for chunk in f.value for value in chunk])
+        gather(chunks).add_done_callback(join)
+        return self.maintain(values)
+
+    def cache_set(self, key, value, ttl=None):
+        if ttl:
+            future = self.execute('SET', key, value, 'EX', ttl)
+        else:
+            future = self.execute('SET', key, value)
+        result = Future()
+        self.maintain(future).add_done_callback(
+            lambda f: result.set_result(None if f.value is None else (key, value, ttl)))
+        return result
+
+    def cache_get(self, key):
+        return self.maintain(self.execute('GET', key))
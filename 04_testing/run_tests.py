@@ -1,6 +1,6 @@
 import unittest
 from tests.functional import test_fields, test_storage
-from tests.integration import test_api
+from tests.integration import test_api, test_server, test_async_api
 
 def run_test(test_cases):
     class NewResult(unittest.TextTestResult):
@@ -23,3 +23,5 @@ if __name__ == '__main__':
     run_test(test_fields.TEST_CASES)
     run_test(test_storage.TEST_CASES)
     run_test(test_api.TEST_CASES)
+    run_test(test_server.TEST_CASES)
+    run_test(test_async_api.TEST_CASES)
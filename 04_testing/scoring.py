@@ -2,7 +2,7 @@ import hashlib
 import json
 
 
-def get_score(store, phone, email, birthday=None, gender=None, first_name=None, last_name=None):
+def get_score_key(phone, birthday=None, first_name=None, last_name=None):
     key_parts = [
         first_name or "",
         last_name or "",
@@ -14,12 +14,11 @@ def get_score(store, phone, email, birthday=None, gender=None, first_name=None,
         # string like date.
     ]
     key_parts = [str(i) for i in key_parts]
-    key = "uid:" + hashlib.md5("".join(key_parts)).hexdigest()
-    # try get from cache,
-    # fallback to heavy calculation in case of cache miss
-    score = store.cache_get(key) or 0
-    if score:
-        return float(score)
+    return "uid:" + hashlib.md5("".join(key_parts)).hexdigest()
+
+
+def calculate_score(phone, email, birthday=None, gender=None, first_name=None, last_name=None):
+    score = 0
     if phone:
         score += 1.5
     if email:
@@ -28,11 +27,43 @@ def get_score(store, phone, email, birthday=None, gender=None, first_name=None,
         score += 1.5
     if first_name and last_name:
         score += 0.5
+    return score
+
+
+def get_score(store, phone, email, birthday=None, gender=None, first_name=None, last_name=None):
+    key = get_score_key(phone, birthday, first_name, last_name)
+    # try get from cache,
+    # fallback to heavy calculation in case of cache miss
+    score = store.cache_get(key) or 0
+    if score:
+        return float(score)
+    score = calculate_score(phone, email, birthday, gender, first_name, last_name)
     # cache for 60 minutes
     store.cache_set(key, score, 60 * 60)
     return score
 
 
-def get_interests(store, cid):
-    r = store.get("i:%s" % cid)
+def decode_interests(r):
     return json.loads(r) if r else []
+
+
+def get_interests(store, cid):
+    return decode_interests(store.get("i:%s" % cid))
+
+
+def interests_keys(client_ids):
+    # Distinct client ids and their keys for one bulk request
+    cids = list(set(client_ids))
+    return cids, ["i:%s" % cid for cid in cids]
+
+
+def decode_interests_many(cids, values):
+    # Values of the bulk request are decoded once each. None if the store is not available
+    if values is None:
+        return None
+    return {cid: decode_interests(r) for cid, r in zip(cids, values)}
+
+
+def get_interests_many(store, client_ids):
+    cids, keys = interests_keys(client_ids)
+    return decode_interests_many(cids, store.get_many(keys))
@@ -1,16 +1,23 @@
+import time
 import redis
 import logging
 
+HEALTH_TTL = 5  # Seconds the result of the last call to Redis is trusted as its health state
+MGET_CHUNK_SIZE = 1000
+
 
 class Store(object):
-    def __init__(self, host, port, password, db, timeout, max_retries):
+    def __init__(self, host, port, password, db, timeout, max_retries, health_ttl=HEALTH_TTL):
         self.host = host
         self.port = port
         self.password = password
         self.db = db
         self.timeout = timeout
         self.max_retries = max_retries
+        self.health_ttl = health_ttl
         self.attempts = 0
+        self.healthy = None
+        self.checked = 0
         self.r = redis.Redis(host=self.host, port=self.port,
                                         password=self.password, db=self.db,
                                         socket_timeout=self.timeout,
@@ -19,24 +26,49 @@ class Store(object):
     def echo(self, val):
         return self.r.echo(val)
 
+    def mark(self, healthy):
+        self.healthy, self.checked = healthy, time.time()
+
+    def is_available(self):
+        # Redis is pinged only if there were no calls to it in health_ttl seconds
+        if self.healthy is None or time.time() - self.checked >= self.health_ttl:
+            try:
+                self.echo(1)
+                self.mark(True)
+            except Exception as e:
+                logging.info('Unable to use Redis: %s' % e)
+                self.mark(False)
+        return self.healthy
+
     def maintain(f):
-        def wrapper(self, *args):
-            response = None
+        def wrapper(self, *args, **kwargs):
             for i in range(self.max_retries):
                 try:
-                    response = f(self, *args)
+                    response = f(self, *args, **kwargs)
                 except Exception as e:
                     self.attempts += 1
                     logging.info('Unable to use Redis: %s' % e)
-                if self.attempts == self.max_retries:
-                    break
-            return response
+                else:
+                    self.mark(True)
+                    return response
+            self.mark(False)
+            return None
         return wrapper
 
     @maintain
     def get(self, key):
         return self.r.get(key)
 
+    @maintain
+    def get_many(self, keys, chunk_size=MGET_CHUNK_SIZE):
+        # Values of keys in their order. MGETs of chunks are sent in one pipeline, so it is one round trip
+        if len(keys) <= chunk_size:
+            return self.r.mget(keys) if keys else []
+        pipe = self.r.pipeline(transaction=False)
+        for i in range(0, len(keys), chunk_size):
+            pipe.mget(keys[i:i + chunk_size])
+        return [value for chunk in pipe.execute() for value in chunk]
+
     @maintain
     def cache_set(self, key, value, ttl=None):
         self.r.set(key, value)
@@ -47,4 +79,3 @@ class Store(object):
     @maintain
     def cache_get(self, key):
         return self.r.get(key)
-
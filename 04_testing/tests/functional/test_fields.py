@@ -41,6 +41,17 @@ class TestCharField(unittest.TestCase):
             api.CharField(required=False, nullable=True, value=val, name='first_name').validate()
             api.CharField(required=False, nullable=True, value=val, name='last_name').validate()
 
+    @cases([u'Artem', u'Артём', u'Tâm', 'Артём', u''])
+    def test_valid_name(self, val):
+        """ Test CharField VALID names, unicode ones come from JSON requests """
+        api.CharField(required=False, nullable=True, value=val, name='first_name').validate()
+
+    @cases([u'Artem1', u'Артём!', u'Артём№', 'Артём№', 1])
+    def test_invalid_name(self, val):
+        """ Test CharField INVALID names """
+        with self.assertRaises(ValidationError):
+            api.CharField(required=False, nullable=True, value=val, name='first_name').validate()
+
 
 class TestArgumentsField(unittest.TestCase):
     @cases([{}, [], {'key': 'val'}, [1, 2]])
@@ -138,6 +149,25 @@ class ClientIDsField(unittest.TestCase):
             api.ClientIDsField(required=False, nullable=True, value=val).validate()
 
 
+class TestRequestFields(unittest.TestCase):
+    def test_fields_collected(self):
+        """ Test fields are collected once per request class """
+        self.assertEqual(sorted(api.MethodRequest.fields), ['account', 'arguments', 'login', 'method', 'token'])
+        self.assertEqual(sorted(api.ClientsInterestsRequest.get_class_fields()), ['client_ids', 'date'])
+        self.assertFalse(hasattr(api.OnlineScoreRequest(None), '__dict__'))
+
+    @cases([({'first_name': 'a', 'last_name': 'b'}, {'phone': '79175002040', 'email': 'a@b.ru'})])
+    def test_request_values(self, first, second):
+        """ Test values of requests are kept per request, shared fields are not modified """
+        r1, r2 = api.OnlineScoreRequest(first), api.OnlineScoreRequest(second)
+        r1.read_arguments(first)
+        r2.read_arguments(second)
+        self.assertEqual((r1.first_name, r1.phone), ('a', None))
+        self.assertEqual((r2.first_name, r2.phone), (None, '79175002040'))
+        self.assertTrue(r1.is_valid() and r2.is_valid())
+        self.assertTrue(all(f.value is None for f in api.OnlineScoreRequest.fields.values()))
+
+
 TEST_CASES = [TestField, TestCharField, TestArgumentsField, TestEmailField, TestPhoneField, TestDateField,
-              TestBirthDayField, TestGenderField, ClientIDsField]
+              TestBirthDayField, TestGenderField, ClientIDsField, TestRequestFields]
 
@@ -38,6 +38,35 @@ class TestSuite(unittest.TestCase):
         self.store.cache_set('CacheGetKey', 'CacheTTL=10s', 10)
         self.assertEqual(self.store.cache_get('CacheGetKey'), 'CacheTTL=10s')
 
+    def test_get_many(self):
+        """ Test get_many method """
+        self.store.cache_set('OtherKey', 'OtherValue')
+        keys = ['TestKey', 'Missing', 'OtherKey']
+        self.assertEqual(self.store.get_many(keys), ['TestValue', None, 'OtherValue'])
+        self.assertEqual(self.store.get_many(keys, 2), ['TestValue', None, 'OtherValue'])
+        self.assertEqual(self.store.get_many(keys, chunk_size=2), ['TestValue', None, 'OtherValue'])
+        self.assertEqual(self.store.cache_set('TTLKey', 'TTLValue', ttl=10), ('TTLKey', 'TTLValue', 10))
+        self.assertEqual(self.store.get_many([]), [])
+
+    def test_get_many_round_trips(self):
+        """ Test get_many makes one round trip on success """
+        self.store.r.mget = MagicMock(return_value=['TestValue'])
+        self.assertEqual(self.store.get_many(['TestKey']), ['TestValue'])
+        self.assertEqual(self.store.r.mget.call_count, 1)
+
+    def test_is_available(self):
+        """ Test health state is cached for health_ttl seconds """
+        self.store.r.echo = MagicMock(return_value='1')
+        self.assertTrue(self.store.is_available())
+        self.assertTrue(self.store.is_available())
+        self.assertEqual(self.store.r.echo.call_count, 1)
+        self.store.r.get = MagicMock(side_effect=Exception('ConnectionError'))
+        self.store.get('TestKey')
+        self.assertFalse(self.store.is_available())  # Failed call updates the state
+        self.store.checked -= self.store.health_ttl
+        self.assertTrue(self.store.is_available())
+        self.assertEqual(self.store.r.echo.call_count, 2)
+
     def test_connection_error(self):
         """ Test connection error """
         self.store.r.get = MagicMock(side_effect=Exception('ConnectionError'))  # No ConnectionError in 2.7
@@ -1,7 +1,7 @@
 import unittest
 import hashlib
 import datetime
-from mock import patch
+from mock import patch, MagicMock
 from mockredis import mock_redis_client
 from store import Store
 import api
@@ -20,10 +20,15 @@ def set_valid_auth(request):
         request["token"] = hashlib.sha512(msg).hexdigest()
 
 
-class TestInvalidRequests(unittest.TestCase):
+class ApiTestCase(unittest.TestCase):
+    def get_response(self, request, headers=None, context=None, store=None):
+        return get_response(request, headers, context, store)
+
+
+class TestInvalidRequests(ApiTestCase):
     def test_empty_request(self):
         """ Test empty request """
-        _, code = get_response({})
+        _, code = self.get_response({})
         self.assertEqual(api.INVALID_REQUEST, code)
 
     @cases([{'account': 'horns&hoofs', 'login': 'h&f', 'method': 'online_score', 'token': '', 'arguments': {}},
@@ -31,7 +36,7 @@ class TestInvalidRequests(unittest.TestCase):
             {'account': 'horns&hoofs', 'login': 'admin', 'method': 'online_score', 'token': '', 'arguments': {}}])
     def test_bad_auth(self, request):
         """ Test bad auth """
-        _, code = get_response(request)
+        _, code = self.get_response(request)
         self.assertEqual(api.FORBIDDEN, code)
 
     @cases([{'account': 'horns&hoofs', 'login': 'h&f', 'method': 'online_score'},
@@ -43,7 +48,7 @@ class TestInvalidRequests(unittest.TestCase):
         Request is valid if all fields are valid.
         """
         set_valid_auth(request)
-        response, code = get_response(request)
+        response, code = self.get_response(request)
         self.assertEqual(api.INVALID_REQUEST, code)
         self.assertTrue(len(response))
 
@@ -70,7 +75,7 @@ class TestInvalidRequests(unittest.TestCase):
         """ Test absent paired arguments  """
         request = {'account': 'horns&hoofs', 'login': 'h&f', 'method': 'online_score', 'arguments': arguments}
         set_valid_auth(request)
-        response, code = get_response(request)
+        response, code = self.get_response(request)
         self.assertEqual(api.INVALID_REQUEST, code, arguments)
         self.assertTrue(len(response))
 
@@ -84,7 +89,7 @@ class TestInvalidRequests(unittest.TestCase):
         """ Test valid pairs with invalid values  """
         request = {'account': 'horns&hoofs', 'login': 'h&f', 'method': 'online_score', 'arguments': arguments}
         set_valid_auth(request)
-        response, code = get_response(request)
+        response, code = self.get_response(request)
         self.assertEqual(api.INVALID_REQUEST, code, arguments)
         self.assertTrue(len(response))
 
@@ -96,12 +101,12 @@ class TestInvalidRequests(unittest.TestCase):
         """ Test valid interests request with invalid values"""
         request = {'account': 'horns&hoofs', 'login': 'h&f', 'method': 'clients_interests', 'arguments': arguments}
         set_valid_auth(request)
-        response, code = get_response(request)
+        response, code = self.get_response(request)
         self.assertEqual(api.INVALID_REQUEST, code, arguments)
         self.assertTrue(len(response))
 
 
-class TestValidRequests(unittest.TestCase):
+class TestValidRequests(ApiTestCase):
     @patch('redis.Redis', mock_redis_client)
     def setUp(self):
         HOST = 'host'
@@ -125,7 +130,7 @@ class TestValidRequests(unittest.TestCase):
         """ Test valid online_score requests """
         request = {'account': 'horns&hoofs', 'login': 'h&f', 'method': 'online_score', 'arguments': arguments}
         set_valid_auth(request)
-        response, code = get_response(request, context=self.context, store=self.store)
+        response, code = self.get_response(request, context=self.context, store=self.store)
         self.assertEqual(api.OK, code, arguments)
         score = response.get("score")
         self.assertTrue(isinstance(score, (int, float)) and score >= 0, arguments)
@@ -137,7 +142,7 @@ class TestValidRequests(unittest.TestCase):
         arguments = {"phone": "79175002040", "email": "stupnikov@otus.ru"}
         request = {"account": "horns&hoofs", "login": "admin", "method": "online_score", "arguments": arguments}
         set_valid_auth(request)
-        response, code = get_response(request, context=self.context, store=self.store)
+        response, code = self.get_response(request, context=self.context, store=self.store)
         self.assertEqual(api.OK, code)
         score = response.get("score")
         self.assertEqual(score, 42)
@@ -157,12 +162,22 @@ class TestValidRequests(unittest.TestCase):
         self.c_int = {0: ['interest_c0'], 1: ['interest_c1'], 2: ['interest_c2'], 3: ['interest_c3'], }
         request = {"account": "horns&hoofs", "login": "h&f", "method": "clients_interests", "arguments": arguments}
         set_valid_auth(request)
-        response, code = get_response(request, context=self.context, store=self.store)
+        response, code = self.get_response(request, context=self.context, store=self.store)
         self.assertEqual(api.OK, code, arguments)
         self.assertEqual(len(arguments["client_ids"]), len(response))
         for k, v in response.items():
             self.assertTrue(v == self.c_int[k])
         self.assertEqual(self.context.get("nclients"), len(arguments["client_ids"]))
 
+    def test_interests_store_error(self):
+        """ Test interests request fails if the store fails """
+        self.store.r.mget = MagicMock(side_effect=Exception('ConnectionError'))
+        self.store.r.pipeline = MagicMock(side_effect=Exception('ConnectionError'))
+        arguments = {"client_ids": [1, 2]}
+        request = {"account": "horns&hoofs", "login": "h&f", "method": "clients_interests", "arguments": arguments}
+        set_valid_auth(request)
+        _, code = self.get_response(request, context=self.context, store=self.store)
+        self.assertEqual(api.INTERNAL_ERROR, code)
+
 
 TEST_CASES = [TestInvalidRequests, TestValidRequests]
@@ -0,0 +1,229 @@
+import json
+import time
+import socket
+import httplib
+import unittest
+import threading
+from SocketServer import ThreadingTCPServer, BaseRequestHandler
+from mock import patch
+from mockredis import mock_redis_client
+from store import Store
+import api
+import async_api
+from async_store import AsyncStore, Loop, Incomplete, parse_reply
+from tests.integration import test_api
+
+
+def encode_reply(reply):
+    if reply is None:
+        return '$-1\r\n'
+    if reply is True:
+        return '+OK\r\n'
+    if isinstance(reply, (int, long)):
+        return ':%d\r\n' % reply
+    if isinstance(reply, list):
+        return '*%d\r\n%s' % (len(reply), ''.join(encode_reply(item) for item in reply))
+    return '$%d\r\n%s\r\n' % (len(str(reply)), reply)
+
+
+class FakeRedisHandler(BaseRequestHandler):
+    # Runs commands of the Redis protocol on the mock Redis client of the server
+    def handle(self):
+        buf = ''
+        while True:
+            data = self.request.recv(65536)
+            if not data:
+                return
+            buf += data
+            while True:
+                try:
+                    command, pos = parse_reply(buf)
+                except Incomplete:
+                    break
+                buf = buf[pos:]
+                try:
+                    reply = encode_reply(self.execute(*command))
+                except Exception as e:
+                    reply = '-ERR %s\r\n' % e
+                self.request.sendall(reply)
+
+    def execute(self, name, *args):
+        redis = self.server.redis
+        name = name.upper()
+        if name in ('AUTH', 'SELECT'):
+            return True
+        if name == 'SET':
+            return redis.set(args[0], args[1], ex=int(args[3]) if len(args) > 3 else None)
+        if name == 'MGET':
+            return redis.mget(list(args))
+        return getattr(redis, name.lower())(*args)
+
+
+class SilentRedisHandler(BaseRequestHandler):
+    # Accepts commands and never replies, like Redis which hangs
+    def handle(self):
+        while self.request.recv(65536):
+            pass
+
+
+class FakeRedis(ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, redis, handler=FakeRedisHandler):
+        ThreadingTCPServer.__init__(self, ('localhost', 0), handler)
+        self.redis = redis
+        self.thread = threading.Thread(target=self.serve_forever, kwargs={'poll_interval': 0.05})
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def make_store(loop, port, timeout=1, max_retries=2):
+    return AsyncStore(host='localhost', port=port, password='password', db=0, timeout=timeout,
+                      max_retries=max_retries, loop=loop)
+
+
+def closed_port():
+    sock = socket.socket()
+    sock.bind(('localhost', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+class AsyncHandlerMixin(object):
+    """Runs the cases of test_api against async_api.method_handler with AsyncStore on the mock Redis"""
+    def setUp(self):
+        super(AsyncHandlerMixin, self).setUp()
+        self.loop = Loop()
+        store = getattr(self, 'store', None)
+        self.redis = FakeRedis(store.r if store is not None else mock_redis_client())
+        self.async_store = make_store(self.loop, self.redis.server_address[1])
+
+    def tearDown(self):
+        self.async_store.close()
+        self.redis.stop()
+        super(AsyncHandlerMixin, self).tearDown()
+
+    def get_response(self, request, headers=None, context=None, store=None):
+        return self.loop.run_until_complete(
+            async_api.method_handler({"body": request, "headers": headers}, context, self.async_store))
+
+
+class TestAsyncInvalidRequests(AsyncHandlerMixin, test_api.TestInvalidRequests):
+    pass
+
+
+class TestAsyncValidRequests(AsyncHandlerMixin, test_api.TestValidRequests):
+    def test_store_unavailable(self):
+        """ Test store errors are handled like in Store """
+        self.async_store = make_store(self.loop, closed_port(), timeout=0.2)
+        request = {"account": "horns&hoofs", "login": "h&f", "method": "clients_interests",
+                   "arguments": {"client_ids": [1, 2]}}
+        test_api.set_valid_auth(request)
+        self.assertEqual(self.get_response(request, context={}), ('Store is not available', api.INTERNAL_ERROR))
+        self.assertEqual(self.loop.run_until_complete(self.async_store.get('i:1')), None)
+
+
+def post(connection, path, body):
+    connection.request('POST', path, body)
+    response = connection.getresponse()
+    return response.status, json.loads(response.read())
+
+
+class TestAsyncServer(unittest.TestCase):
+    def setUp(self):
+        self.loop = Loop()
+        self.mock = mock_redis_client()
+        self.redis = FakeRedis(self.mock)
+        self.server = async_api.AsyncHTTPServer(('localhost', 0), make_store(self.loop, self.redis.server_address[1]),
+                                                self.loop)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.thread.join()
+        self.server.server_close()
+        self.redis.stop()
+
+    def interests_request(self):
+        request = {"account": "horns&hoofs", "login": "h&f", "method": "clients_interests",
+                   "arguments": {"client_ids": [1, 2]}}
+        test_api.set_valid_auth(request)
+        return json.dumps(request)
+
+    def test_keep_alive(self):
+        """ Test requests of one keep-alive connection get the same responses as from MainHTTPHandler """
+        self.mock.set('i:1', '["books"]')
+        requests = [('/method/', self.interests_request()), ('/method/', '{"login": "h&f"}'),
+                    ('/method/', 'not json'), ('/method/', '{}'), ('/unknown/', '{"login": "h&f"}')]
+        with patch('redis.Redis', mock_redis_client):
+            store = Store(host='host', port=0, password='password', db=0, timeout=1, max_retries=2)
+        store.r = self.mock
+        sync_server = api.make_server(('localhost', 0), api.MainHTTPHandler)
+        sync_thread = threading.Thread(target=sync_server.serve_forever, kwargs={'poll_interval': 0.05})
+        sync_thread.daemon = True
+        sync_thread.start()
+        try:
+            expected = []
+            with patch.object(api.MainHTTPHandler, 'store', store):
+                for path, body in requests:
+                    connection = httplib.HTTPConnection('localhost', sync_server.server_address[1], timeout=5)
+                    expected.append(post(connection, path, body))
+                    connection.close()
+        finally:
+            sync_server.shutdown()
+            sync_server.server_close()
+        connection = httplib.HTTPConnection('localhost', self.server.server_address[1], timeout=5)
+        responses = [post(connection, path, body) for path, body in requests]
+        connection.close()
+        self.assertEqual(responses[0], (api.OK, {"code": api.OK, "response": {"1": ["books"], "2": []}}))
+        self.assertEqual(responses, expected)
+
+    def test_respond_error(self):
+        """ Test an error of one response does not break the connection to Redis """
+        self.mock.set('i:1', '["books"]')
+        port = self.server.server_address[1]
+        ok = (api.OK, {"code": api.OK, "response": {"1": ["books"], "2": []}})
+        self.assertEqual(post(httplib.HTTPConnection('localhost', port, timeout=5), '/method/',
+                              self.interests_request()), ok)
+        redis_socket = self.server.store.socket
+        with patch.object(async_api.HTTPChannel, 'respond', side_effect=Exception('broken')):
+            with self.assertRaises(Exception):
+                post(httplib.HTTPConnection('localhost', port, timeout=5), '/method/', self.interests_request())
+        self.assertEqual(post(httplib.HTTPConnection('localhost', port, timeout=5), '/method/',
+                              self.interests_request()), ok)
+        self.assertIs(self.server.store.socket, redis_socket)
+
+
+class TestAsyncStore(unittest.TestCase):
+    def test_timeout_under_load(self):
+        """ Test commands time out when Redis does not reply while new commands keep coming """
+        loop, redis = Loop(), FakeRedis(None, SilentRedisHandler)
+        store = make_store(loop, redis.server_address[1], timeout=0.3)
+        started = time.time()
+        first = store.get('i:1')
+
+        def load():
+            store.get('i:2')
+            if time.time() - started < 3:
+                loop.call_later(0.1, load)
+        loop.call_later(0.1, load)
+        try:
+            while not first.done() and time.time() - started < 3:
+                loop.run_once()
+            self.assertTrue(first.done())
+            self.assertIsNone(first.result())
+            self.assertLess(time.time() - started, 1.5)  # Two attempts of 0.3 seconds, load did not delay them
+        finally:
+            store.close()
+            redis.stop()
+
+
+TEST_CASES = [TestAsyncInvalidRequests, TestAsyncValidRequests, TestAsyncServer, TestAsyncStore]
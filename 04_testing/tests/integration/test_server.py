@@ -0,0 +1,75 @@
+import json
+import time
+import httplib
+import unittest
+import threading
+from BaseHTTPServer import BaseHTTPRequestHandler
+import api
+
+
+class SlowHandler(BaseHTTPRequestHandler):
+    release = threading.Event()
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        self.release.wait(5)
+        self.send_response(api.OK)
+        self.end_headers()
+        self.wfile.write(json.dumps({"code": api.OK}))
+
+    def log_message(self, *args):
+        pass
+
+
+def post(port, results):
+    connection = httplib.HTTPConnection('localhost', port, timeout=5)
+    connection.request('POST', '/method/', '{}', {'Content-Length': '2'})
+    response = connection.getresponse()
+    results.append((response.status, json.loads(response.read())))
+    connection.close()
+
+
+class TestPooledServer(unittest.TestCase):
+    def setUp(self):
+        SlowHandler.release.clear()
+        self.server = api.make_server(('localhost', 0), SlowHandler, 'thread', threads=2, max_inflight=3)
+        self.port = self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever, kwargs={'poll_interval': 0.05})
+        self.thread.daemon = True
+        self.thread.start()
+
+    def tearDown(self):
+        SlowHandler.release.set()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_concurrent_requests(self):
+        """ Test requests are handled by threads of the pool at once """
+        results = []
+        clients = [threading.Thread(target=post, args=(self.port, results)) for _ in range(2)]
+        for client in clients:
+            client.start()
+        time.sleep(0.2)
+        self.assertEqual(results, [])  # Both requests wait in handlers, none of them blocks the other
+        SlowHandler.release.set()
+        for client in clients:
+            client.join()
+        self.assertEqual([status for status, _ in results], [api.OK, api.OK])
+
+    def test_shedding(self):
+        """ Test requests over max_inflight are rejected with 503 """
+        results = []
+        clients = [threading.Thread(target=post, args=(self.port, results)) for _ in range(3)]
+        for client in clients:
+            client.start()
+        time.sleep(0.2)
+        post(self.port, results)
+        self.assertEqual(results, [(api.SERVICE_UNAVAILABLE, {"error": "Service Unavailable",
+                                                              "code": api.SERVICE_UNAVAILABLE})])
+        SlowHandler.release.set()
+        for client in clients:
+            client.join()
+        self.assertEqual(sorted(status for status, _ in results), [api.OK] * 3 + [api.SERVICE_UNAVAILABLE])
+
+
+TEST_CASES = [TestPooledServer]